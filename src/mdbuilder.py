@@ -33,23 +33,47 @@ from __future__ import print_function, division
 
 import os
 import sys
+import gzip
+import bz2
+import json
+import hashlib
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-from Tkinter import *
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+import socket
+import multiprocessing
 
-import tkMessageBox
-import tkFileDialog
+# run as a script (force-field server or batch build) without PyMOL/Tk
+_HAS_GUI = 0
+if __name__ != '__main__':
+    try:
+        from Tkinter import *
+
+        import tkMessageBox
+        import tkFileDialog
+        import Pmw
+        from pymol import cmd, util
+        from pymol.cgo import *
+        from chempy import Atom, Bond
+        from chempy.models import Indexed
+    except ImportError:
+        pass
+    else:
+        _HAS_GUI = 1
 try:
     from math import fsum as sum
 except ImportError:
     pass
 
-import Pmw
-from pymol import cmd, util
-from pymol.cgo import *
-
 try:
     import numpy
 except ImportError:
@@ -57,14 +81,28 @@ except ImportError:
 else:
     _HAS_LIB = 1
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 #import traceback
 #import getopt
 import time
 import math
+import mmap
 import operator
+import re
 from copy import deepcopy
-from struct import calcsize, unpack
+from fnmatch import fnmatchcase
 from collections import OrderedDict, defaultdict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 from math import sqrt, cos, sin, radians
 from itertools import combinations, product, repeat, chain
 from timeit import default_timer as clock
@@ -135,7 +173,12 @@ def perr(*errMsg):
 def wopen(filename, mode='wb'):
     assert mode[0] == 'w'
     if os.path.isfile(filename):
-        copy = filename + '.copy'
+        # the compression extension stays last, so ropen reads the copy
+        if is_compressed(filename):
+            base, ext = split_ext(filename)
+            copy = base + '.copy' + ext
+        else:
+            copy = filename + '.copy'
         if os.path.isfile(copy):
             try:
                 os.remove(copy)
@@ -150,92 +193,694 @@ def wopen(filename, mode='wb'):
             print(err)
             perr("Cannot rename", filename)
 
-    return open(filename, mode)
+    return _open(filename, mode)
 
 
-def read_pdb(filename, epreInpDict=None):
-    aliasAtomList = epreInpDict['ALIASATOM'] if epreInpDict is not None else []
-    aliasResiList = epreInpDict['ALIASRES'] if epreInpDict is not None else []
-    pdbDataList = []
-    newSegList = []
-    pdbResCnt = 0
-    lastResNum = 0
-    lastResName = None
+def ropen(filename, mode='r'):
+    assert mode[0] == 'r'
+    return _open(filename, mode)
+
+
+COMPRESSED_EXTS = ('.gz', '.bz2', '.xz')
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSED_EXTS
+
+
+def split_ext(filename):
+    """Split filename like os.path.splitext, but keep a compression
+    extension with the one before it: out.pdb.gz gives ('out', '.pdb.gz').
+    """
+    base, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSED_EXTS:
+        base, ext2 = os.path.splitext(base)
+        ext = ext2 + ext
+    return base, ext
+
+
+def _open(filename, mode):
+    """Open a file, compressing or decompressing by its extension.
+
+    Names ending in .gz, .bz2 or .xz are read and written through the
+    matching codec one buffer at a time, so nothing is ever held whole
+    in memory.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in COMPRESSED_EXTS:
+        return open(filename, mode)
+
+    if 'b' not in mode and sys.version_info[0] >= 3:
+        mode += 't'
+    if ext == '.gz':
+        return gzip.open(filename, mode, 6)
+    elif ext == '.bz2':
+        return getattr(bz2, 'open', bz2.BZ2File)(filename, mode)
+    elif lzma is None:
+        raise IOError('xz support needs the lzma module: %s' % filename)
+    else:
+        return lzma.open(filename, mode)
+
+
+class NameTable(object):
+    """Interned strings addressed by small integer ids."""
+
+    def __init__(self, names=()):
+        self.names = []
+        self.index = {}
+        for name in names:
+            self.intern(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+    def intern(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = len(self.names)
+            self.index[name] = i
+            self.names.append(name)
+        return i
+
+    def intern_all(self, names):
+        return numpy.fromiter((self.intern(name) for name in names),
+                              dtype=numpy.int32)
+
+    def take(self, ids):
+        return numpy.array(self.names, dtype=object)[ids]
+
+
+class System(object):
+    """Columnar structure model backed by NumPy arrays.
+
+    atoms    -- structured array (num, name, res) with one row per atom
+    pos      -- float64 array of shape (natom, 3), NaN for unknown positions
+    residues -- structured array (num, name, seg, start) with one row per
+                residue; start is the index of its first atom
+    segments -- structured array (name, start) with one row per segment;
+                start is the index of its first residue
+
+    Atom, residue and segment names are ids into the shared name table.
+    """
+
+    ATOM_DTYPE = [('num', 'i4'), ('name', 'i4'), ('res', 'i4')]
+    RESI_DTYPE = [('num', 'i4'), ('name', 'i4'), ('seg', 'i4'),
+                  ('start', 'i4')]
+    SEG_DTYPE = [('name', 'i4'), ('start', 'i4')]
+
+    def __init__(self, natom=0, nres=0, nseg=0, names=None):
+        self.names = NameTable() if names is None else names
+        self.atoms = numpy.zeros(natom, dtype=self.ATOM_DTYPE)
+        self.pos = numpy.empty((natom, 3), dtype=numpy.float64)
+        self.pos.fill(numpy.nan)
+        self.residues = numpy.zeros(nres, dtype=self.RESI_DTYPE)
+        self.segments = numpy.zeros(nseg, dtype=self.SEG_DTYPE)
+
+    @property
+    def natom(self):
+        return len(self.atoms)
+
+    @property
+    def nres(self):
+        return len(self.residues)
+
+    @property
+    def nseg(self):
+        return len(self.segments)
+
+    def atom_names(self):
+        return self.names.take(self.atoms['name'])
+
+    def res_names(self):
+        return self.names.take(self.residues['name'])
+
+    def seg_names(self):
+        return self.names.take(self.segments['name'])
+
+    def res_stop(self):
+        return numpy.append(self.residues['start'][1:], self.natom)
+
+    def seg_stop(self):
+        return numpy.append(self.segments['start'][1:], self.nres)
+
+    @classmethod
+    def from_pdbdata(cls, pdbDataList):
+        names = NameTable()
+        segRows = []
+        resRows = []
+        atomRows = []
+        posList = []
+        nan = numpy.nan
+        for segCnt, (segName, segDataList) in enumerate(pdbDataList):
+            segRows.append((names.intern(segName), len(resRows)))
+            for resNum, resName, resAtom in segDataList:
+                resCnt = len(resRows)
+                resRows.append((resNum, names.intern(resName), segCnt,
+                                len(atomRows)))
+                for atom in resAtom:
+                    atomRows.append((atom[0], names.intern(atom[1]), resCnt))
+                    if atom[2] is None:
+                        posList.append((nan, nan, nan))
+                    else:
+                        posList.append(atom[2:5])
+
+        system = cls(names=names)
+        system.atoms = numpy.array(atomRows, dtype=cls.ATOM_DTYPE)
+        system.pos = numpy.array(posList, dtype=numpy.float64).reshape(-1, 3)
+        system.residues = numpy.array(resRows, dtype=cls.RESI_DTYPE)
+        system.segments = numpy.array(segRows, dtype=cls.SEG_DTYPE)
+
+        return system
+
+    def to_pdbdata(self):
+        atomNums = self.atoms['num'].tolist()
+        atomNames = self.atom_names().tolist()
+        known = ~numpy.isnan(self.pos).any(axis=1)
+        posList = self.pos.tolist()
+        resNums = self.residues['num'].tolist()
+        resNames = self.res_names().tolist()
+        resStart = self.residues['start'].tolist()
+        resStop = self.res_stop().tolist()
+        segNames = self.seg_names().tolist()
+        segStart = self.segments['start'].tolist()
+        segStop = self.seg_stop().tolist()
+
+        pdbDataList = []
+        for segCnt, segName in enumerate(segNames):
+            segDataList = []
+            for resCnt in range(segStart[segCnt], segStop[segCnt]):
+                resAtom = []
+                for i in range(resStart[resCnt], resStop[resCnt]):
+                    if known[i]:
+                        x, y, z = posList[i]
+                    else:
+                        x = y = z = None
+                    resAtom.append([atomNums[i], atomNames[i], x, y, z])
+                segDataList.append([resNums[resCnt], resNames[resCnt],
+                                    resAtom])
+            pdbDataList.append([segName, segDataList])
+
+        return pdbDataList
+
+
+def _line_bounds(buf):
+    """Return the start and stop offsets of every line in a byte array."""
+    eol = numpy.flatnonzero(buf == 10)
+    starts = numpy.concatenate(([0], eol + 1))
+    stops = numpy.concatenate((eol, [len(buf)]))
+    if starts[-1] == len(buf):
+        starts = starts[:-1]
+        stops = stops[:-1]
+    if len(stops):
+        last = numpy.maximum(stops - 1, 0)
+        stops -= (buf[last] == 13) & (stops > starts)
+    return starts, stops
+
+
+def _fixed_chars(buf, starts, stops, col, width):
+    """Slice the same fixed-width column out of many lines at once.
+
+    Returns a (nline, width) byte matrix. Characters past the end of a
+    line read as blanks, so short lines do not pick up the next one.
+    """
+    idx = starts[:, None] + numpy.arange(col, col + width)
+    chars = buf.take(idx, mode='clip')
+    chars[idx >= stops[:, None]] = 32
+    return chars
+
+
+def _fixed_column(buf, starts, stops, col, width):
+    chars = _fixed_chars(buf, starts, stops, col, width)
+    return chars.view('S%d' % width).reshape(-1)
+
+
+def _fixed_number(column, dtype=numpy.float64):
+    """Convert a fixed-width numeric text column without per-item calls.
+
+    Plain decimals such as '%8.3f' or '%5d' fields are evaluated with
+    array arithmetic as integer mantissa over a power of ten, which rounds
+    exactly like float(). Anything else (exponents, overflow markers) is
+    left to NumPy's string conversion.
+    """
+    width = column.dtype.itemsize
+    chars = column.view(numpy.uint8).reshape(-1, width).T.astype(numpy.int16)
+    n = len(column)
+    mantissa = numpy.zeros(n, dtype=numpy.int64)
+    dotPlace = numpy.zeros(n, dtype=numpy.int64)
+    ndot = numpy.zeros(n, dtype=numpy.int64)
+    isNeg = numpy.zeros(n, dtype=bool)
+    hasDigit = numpy.zeros(n, dtype=bool)
+    plain = numpy.ones(n, dtype=bool)
+    for c in chars:
+        isDigit = (c >= 48) & (c <= 57)
+        isDot = c == 46
+        isMinus = c == 45
+        mantissa = numpy.where(isDigit, mantissa * 10 + c - 48, mantissa)
+        dotPlace += isDigit & (ndot > 0)
+        ndot += isDot
+        isNeg |= isMinus
+        hasDigit |= isDigit
+        plain &= (isDigit | isDot | isMinus | (c == 32) | (c == 43) |
+                  (c == 0))
+    plain &= hasDigit & (ndot <= 1)
+
+    if numpy.dtype(dtype).kind == 'f':
+        value = mantissa / 10.0 ** dotPlace
+    else:
+        value = mantissa
+        plain &= dotPlace == 0
+    value[isNeg] *= -1
+    value = value.astype(dtype)
+
+    if not plain.all():
+        other = ~plain
+        value[other] = column[other].astype(dtype)
+
+    return value
+
+
+HY36_DIGITS_UPPER = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+HY36_DIGITS_LOWER = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def hy36encode(width, value):
+    """Encode an integer as a hybrid-36 string of the given width.
+
+    Numbers that fit are written in decimal as usual. Past that, width
+    characters count on in base 36, first with upper case letters (A0000
+    follows 99999) and then with lower case ones.
+    """
+    if -10 ** (width - 1) < value < 10 ** width:
+        return '%*d' % (width, value)
+    if value < 0:
+        raise ValueError('%d does not fit in hybrid-36 width %d' %
+                         (value, width))
+    value -= 10 ** width
+    span = 26 * 36 ** (width - 1)
+    if value < span:
+        digits = HY36_DIGITS_UPPER
+    elif value < 2 * span:
+        digits = HY36_DIGITS_LOWER
+        value -= span
+    else:
+        raise ValueError('%d does not fit in hybrid-36 width %d' %
+                         (value + 10 ** width, width))
+    value += 10 * 36 ** (width - 1)
+    encoded = []
+    while value:
+        value, digit = divmod(value, 36)
+        encoded.append(digits[digit])
+    return ''.join(reversed(encoded))
+
+
+def _hy36_number(column, dtype=numpy.int32):
+    """Decode a fixed-width column of decimal or hybrid-36 integers."""
+    width = column.dtype.itemsize
+    chars = column.view(numpy.uint8).reshape(-1, width).astype(numpy.int64)
+    isUpper = (chars[:, 0] >= 65) & (chars[:, 0] <= 90)
+    isLower = (chars[:, 0] >= 97) & (chars[:, 0] <= 122)
+    isHy36 = isUpper | isLower
+    if not isHy36.any():
+        return _fixed_number(column, dtype)
+
+    value = numpy.empty(len(column), dtype=dtype)
+    value[~isHy36] = _fixed_number(column[~isHy36], dtype)
+
+    chars = chars[isHy36]
+    digits = numpy.where(chars <= 57, chars - 48,
+                         numpy.where(chars <= 90, chars - 55, chars - 87))
+    if ((digits < 0) | (digits > 35)).any():
+        raise ValueError('invalid hybrid-36 number')
+    number = numpy.zeros(len(chars), dtype=numpy.int64)
+    for digit in digits.T:
+        number = number * 36 + digit
+    number += numpy.where(isUpper[isHy36], -10 * 36 ** (width - 1),
+                          16 * 36 ** (width - 1)) + 10 ** width
+    value[isHy36] = number
+    return value
+
+
+def _native(s):
+    """Return an item of a NumPy bytes column as a native str."""
+    return s if isinstance(s, str) else s.decode('latin-1')
+
+
+def _intern_column(names, column):
+    """Strip and intern a fixed-width text column, returning name ids."""
+    uniq, inverse = numpy.unique(column, return_inverse=True)
+    ids = numpy.array([names.intern(_native(name).strip())
+                       for name in uniq.tolist()], dtype=numpy.int32)
+    return ids[inverse]
+
+
+def _parse_pdb_columns(buf, counts=None):
+    """Locate ATOM/HETATM records in a PDB byte array and slice columns.
+
+    Returns a dict of per-atom column arrays plus 'break', the number of
+    segment breaks (TER, END or a blank record name) seen before each
+    atom, and 'model', the number of MODEL records seen before it. When
+    reading block by block, pass the (break, model) counts so far as
+    counts; the running totals then come back under 'counts'.
+    """
+    starts, stops = _line_bounds(buf)
+    head = _fixed_column(buf, starts, stops, 0, 6)
+    isAtom = (head == b'ATOM  ') | (head == b'HETATM')
+    isBreak = ((head == b'      ') | (head == b'TER   ') |
+               (head == b'END   '))
+
+    breaks = numpy.cumsum(isBreak)
+    models = numpy.cumsum(head == b'MODEL ')
+    starts = starts[isAtom]
+    stops = stops[isAtom]
+    col = lambda c, w: _fixed_column(buf, starts, stops, c, w)
+
+    columns = {
+        'serial': col(6, 5),
+        'name': col(12, 4),
+        'resname': col(17, 4),
+        'chain': col(21, 1),
+        'resseq': col(22, 4),
+        'x': col(30, 8),
+        'y': col(38, 8),
+        'z': col(46, 8),
+        'segid': col(72, 4),
+        'break': breaks[isAtom],
+        'model': models[isAtom],
+        }
+    if counts is not None:
+        nbreak, nmodel = counts
+        columns['break'] += nbreak
+        columns['model'] += nmodel
+        if len(head):
+            nbreak += breaks[-1]
+            nmodel += models[-1]
+        columns['counts'] = (nbreak, nmodel)
+
+    return columns
+
+
+def _build_system(columns, epreInpDict=None):
+    """Turn parsed atom columns into a System.
+
+    Applies the ALIASATOM/ALIASRES rules, starts a new segment at every
+    break and a new residue whenever the residue number or name changes.
+    """
+    names = NameTable()
+    atomNums = _hy36_number(columns['serial'])
+    atomNames = _intern_column(names, columns['name'])
+    resNames = _intern_column(names, columns['resname'])
+    resNums = _hy36_number(columns['resseq'])
+    natom = len(atomNums)
+
+    if epreInpDict is not None:
+        rules = epreInpDict.get('RENAMERULE')
+        if rules is None:
+            rules = compile_rename_rules(epreInpDict)
+        if rules:
+            resNames, atomNames = rules.apply(names, resNames, atomNames)
+
+    segKey = columns['break']
+    newSeg = numpy.ones(natom, dtype=bool)
+    newSeg[1:] = segKey[1:] != segKey[:-1]
+    newRes = newSeg.copy()
+    newRes[1:] |= ((resNums[1:] != resNums[:-1]) |
+                   (resNames[1:] != resNames[:-1]))
+
+    resStart = numpy.flatnonzero(newRes)
+    resSeg = numpy.cumsum(newSeg)[resStart] - 1
+    segStart = numpy.flatnonzero(newSeg[resStart])
+    nseg = len(segStart)
+
+    inpSegList = epreInpDict['SEGMENT'] if epreInpDict is not None else []
+    if inpSegList and len(inpSegList) == nseg:
+        segNames = inpSegList
+    else:
+        print("Use default segment names: 'S1' for segment 1")
+        segNames = ['S%d' % (i + 1) for i in range(nseg)]
+
+    system = System(names=names)
+    system.atoms = numpy.empty(natom, dtype=System.ATOM_DTYPE)
+    system.atoms['num'] = atomNums
+    system.atoms['name'] = atomNames
+    system.atoms['res'] = numpy.cumsum(newRes) - 1
+    system.pos = numpy.empty((natom, 3), dtype=numpy.float64)
+    for i, axis in enumerate('xyz'):
+        system.pos[:, i] = _fixed_number(columns[axis])
+    system.residues = numpy.empty(len(resStart), dtype=System.RESI_DTYPE)
+    system.residues['num'] = resNums[resStart]
+    system.residues['name'] = resNames[resStart]
+    system.residues['seg'] = resSeg
+    system.residues['start'] = resStart
+    system.segments = numpy.empty(nseg, dtype=System.SEG_DTYPE)
+    system.segments['name'] = names.intern_all(segNames)
+    system.segments['start'] = segStart
+
+    return system
+
+
+def _read_pdb_blocks(pdbFile, size=1 << 24):
+    """Parse a PDB stream a block of whole lines at a time."""
+    parts = []
+    counts = (0, 0)
+    rest = b''
+    while True:
+        data = pdbFile.read(size)
+        block = rest + data
+        if data:
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+        if block:
+            columns = _parse_pdb_columns(numpy.frombuffer(block, numpy.uint8),
+                                         counts)
+            counts = columns.pop('counts')
+            parts.append(columns)
+        if not data:
+            break
+
+    if not parts:
+        return _parse_pdb_columns(numpy.zeros(0, dtype=numpy.uint8))
+    return dict((key, numpy.concatenate([part[key] for part in parts]))
+                for key in parts[0])
 
+
+def read_pdb_system(filename, epreInpDict=None):
     try:
-        pdbFile = open(filename)
+        pdbFile = ropen(filename, 'rb')
     except IOError:
         perr("Cannot open", filename)
+        raise
 
     print("Read PDB file", filename)
 
-    fmt = '6x 5s x 4s x 4s s 4s 4x 8s 8s 8s 13x 8s'
-    size = calcsize(fmt)
+    with pdbFile:
+        if is_compressed(filename):
+            columns = _read_pdb_blocks(pdbFile)
+        elif os.fstat(pdbFile.fileno()).st_size:
+            mm = mmap.mmap(pdbFile.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = numpy.frombuffer(mm, dtype=numpy.uint8)
+            columns = _parse_pdb_columns(buf)
+            del buf
+            mm.close()
+        else:
+            columns = _parse_pdb_columns(numpy.zeros(0, dtype=numpy.uint8))
+
+    nmodel = columns['model'].max() if len(columns['model']) else 0
+    if nmodel > 1:
+        print("Read model 1 of %d; use iter_pdb_models for the others" %
+              nmodel)
+        first = columns['model'] <= 1
+        columns = dict((key, column[first])
+                       for key, column in columns.items())
+
+    return _build_system(columns, epreInpDict)
+
 
+def _pdb_model_blocks(pdbFile):
+    """Yield (model number, text) for each MODEL block of a PDB stream.
+
+    A file without MODEL records is a single model numbered 1.
+    """
+    lines = []
+    modelNum = None
+    modelCnt = 0
     for line in pdbFile:
-        pdbHead = line[:6].rstrip()
-
-        if pdbHead in ['ATOM', 'HETATM']:
-            (pdbAtomNum, pdbAtomName, pdbResName,
-             pdbChainID, pdbResNum, pdbPosX, pdbPosY,
-             pdbPosZ, pdbSegName) = unpack(fmt, line[:size])
-
-            pdbAtomNum = int(pdbAtomNum)
-            pdbAtomName = pdbAtomName.strip()
-            pdbResName = pdbResName.strip()
-            pdbResNum = int(pdbResNum)
-            pdbPosX = float(pdbPosX)
-            pdbPosY = float(pdbPosY)
-            pdbPosZ = float(pdbPosZ)
-            pdbSegName = pdbSegName.strip()
-
-            if aliasAtomList:
-                for aliasAtom in aliasAtomList:
-                    if (aliasAtom[0][1] == pdbAtomName and
-                                aliasAtom[0][0] in [pdbResName, '']):
-                        pdbAtomName = aliasAtom[1]
-
-            newAtom = [pdbAtomNum, pdbAtomName, pdbPosX, pdbPosY, pdbPosZ]
-
-            if aliasResiList:
-                for aliasResi in aliasResiList:
-                    if pdbResName == aliasResi[0]:
-                        pdbResName = aliasResi[1]
-
-            if pdbResNum == lastResNum and pdbResName == lastResName:
-                newSegList[pdbResCnt - 1][2].append(newAtom)
-            else:
-                newRes = [pdbResNum, pdbResName, [newAtom]]
-                newSegList.append(newRes)
-                pdbResCnt += 1
+        head = line[:6]
+        if head == b'MODEL ':
+            modelCnt += 1
+            try:
+                modelNum = int(line[6:].split()[0])
+            except (IndexError, ValueError):
+                modelNum = modelCnt
+            lines = []
+        elif head == b'ENDMDL':
+            if modelNum is not None:
+                yield modelNum, b''.join(lines)
+            modelNum = None
+            lines = []
+        elif modelNum is not None or not modelCnt:
+            lines.append(line)
+
+    if not modelCnt:
+        yield 1, b''.join(lines)
+    elif modelNum is not None:
+        yield modelNum, b''.join(lines)
+
+
+def iter_pdb_models(filename, epreInpDict=None):
+    """Yield (model number, pdbDataList) for every model in a PDB file.
+
+    Models are read one at a time as the iterator advances, so only one
+    is ever held in memory.
+    """
+    try:
+        pdbFile = ropen(filename, 'rb')
+    except IOError:
+        perr("Cannot open", filename)
+        raise
 
-            lastResNum = pdbResNum
-            lastResName = pdbResName
+    print("Read PDB models from", filename)
 
-        elif not pdbHead or pdbHead in ['TER', 'END']:
-            if newSegList:
-                pdbDataList.append([None, newSegList])
-            newSegList = []
-            pdbResCnt = 0
-            lastResNum = 0
-            lastResName = None
+    with pdbFile:
+        for modelNum, text in _pdb_model_blocks(pdbFile):
+            buf = numpy.frombuffer(text, dtype=numpy.uint8) if text else \
+                  numpy.zeros(0, dtype=numpy.uint8)
+            system = _build_system(_parse_pdb_columns(buf), epreInpDict)
+            yield modelNum, system.to_pdbdata()
 
-    if newSegList:
-        pdbDataList.append([None, newSegList])
 
-    inpSegList = epreInpDict['SEGMENT'] if epreInpDict is not None else []
-    inpSegNum = len(inpSegList)
-    pdbSegNum = len(pdbDataList)
+def build_models(filename, ctopDataList, epreInpDict, cprmDataList):
+    """Run build_struct on each model of a multi-model PDB file in turn.
+
+    The topology and parameters are parsed once by the caller and shared
+    by all models. Yields (model number, pdbDataList, topList):
+
+        top = read_charmm_top('top_all22_prot.inp', epreInpDict)
+        prm = read_charmm_prm('par_all27_prot_lipid.prm')
+        for num, mod, topList in build_models('nmr.pdb', top[1:],
+                                              epreInpDict, prm):
+            write_psf(model_filename('nmr.psf', num), topList, epreInpDict)
+
+    build_system does this, solvation and all, when ALLMODELS is set.
+    """
+    for modelNum, pdbDataList in iter_pdb_models(filename, epreInpDict):
+        print("Build model", modelNum)
+        pdbDataList, topList = build_struct(ctopDataList, pdbDataList,
+                                            epreInpDict, cprmDataList)
+        yield modelNum, pdbDataList, topList
+
+
+def model_filename(filename, modelNum):
+    """Return filename with the model number before its extensions.
 
-    if inpSegList and inpSegNum == pdbSegNum:
-        for i, seg in enumerate(pdbDataList):
-            seg[0] = inpSegList[i]
+    out.psf becomes out_3.psf, and out.pdb.gz becomes out_3.pdb.gz.
+    """
+    base, ext = split_ext(filename)
+    return '%s_%d%s' % (base, modelNum, ext)
+
+
+def read_pdb(filename, epreInpDict=None):
+    pdbDataList = read_pdb_system(filename, epreInpDict).to_pdbdata()
+
+    global _debug
+    if _debug:
+        print(pdbDataList)
+
+    return pdbDataList
+
+
+CIF_TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+
+def _cif_split(line):
+    if "'" not in line and '"' not in line:
+        return line.split()
+    return [''.join(token) for token in CIF_TOKEN.findall(line)]
+
+
+def _parse_cif_columns(cifFile):
+    """Read the _atom_site loop of an mmCIF file into atom columns.
+
+    Returns the same dict as _parse_pdb_columns. Author atom, residue and
+    chain labels are preferred over the label_* ones, and a new break is
+    counted whenever the chain or model changes.
+    """
+    keys = []
+    tokens = []
+    blocks = []
+    for line in cifFile:
+        if not blocks and not tokens and line.startswith('_atom_site.'):
+            keys.append(line.split()[0][len('_atom_site.'):])
+            continue
+        if not keys:
+            continue
+        if line.startswith(('_', '#', 'loop_', 'data_', ';')):
+            break
+        tokens.extend(_cif_split(line))
+        if len(tokens) >= PDB_BLOCK_SIZE * len(keys):
+            nrow = len(tokens) // len(keys)
+            blocks.append(numpy.array(tokens[:nrow * len(keys)], dtype='S'))
+            del tokens[:nrow * len(keys)]
+    if len(tokens) % max(len(keys), 1):
+        raise ValueError('incomplete row in _atom_site loop')
+    blocks.append(numpy.array(tokens, dtype='S'))
+
+    rows = [block.reshape(-1, len(keys)) for block in blocks]
+    def col(*names):
+        for name in names:
+            if name in keys:
+                i = keys.index(name)
+                return numpy.concatenate([row[:, i] for row in rows])
+        raise ValueError('mmCIF file lacks _atom_site.%s' % names[0])
+
+    chain = col('auth_asym_id', 'label_asym_id')
+    if 'pdbx_PDB_model_num' in keys:
+        model = col('pdbx_PDB_model_num')
     else:
-        print("Use default segment names: 'S1' for segment 1")
-        for i, seg in enumerate(pdbDataList):
-            seg[0] = 'S%d' % (i + 1)
+        model = numpy.zeros(len(chain), dtype='S1')
+    isBreak = numpy.zeros(len(chain), dtype=numpy.int64)
+    isBreak[1:] = (chain[1:] != chain[:-1]) | (model[1:] != model[:-1])
+
+    return {
+        'serial': col('id'),
+        'name': col('auth_atom_id', 'label_atom_id'),
+        'resname': col('auth_comp_id', 'label_comp_id'),
+        'chain': chain,
+        'resseq': col('auth_seq_id', 'label_seq_id'),
+        'x': col('Cartn_x'),
+        'y': col('Cartn_y'),
+        'z': col('Cartn_z'),
+        'break': numpy.cumsum(isBreak),
+        'model': model,
+        }
 
-    pdbFile.close()
+
+def read_cif_system(filename, epreInpDict=None):
+    try:
+        cifFile = ropen(filename)
+    except IOError:
+        perr("Cannot open", filename)
+        raise
+
+    print("Read mmCIF file", filename)
+
+    with cifFile:
+        columns = _parse_cif_columns(cifFile)
+
+    models = numpy.unique(columns['model'])
+    if len(models) > 1:
+        print("Read model 1 of %d" % len(models))
+        first = columns['model'] == columns['model'][0]
+        columns = dict((key, column[first])
+                       for key, column in columns.items())
+
+    return _build_system(columns, epreInpDict)
+
+
+def read_cif(filename, epreInpDict=None):
+    pdbDataList = read_cif_system(filename, epreInpDict).to_pdbdata()
 
     global _debug
     if _debug:
@@ -244,10 +889,26 @@ def read_pdb(filename, epreInpDict=None):
     return pdbDataList
 
 
-def write_pdb(filename, pdbDataList, boxInfo=None):
-    pdbFile = wopen(filename)
+def is_cif(filename):
+    if is_compressed(filename):
+        filename = os.path.splitext(filename)[0]
+    return os.path.splitext(filename)[1].lower() in ('.cif', '.mmcif')
 
-    print("Write PDB file", filename)
+
+PDB_BLOCK_SIZE = 65536
+
+
+def write_pdb_stream(pdbFile, pdbDataList, boxInfo=None):
+    """Write PDB records to an open file or in-memory buffer.
+
+    pdbDataList may be a System or the nested list form. Atom records are
+    formatted in blocks of PDB_BLOCK_SIZE lines, each with a single
+    string-formatting call, and each block goes out in one write.
+    """
+    if isinstance(pdbDataList, System):
+        system = pdbDataList
+    else:
+        system = System.from_pdbdata(pdbDataList)
 
     date = time.strftime("%d-%b-%y", time.localtime()).upper()
     pdbFile.write('HEADER    %-40s%-30s\n' % ('GENERATED BY MDBuilder 1.0', date))
@@ -258,549 +919,1405 @@ def write_pdb(filename, pdbDataList, boxInfo=None):
         pdbFile.write('%6s%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s%4d%10s\n' %
                       ('CRYST1', a, b, c, 90.0, 90.0, 90.0, 'P 1', 1, ' '))
 
-    fmt = '%-6s%5d %-4s %-4s%1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f      %-4s%2s  \n'
-
-    atomCnt = 0
-    for segName, segDataList in pdbDataList:
-        chainID = segName[0]
-
-        for resNum, resName, resAtom in segDataList:
-
-            for atomNum, atomName, atomPosX, atomPosY, atomPosZ in resAtom:
-                atomCnt += 1
-                atomNum = atomCnt
-                pdbFile.write(fmt % ('ATOM', atomNum, atomName.ljust(3).rjust(4),
-                                     resName, chainID, resNum, atomPosX, atomPosY,
-                                     atomPosZ, 1.0, 0.0, segName, atomName[0]))
+    names = system.names.names
+    atomNames = numpy.array([name.ljust(3).rjust(4) for name in names],
+                            dtype=object)
+    elements = numpy.array([name[:1] for name in names], dtype=object)
+    segNames = system.seg_names()
+    resSeg = system.residues['seg']
+    resNames = system.res_names()
+    resNums = system.residues['num'].tolist()
+    resFields = numpy.array(
+        ['%-4s%1s%4s' % (resName, segNames[seg][0], hy36encode(4, resNum))
+         for resName, seg, resNum in zip(resNames, resSeg, resNums)],
+        dtype=object)
+
+    fmt = ('ATOM  %5s %-4s %s    %8.3f%8.3f%8.3f  1.00  0.00      '
+           '%-4s%2s  \n')
+    natom = system.natom
+    for start in range(0, natom, PDB_BLOCK_SIZE):
+        stop = min(start + PDB_BLOCK_SIZE, natom)
+        atoms = system.atoms[start:stop]
+        resIds = atoms['res']
+        if stop < 100000:
+            serials = range(start + 1, stop + 1)
+        else:
+            serials = [hy36encode(5, i) for i in range(start + 1, stop + 1)]
+        rows = zip(serials,
+                   atomNames[atoms['name']].tolist(),
+                   resFields[resIds].tolist(),
+                   system.pos[start:stop, 0].tolist(),
+                   system.pos[start:stop, 1].tolist(),
+                   system.pos[start:stop, 2].tolist(),
+                   segNames[resSeg[resIds]].tolist(),
+                   elements[atoms['name']].tolist())
+        pdbFile.write(fmt * (stop - start) %
+                      tuple(chain.from_iterable(rows)))
 
     nxform = 0 if boxInfo is None else 1
-    natom = atomCnt
     pdbFile.write('%6s%4s%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%10s\n' %
                   ('MASTER', ' ', 0, 0, 0, 0, 0, 0, 0, nxform, natom, 0, 0, 0, ' '))
     pdbFile.write('%-80s\n' % 'END')
 
-    pdbFile.close()
 
+def write_pdb(filename, pdbDataList, boxInfo=None):
+    pdbFile = wopen(filename)
 
-def write_tmppdb(filename, pdbDataList, boxInfo=None):
-    if hasattr(filename, 'seek'):      # file object
-        if hasattr(filename, 'name'):
-            fname = os.path.basename(filename.name)
-        else:
-            fname = ''
-    if fname:
-        print("ERROR")
-    else:
-        print("Write PDB file from string")
+    print("Write PDB file", filename)
 
-    date = time.strftime("%d-%b-%y", time.localtime()).upper()
-    filename.write('HEADER    %-40s%-30s\n' % ('GENERATED BY MDBuilder 1.0', date))
-    filename.write('AUTHOR    %-70s\n' % getuser().upper())
+    write_pdb_stream(pdbFile, pdbDataList, boxInfo)
 
-    if boxInfo is not None:
-        a, b, c = boxInfo[2]
-        filename.write('%6s%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s%4d%10s\n' %
-                      ('CRYST1', a, b, c, 90.0, 90.0, 90.0, 'P 1', 1, ' '))
+    pdbFile.close()
 
-    fmt = '%-6s%5d %-4s %-4s%1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f      %-4s%2s  \n'
 
-    atomCnt = 0
-    for segName, segDataList in pdbDataList:
-        chainID = segName[0]
+def write_tmppdb(pdbFile, pdbDataList, boxInfo=None):
+    print("Write PDB file from string")
 
-        for resNum, resName, resAtom in segDataList:
+    write_pdb_stream(pdbFile, pdbDataList, boxInfo)
 
-            for atomNum, atomName, atomPosX, atomPosY, atomPosZ in resAtom:
-                atomCnt += 1
-                atomNum = atomCnt
-                filename.write(fmt % ('ATOM', atomNum, atomName.ljust(3).rjust(4),
-                                     resName, chainID, resNum, atomPosX, atomPosY,
-                                     atomPosZ, 1.0, 0.0, segName, atomName[0]))
 
-    nxform = 0 if boxInfo is None else 1
-    natom = atomCnt
-    filename.write('%6s%4s%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%5d%10s\n' %
-                  ('MASTER', ' ', 0, 0, 0, 0, 0, 0, 0, nxform, natom, 0, 0, 0, ' '))
-    filename.write('%-80s\n' % 'END')
+def _cif_quote(value):
+    if not value:
+        return '.'
+    if "'" in value:
+        return '"%s"' % value
+    if '"' in value or value[0] in '_#$;[]' or ' ' in value:
+        return "'%s'" % value
+    return value
+
 
+def write_cif_stream(cifFile, pdbDataList, boxInfo=None):
+    """Write an mmCIF _atom_site table, the large-system sibling of PDB.
 
-def download_pdb(filename):
-    """Download a structure file from RCSB Protein Date Bank."""
+    Serial and residue numbers are free-width, so nothing overflows no
+    matter how many atoms there are. Atoms go out in blocks just as in
+    write_pdb_stream.
+    """
+    if isinstance(pdbDataList, System):
+        system = pdbDataList
+    else:
+        system = System.from_pdbdata(pdbDataList)
+
+    cifFile.write('data_MDBuilder\n#\n')
+    cifFile.write('_audit_conform.dict_name mmcif_pdbx.dic\n')
+    cifFile.write('_software.name MDBuilder\n')
+    cifFile.write('_software.version %s\n#\n' % __version__)
+
+    if boxInfo is not None:
+        a, b, c = boxInfo[2]
+        cifFile.write('_cell.length_a %.3f\n_cell.length_b %.3f\n'
+                      '_cell.length_c %.3f\n' % (a, b, c))
+        cifFile.write('_cell.angle_alpha 90.00\n_cell.angle_beta 90.00\n'
+                      '_cell.angle_gamma 90.00\n')
+        cifFile.write("_symmetry.space_group_name_H-M 'P 1'\n#\n")
+
+    cifFile.write('loop_\n')
+    for key in ('group_PDB', 'id', 'type_symbol', 'label_atom_id',
+                'label_comp_id', 'label_asym_id', 'label_seq_id', 'Cartn_x',
+                'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv',
+                'auth_seq_id', 'auth_comp_id', 'auth_asym_id',
+                'auth_atom_id', 'pdbx_PDB_model_num'):
+        cifFile.write('_atom_site.%s\n' % key)
+
+    names = system.names.names
+    atomNames = numpy.array([_cif_quote(name) for name in names],
+                            dtype=object)
+    elements = numpy.array([_cif_quote(name[:1]) for name in names],
+                           dtype=object)
+    segNames = [_cif_quote(name) for name in system.seg_names()]
+    resSeg = system.residues['seg'].tolist()
+    resNames = [_cif_quote(name) for name in system.res_names()]
+    resNums = system.residues['num'].tolist()
+    resFields = numpy.array(
+        ['%s %s %d' % (resName, segNames[seg], resNum)
+         for resName, seg, resNum in zip(resNames, resSeg, resNums)],
+        dtype=object)
+    authFields = numpy.array(
+        ['%d %s %s' % (resNum, resName, segNames[seg])
+         for resName, seg, resNum in zip(resNames, resSeg, resNums)],
+        dtype=object)
+
+    fmt = 'ATOM %d %s %s %s %.3f %.3f %.3f 1.00 0.00 %s %s 1\n'
+    natom = system.natom
+    for start in range(0, natom, PDB_BLOCK_SIZE):
+        stop = min(start + PDB_BLOCK_SIZE, natom)
+        atoms = system.atoms[start:stop]
+        resIds = atoms['res']
+        nameIds = atoms['name']
+        rows = zip(range(start + 1, stop + 1),
+                   elements[nameIds].tolist(),
+                   atomNames[nameIds].tolist(),
+                   resFields[resIds].tolist(),
+                   system.pos[start:stop, 0].tolist(),
+                   system.pos[start:stop, 1].tolist(),
+                   system.pos[start:stop, 2].tolist(),
+                   authFields[resIds].tolist(),
+                   atomNames[nameIds].tolist())
+        cifFile.write(fmt * (stop - start) %
+                      tuple(chain.from_iterable(rows)))
+
+    cifFile.write('#\n')
+
+
+def write_cif(filename, pdbDataList, boxInfo=None):
+    cifFile = wopen(filename)
+
+    print("Write mmCIF file", filename)
+
+    write_cif_stream(cifFile, pdbDataList, boxInfo)
+
+    cifFile.close()
+
+
+PDB_URL = 'https://files.rcsb.org/download/'
+PDB_CACHE_SIZE = 1024
+
+
+def cache_dir(*names):
+    """Return a directory under the MDBuilder cache, creating it if needed.
+
+    The cache lives in ~/.mdbuilder unless MDBUILDER_CACHE says otherwise.
+    """
+    root = (os.environ.get('MDBUILDER_CACHE') or
+            os.path.join(os.path.expanduser('~'), '.mdbuilder'))
+    path = os.path.join(root, *names)
     try:
-        from urllib2 import urlopen
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+class PDBCache(object):
+    """Content-addressed store for downloaded structure files.
+
+    Every file is kept once under its SHA-256 digest and checked against
+    it when read back; index.json maps keys such as '1ABC.pdb' to digests
+    and records when each key was last used. Once the files take more
+    than maxSize megabytes, the least recently used keys are dropped.
+    """
+
+    def __init__(self, path=None, maxSize=PDB_CACHE_SIZE):
+        self.path = path or cache_dir('pdb')
+        self.maxSize = maxSize
+        self.indexFile = os.path.join(self.path, 'index.json')
+        try:
+            with open(self.indexFile) as indexFile:
+                self.index = json.load(indexFile)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def _object(self, digest):
+        return os.path.join(self.path, digest)
+
+    def _save(self):
+        tmpFile = '%s.%d' % (self.indexFile, os.getpid())
+        with open(tmpFile, 'w') as indexFile:
+            json.dump(self.index, indexFile)
+        os.rename(tmpFile, self.indexFile)
+
+    def get(self, key):
+        if key not in self.index:
+            return None
+        digest = self.index[key][0]
+        try:
+            with open(self._object(digest), 'rb') as objFile:
+                data = objFile.read()
+        except IOError:
+            data = None
+        if data is None or hashlib.sha256(data).hexdigest() != digest:
+            print("Drop damaged cache entry", key)
+            del self.index[key]
+            self._save()
+            try:
+                os.remove(self._object(digest))
+            except OSError:
+                pass
+            return None
+        self.index[key][2] = time.time()
+        self._save()
+        return data
+
+    def put(self, key, data):
+        digest = hashlib.sha256(data).hexdigest()
+        objPath = self._object(digest)
+        if not os.path.isfile(objPath):
+            tmpFile = '%s.%d' % (objPath, os.getpid())
+            with open(tmpFile, 'wb') as objFile:
+                objFile.write(data)
+            os.rename(tmpFile, objPath)
+        self.index[key] = [digest, len(data), time.time()]
+        self.evict()
+        self._save()
+
+    def evict(self):
+        sizes = dict((digest, size) for digest, size, _ in self.index.values())
+        total = sum(sizes.values())
+        for key in sorted(self.index, key=lambda k: self.index[k][2]):
+            if total <= self.maxSize * 1024 * 1024:
+                break
+            digest = self.index.pop(key)[0]
+            if all(entry[0] != digest for entry in self.index.values()):
+                total -= sizes[digest]
+                try:
+                    os.remove(self._object(digest))
+                except OSError:
+                    pass
+
+
+def _find_in_mirror(mirrorDir, pdbCode, fmt):
+    """Look for an entry in a local copy of the PDB archive."""
+    code = pdbCode.lower()
+    ext = 'ent' if fmt == 'pdb' else fmt
+    prefix = 'pdb' if fmt == 'pdb' else ''
+    names = ['%s.%s' % (pdbCode, fmt), '%s.%s' % (code, fmt),
+             '%s%s.%s' % (prefix, code, ext)]
+    dirs = [mirrorDir, os.path.join(mirrorDir, code[1:3])]
+    for dirName, name, comp in product(dirs, names, ('',) + COMPRESSED_EXTS):
+        path = os.path.join(dirName, name + comp)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def download_pdb(filename, offline=None, mirrorDir=None, baseUrl=None,
+                 cacheDir=None, cacheSize=None):
+    """Download a structure file from RCSB Protein Date Bank.
+
+    Files are served from the local cache when possible, then from the
+    mirror directory (MDBUILDER_PDB_MIRROR), and only then fetched from
+    baseUrl (MDBUILDER_PDB_URL, the RCSB download service by default).
+    Only downloaded files are added to the cache; a cache hit just marks
+    the entry as used. In offline mode (MDBUILDER_OFFLINE=1) the network
+    is never used. The file is written to the current directory as
+    <ID>.pdb or <ID>.cif.
+    """
+    try:
+        from urllib2 import urlopen, URLError
     except ImportError:
         from urllib.request import urlopen
         from urllib.error import URLError
 
+    env = os.environ.get
+    if offline is None:
+        offline = env('MDBUILDER_OFFLINE', '0') not in ('', '0')
+    if mirrorDir is None:
+        mirrorDir = env('MDBUILDER_PDB_MIRROR')
+    if baseUrl is None:
+        baseUrl = env('MDBUILDER_PDB_URL', PDB_URL)
+    if cacheSize is None:
+        cacheSize = float(env('MDBUILDER_PDB_CACHE_SIZE', PDB_CACHE_SIZE))
+
     filename = filename.upper()
-    if filename.endswith('.PDB'):
-        pdbCode = filename[:-4]
-    else:
-        pdbCode = filename
+    pdbCode, fmt = os.path.splitext(filename)
+    fmt = fmt[1:].lower() or 'pdb'
+    if fmt not in ('pdb', 'cif'):
+        raise ValueError("Only pdb and cif files can be downloaded")
     if len(pdbCode) != 4:
         raise ValueError("PDB ID should be a 4-character string")
-    pdbFile = pdbCode + '.pdb'
+    pdbFile = '%s.%s' % (pdbCode, fmt)
+
+    cache = PDBCache(cacheDir, cacheSize)
+    data = cache.get(pdbFile)
+    if data is not None:
+        print("Take", pdbFile, "from cache", cache.path)
+    elif mirrorDir:
+        path = _find_in_mirror(mirrorDir, pdbCode, fmt)
+        if path is not None:
+            print("Copy", pdbFile, "from mirror", path)
+            with ropen(path, 'rb') as mirrorFile:
+                data = mirrorFile.read()
+
+    if data is None:
+        if offline:
+            raise PDBDownloadError('%s is neither cached nor mirrored' %
+                                   pdbFile)
+        print("Download", pdbFile, "from Protein Data Bank")
+        sys.stdout.flush()
+        try:
+            data = urlopen(baseUrl.rstrip('/') + '/' + pdbFile).read()
+        except (URLError, IOError):
+            #perr("Cannot download the file")
+            print("Cannot download the file")
+            raise PDBDownloadError('Download is failed')
+        if len(data) < 1024:
+            #perr("Invalid pdb code", pdbCode)
+            raise PDBDownloadError('Download is failed')
+        print('Download is successfully completed')
+        cache.put(pdbFile, data)
+
+    outFile = wopen(pdbFile, 'wb')
+    outFile.write(data)
+    outFile.close()
+
+    return pdbFile
+
+
+def charmm_records(lines):
+    """Turn CHARMM input lines into upper-case token lists, one per record.
+
+    Text after '!' is dropped, a line ending in a lone '-' continues on the
+    next one, and blank lines are skipped. Works on any iterable of lines,
+    so files are read as they are walked.
+    """
+    pending = []
+    for line in lines:
+        tokens = line.split('!', 1)[0].upper().split()
+        if pending:
+            tokens = pending + tokens
+            pending = []
+        if tokens and tokens[-1] == '-':
+            pending = tokens[:-1]
+        elif tokens:
+            yield tokens
+    if pending:
+        yield pending
 
-    print("Download", pdbFile, "from Protein Data Bank")
-    sys.stdout.flush()
 
-    try:
-        pdb = urlopen('http://www.rcsb.org/pdb/download/downloadFile.do?' +
-                      'fileFormat=pdb&compression=NO&structureId=' + pdbCode)
-    except URLError:
-        #perr("Cannot download the file")
-        print("Cannot download the file")
+def read_charmm_top_title(ctopLines):
+    """Read the '*' title block and the version line of a topology file.
 
-    wopen(pdbFile, 'wb').write(pdb.read())
+    ctopLines is an iterator of lines; it is left just after the title
+    block. Returns the titles followed by the version string, and a list
+    of the lines read past the block that still have to be parsed.
+    """
+    ctopTitleList = []
+    ctopVer = '0 0'
+    lastLine = ''
 
-    if os.path.getsize(pdbFile) < 1024:
-        #perr("Invalid pdb code", pdbCode)
-        raise PDBDownloadError('Download is failed')
-    print('Download is successfully completed')
+    for line in ctopLines:
+        if line.startswith('*'):
+            ctopTitleList.append(line.rstrip('\r\n'))
+        elif not line.strip():
+            pass
+        elif (lastLine.startswith('*') and
+              line.split()[0][:4].upper() not in CHARMM_TOP_KEYS):
+            ctopVer = ' '.join(line.split())
+            return ctopTitleList + [ctopVer], []
+        else:
+            return ctopTitleList + [ctopVer], [line]
+        lastLine = line
+
+    return ctopTitleList + [ctopVer], []
+
+
+class CharmmTopReader(object):
+    """Single-pass reader for CHARMM topology records.
+
+    Records from charmm_records are dispatched on their keyword to the
+    do_* methods, which fill the mass, DEFA, RESI and PRES tables in the
+    same layout the rest of the program uses. RESI and PRES entries may
+    come in any order.
+    """
+
+    def __init__(self, noCmap=False):
+        self.noCmap = noCmap
+        self.lines = None
+        self.massDict = {}
+        self.defaDict = {}
+        self.resiDict = {}
+        self.presDict = {}
+        self.resi = None
+        self.pres = None
+        self.handlers = {
+            'MASS': self.do_mass,
+            'DEFA': self.do_defa,
+            'RESI': self.do_resi,
+            'PRES': self.do_pres,
+            'ATOM': self.do_atom,
+            'DELE': self.do_dele,
+            'BOND': self.do_bond,
+            'DOUB': self.do_bond,
+            'TRIP': self.do_bond,
+            'AROM': self.do_bond,
+            'IMPR': self.do_impr,
+            'CMAP': self.do_cmap,
+            'IC': self.do_ic,
+            'PATC': self.do_patc,
+            }
+
+    def feed(self, records):
+        """Handle records until END or until they run out."""
+        handlers = self.handlers
+        for tokens in records:
+            key = tokens[0]
+            if key == 'END':
+                break
+            key = 'IC' if key[:2] == 'IC' else key[:4]
+            if key in handlers:
+                handlers[key](tokens)
+
+    def do_mass(self, tokens):
+        self.massDict[tokens[2]] = float(tokens[3])
+
+    def do_defa(self, tokens):
+        for i in range(1, len(tokens) - 1, 2):
+            ctopPatch = tokens[i][:4]
+            if ctopPatch in ['FIRS', 'LAST']:
+                self.defaDict[ctopPatch] = tokens[i + 1]
+            else:
+                perr("Unknown argument", ctopPatch)
+
+    def do_resi(self, tokens):
+        self.pres = None
+        self.resi = [OrderedDict(), [], [], [], [], {
+            'FIRS': self.defaDict.get('FIRS', 'NONE'),
+            'LAST': self.defaDict.get('LAST', 'NONE'),
+            }]
+        self.resiDict[tokens[1]] = self.resi
+
+    def do_pres(self, tokens):
+        self.resi = None
+        self.pres = [[], OrderedDict(), [], [], [], []]
+        self.presDict[tokens[1]] = self.pres
+
+    def entry(self, resiField, presField):
+        if self.resi is not None:
+            return self.resi[resiField]
+        if self.pres is not None:
+            return self.pres[presField]
+        return None
+
+    def do_atom(self, tokens):
+        atomDict = self.entry(0, 1)
+        if atomDict is not None:
+            atomDict[tokens[1]] = [tokens[2], float(tokens[3])]
+
+    def do_dele(self, tokens):
+        if self.pres is not None and tokens[1] == 'ATOM':
+            self.pres[0].append(tokens[2])
+
+    def do_bond(self, tokens):
+        bondList = self.entry(1, 2)
+        if bondList is not None:
+            for i in range(1, len(tokens) - 1, 2):
+                bondList.append(tokens[i:i + 2])
+
+    def do_impr(self, tokens):
+        imprList = self.entry(2, 3)
+        if imprList is not None:
+            for i in range(1, len(tokens) - 3, 4):
+                imprList.append(tokens[i:i + 4])
+
+    def do_cmap(self, tokens):
+        cmapList = self.entry(3, 4)
+        if cmapList is None or self.noCmap:
+            return
+        if len(tokens) != 9:
+            perr("CMAP needs 8 atoms%s:" % line_note(self.lines),
+                 ' '.join(tokens))
+            return
+        cmapList.append(tokens[1:9])
 
+    def do_ic(self, tokens):
+        icList = self.entry(4, 5)
+        if icList is not None:
+            ic = tokens[1:]
+            ic[4] = float(ic[4])
+            ic[5] = radians(float(ic[5]))
+            ic[6] = radians(float(ic[6]))
+            ic[7] = radians(float(ic[7]))
+            ic[8] = float(ic[8])
+            icList.append(ic)
 
-def read_charmm_top_title(ctopLines):
-    ctopTitleList = []
+    def do_patc(self, tokens):
+        if self.resi is None:
+            return
+        ctopResiPatchDict = self.resi[5]
+        if len(tokens) not in (3, 5):
+            perr("Unknown patching format")
+            return
+        for i in range(1, len(tokens), 2):
+            ctopPatch = tokens[i][:4]
+            if ctopPatch in ctopResiPatchDict:
+                ctopResiPatchDict[ctopPatch] = tokens[i + 1]
+            else:
+                perr("Unknown argument", ctopPatch)
 
-    for i, line in enumerate(ctopLines):
-        ctopVer = '0 0'
 
-        if line[0] == '*':
-            ctopTitle = line
-            ctopTitleList.append(ctopTitle)
-        elif not line.strip():
-            continue
-        elif line[:4].strip().upper() in ['MASS', 'END']:
-            break
-        elif ctopLines[i - 1][0] == '*':
-            ctopVer = ' '.join(line.strip().split())
-            break
+CHARMM_TOP_KEYS = ('MASS', 'DECL', 'DEFA', 'AUTO', 'RESI', 'PRES', 'END')
 
-    ctopTitleList.append(ctopVer)
 
-    return ctopTitleList
+FF_CACHE_VERSION = 9
 
 
-def read_charmm_top_mass(ctopLines):
-    ctopAtomMassDict = {}
+def ff_cache_path(kind, filename, *options):
+    """Return the cache file for the parsed form of a force-field file.
 
-    for line in ctopLines:
+    The name hashes the file contents together with the parser kind,
+    FF_CACHE_VERSION and any options that change the result, so editing
+    the file or the parser simply misses the old entry. FF_CACHE_VERSION
+    must be bumped whenever a parser changes what it returns. Returns None
+    if caching is disabled (MDBUILDER_NOCACHE=1) or the file is unreadable.
+    """
+    if os.environ.get('MDBUILDER_NOCACHE', '0') not in ('', '0'):
+        return None
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as ffFile:
+            for block in iter(lambda: ffFile.read(1 << 20), b''):
+                digest.update(block)
+    except IOError:
+        return None
+    digest.update(repr((kind, FF_CACHE_VERSION, options)).encode('utf-8'))
+    return os.path.join(cache_dir('ff'), digest.hexdigest() + '.pkl')
 
-        if line.startswith('MASS'):
-            splitLine = line.split()
-            ctopAtomType = splitLine[2]
-            ctopAtomMass = float(splitLine[3])
-            ctopAtomMassDict[ctopAtomType] = ctopAtomMass
-        elif line.startswith(('DECL', 'RESI', 'PRES', 'END')):
-            break
 
-    return ctopAtomMassDict
+def ff_cache_load(cachePath):
+    if cachePath is None:
+        return None
+    try:
+        with open(cachePath, 'rb') as cacheFile:
+            return pickle.load(cacheFile)
+    except Exception:
+        return None
 
 
-def read_charmm_top_defa(ctopLines):
-    ctopDefaDict = {}
+def ff_cache_save(cachePath, data):
+    if cachePath is None:
+        return
+    tmpPath = '%s.%d' % (cachePath, os.getpid())
+    try:
+        with open(tmpPath, 'wb') as cacheFile:
+            pickle.dump(data, cacheFile, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, cachePath)
+    except (IOError, OSError, pickle.PicklingError) as err:
+        print(err)
+        print("Cannot write force-field cache", cachePath)
 
-    for line in ctopLines:
 
-        if line.startswith('DEFA'):
-            splitLine = line.split()
-            for i in range(1, len(splitLine), 2):
-                ctopPatch = splitLine[i][:4]
-                ctopPatchName = splitLine[i + 1]
-                if ctopPatch in ['FIRS', 'LAST']:
-                    ctopDefaDict[ctopPatch] = ctopPatchName
-                else:
-                    perr("Unknown argument", ctopPatch)
-        elif line.startswith(('RESI', 'PRES', 'END')):
-            break
+def print_charmm_top_title(ctopTitleList):
+    for ctopTitle in ctopTitleList[:-1]:
+        print(ctopTitle)
+    ctopVer = ctopTitleList[-1]
+    print('Developed under CHARMM version ' + ctopVer)
 
-    return ctopDefaDict
 
+def ff_file_list(filenames):
+    """Return the force-field files named by a TOPOLOGY/FORCEFIELD value.
+
+    The value is a list of file names, or one string with the names
+    separated by os.pathsep, as typed in the GUI entries. Files are merged
+    in this order, so later files override earlier ones.
+    """
+    if isinstance(filenames, (list, tuple)):
+        return list(filenames)
+    return [name for name in filenames.split(os.pathsep) if name.strip()]
+
+
+def is_charmm_stream(filename):
+    if is_compressed(filename):
+        filename = os.path.splitext(filename)[0]
+    return os.path.splitext(filename)[1].lower() == '.str'
+
+
+def charmm_stream_sections(lines, kind):
+    """Yield the line lists of the 'read <kind> card' sections of a stream.
+
+    kind is 'RTF' or 'PARA'. Each section runs from the line after the
+    read command up to its END line, which is left out. Everything else
+    in the stream (other CHARMM commands) is skipped.
+    """
+    section = None
+    for line in lines:
+        tokens = line.split('!', 1)[0].upper().split()
+        if section is None:
+            if (len(tokens) >= 3 and tokens[0][:4] == 'READ' and
+                    tokens[1][:4] == kind and tokens[2][:4] == 'CARD'):
+                section = []
+        elif tokens[:1] == ['END']:
+            yield section
+            section = None
+        else:
+            section.append(line)
+    if section:
+        yield section
 
-def read_charmm_top_resi(ctopLines, ctopDefaDict, noCmap):
-    ctopResiDataDict = {}
-    lastResiName = None
 
-    for line in ctopLines:
-        ctopHead = line[:4]
-
-        if ctopHead == 'RESI':
-            splitLine = line.split()
-            ctopResiName = splitLine[1]
-            lastResiName = ctopResiName
-            ctopResiDataDict[ctopResiName] = [OrderedDict(), [], [], [], [], {}]
-            ctopResiPatchDict = ctopResiDataDict[ctopResiName][5]
-            ctopResiPatchDict['FIRS'] = ctopDefaDict['FIRS']
-            ctopResiPatchDict['LAST'] = ctopDefaDict['LAST']
-        elif ctopHead == 'ATOM':
-            if lastResiName is None: continue
-            (ctopResiAtomName, ctopResiAtomType,
-             ctopResiAtomChrg) = line.split()[1:]
-            ctopResiAtomChrg = float(ctopResiAtomChrg)
-            ctopResiAtomDict = ctopResiDataDict[lastResiName][0]
-            ctopResiAtomDict[ctopResiAtomName] = [ctopResiAtomType,
-                                                  ctopResiAtomChrg]
-        elif ctopHead in ['BOND', 'DOUB', 'TRIP', 'AROM']:
-            if lastResiName is None: continue
-            splitLine = line.split()
-            ctopResiBondList = ctopResiDataDict[lastResiName][1]
-            for atomA in range(1, len(splitLine) - 1, 2):
-                atomB = atomA + 1
-                newBond = [splitLine[atomA], splitLine[atomB]]
-                ctopResiBondList.append(newBond)
-        elif ctopHead == 'IMPR':
-            if lastResiName is None: continue
-            splitLine = line.split()
-            for atomA in range(1, len(splitLine) - 3, 4):
-                atomB = atomA + 1
-                atomC = atomA + 2
-                atomD = atomA + 3
-                newImpr = [splitLine[atomA], splitLine[atomB],
-                           splitLine[atomC], splitLine[atomD]]
-                ctopResiImprList = ctopResiDataDict[lastResiName][2]
-                ctopResiImprList.append(newImpr)
-        elif ctopHead == 'CMAP':
-            if noCmap or not lastResiName: continue
-            splitLine = line.split()
-            ctopResiCmapList = ctopResiDataDict[lastResiName][3]
-            ctopResiCmapList.append(splitLine[1:9])
-        elif line[:2] == 'IC':
-            if lastResiName is None: continue
-            splitLine = line.split()
-            ic = splitLine[1:]
-            ic[4] = float(ic[4])
-            ic[5] = radians(float(ic[5]))
-            ic[6] = radians(float(ic[6]))
-            ic[7] = radians(float(ic[7]))
-            ic[8] = float(ic[8])
-            ctopResiICList = ctopResiDataDict[lastResiName][4]
-            ctopResiICList.append(ic)
-        elif ctopHead == 'PATC':
-            if lastResiName is None: continue
-            splitLine = line.split()
-            splitLineLen = len(splitLine)
-            ctopResiPatchDict = ctopResiDataDict[lastResiName][5]
-            if splitLineLen == 3:
-                firstPatch = splitLine[1][:4]
-                firstPres = splitLine[2]
-                if firstPatch in ctopResiPatchDict:
-                    ctopResiPatchDict[firstPatch] = firstPres
-                else:
-                    perr("Unknown argument", firstPatch)
-            elif splitLineLen == 5:
-                firstPatch = splitLine[1][:4]
-                firstPres = splitLine[2]
-                secondPatch = splitLine[3][:4]
-                secondPres = splitLine[4]
-                if firstPatch in ctopResiPatchDict:
-                    ctopResiPatchDict[firstPatch] = firstPres
-                else:
-                    perr("Unknown argument", firstPatch)
-                if secondPatch in ctopResiPatchDict:
-                    ctopResiPatchDict[secondPatch] = secondPres
-                else:
-                    perr("Unknown argument", secondPatch)
-            else:
-                perr("Unknown patching format")
-        elif ctopHead == 'PRES' or ctopHead.strip() == 'END':
-            break
+class _CountedLines(object):
+    """Lines of an iterable, with the number of the last one handed out in
+    num; numbering goes on from start."""
 
-    return ctopResiDataDict
+    def __init__(self, lines, start=0):
+        self.lines = iter(lines)
+        self.num = start
 
+    def __iter__(self):
+        return self
 
-def read_charmm_top_pres(ctopLines, ctopDefaDict, noCmap):
-    ctopPresDataDict = {}
-    lastPresName = None
+    def __next__(self):
+        line = next(self.lines)
+        self.num += 1
+        return line
 
-    for line in ctopLines:
-        ctopHead = line[:4]
-
-        if ctopHead == 'PRES':
-            splitLine = line.split()
-            ctopPresName = splitLine[1]
-            lastPresName = ctopPresName
-            ctopPresDataDict[ctopPresName] = [[], OrderedDict(), [], [], [], []]
-        elif ctopHead == 'DELE':
-            if lastPresName is None: continue
-            splitLine = line.split()
-            if splitLine[1] == 'ATOM':
-                ctopPresDelAtomName = splitLine[2]
-                ctopPresDelAtomList = ctopPresDataDict[lastPresName][0]
-                ctopPresDelAtomList.append(ctopPresDelAtomName)
-        elif ctopHead == 'ATOM':
-            if lastPresName is None: continue
-            (ctopPresAtomName, ctopPresAtomType,
-             ctopPresAtomChrg) = line.split()[1:]
-            ctopPresAtomChrg = float(ctopPresAtomChrg)
-            ctopPresAtomDict = ctopPresDataDict[lastPresName][1]
-            ctopPresAtomDict[ctopPresAtomName] = [ctopPresAtomType,
-                                                  ctopPresAtomChrg]
-        elif ctopHead in ['BOND', 'DOUB', 'TRIP', 'AROM']:
-            if lastPresName is None: continue
-            splitLine = line.split()
-            ctopPresBondList = ctopPresDataDict[lastPresName][2]
-            for atomA in range(1, len(splitLine) - 1, 2):
-                atomB = atomA + 1
-                newBond = [splitLine[atomA], splitLine[atomB]]
-                ctopPresBondList.append(newBond)
-        elif ctopHead == 'IMPR':
-            if lastPresName is None: continue
-            splitLine = line.split()
-            for atomA in range(1, len(splitLine) - 3, 4):
-                atomB = atomA + 1
-                atomC = atomA + 2
-                atomD = atomA + 3
-                newImpr = [splitLine[atomA], splitLine[atomB],
-                           splitLine[atomC], splitLine[atomD]]
-                ctopPresImprList = ctopPresDataDict[lastPresName][3]
-                ctopPresImprList.append(newImpr)
-        elif ctopHead == 'CMAP':
-            if noCmap or not lastPresName: continue
-            splitLine = line.split()
-            ctopPresCmapList = ctopPresDataDict[lastPresName][4]
-            ctopPresCmapList.append(splitLine[1:9])
-        elif line[:2] == 'IC':
-            if lastPresName is None: continue
-            splitLine = line.split()
-            ic = splitLine[1:]
-            ic[4] = float(ic[4])
-            ic[5] = radians(float(ic[5]))
-            ic[6] = radians(float(ic[6]))
-            ic[7] = radians(float(ic[7]))
-            ic[8] = float(ic[8])
-            ctopPresICList = ctopPresDataDict[lastPresName][5]
-            ctopPresICList.append(ic)
-        elif ctopHead.strip() == 'END':
-            break
+    next = __next__
 
-    return ctopPresDataDict
 
+def line_note(lines):
+    """Return ' (line n)' for the last line of a _CountedLines, or ''."""
+    return '' if lines is None else ' (line %d)' % lines.num
 
-def read_charmm_top(filename, epreInpDict):
-    noCmap = epreInpDict['NOCMAP']
 
-    try:
-        ctopFile = open(filename)
-    except IOError:
-        perr("Cannot open", filename)
+class _OffsetLines(object):
+    """Native str lines of a binary file, with the byte offset of the last
+    line handed out in offset and of the next one in end, and its number
+    in num."""
 
-    ctopLines = ctopFile.read()
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.offset = 0
+        self.end = 0
+        self.num = 0
 
-    print("Read CHARMM topology file", filename, end="\n\n")
+    def __iter__(self):
+        return self
 
-    ctopTitleLines = ctopLines.splitlines()
-    ctopTitleList = read_charmm_top_title(ctopTitleLines)
-    for ctopTitle in ctopTitleList[:-1]:
-        print(ctopTitle)
-    ctopVer = ctopTitleList[-1]
-    print('Developed under CHARMM version ' + ctopVer)
+    def __next__(self):
+        line = next(self.lines)
+        self.offset = self.end
+        self.end += len(line)
+        self.num += 1
+        return _native(line)
 
-    ctopLines = ctopLines.upper()
-
-    massStart = ctopLines.find('\nMASS')
-    declStart = ctopLines.find('\nDECL')
-    resiStart = ctopLines.find('\nRESI')
-    presStart = ctopLines.find('\nPRES')
-
-    if massStart != -1:
-        hasMass = True
-        if declStart != -1:
-            ctopMassLines = ctopLines[massStart:declStart]
-        elif resiStart != -1:
-            ctopMassLines = ctopLines[massStart:resiStart]
-        elif presStart != -1:
-            ctopMassLines = ctopLines[massStart:presStart]
-        else:
-            ctopMassLines = ctopLines[massStart:]
-        ctopMassLines = [line.split('!')[0] for line in ctopMassLines.
-            splitlines() if line]
-    else:
-        hasMass = False
-
-    if declStart != -1:
-        hasDecl = True
-        if resiStart != -1:
-            ctopDeclLines = ctopLines[declStart:resiStart]
-        elif presStart != -1:
-            ctopDeclLines = ctopLines[declStart:presStart]
-        else:
-            ctopDeclLines = ctopLines[declStart:]
-        ctopDeclLines = [line.split('!')[0] for line in ctopDeclLines.
-            splitlines() if line]
-    else:
-        hasDecl = False
+    next = __next__
 
-    if resiStart != -1:
-        hasResi = True
-        if presStart != -1:
-            ctopResiLines = ctopLines[resiStart:presStart]
+
+def index_charmm_top(ctopFile, isStream=False):
+    """Scan a topology file for its titles, masses and RESI/PRES blocks.
+
+    ctopFile is opened in binary mode. Only the title, MASS and DEFA
+    records are parsed; of the other lines just the first word is looked
+    at. Each RESI and PRES is recorded as (offset, size, firs, last,
+    line): the bytes its block takes in the file, the DEFA patches in
+    effect there and the number of its first line. For a stream file the 'read rtf card' sections are scanned.
+    Returns (titles, masses, RESI blocks, PRES blocks).
+    """
+    lines = _OffsetLines(ctopFile)
+    reader = CharmmTopReader()
+    blockDicts = {'RESI': {}, 'PRES': {}}
+    ctopTitleList = None
+
+    while True:
+        if isStream:
+            for line in lines:
+                tokens = line.split('!', 1)[0].upper().split()
+                if (len(tokens) >= 3 and tokens[0][:4] == 'READ' and
+                        tokens[1][:4] == 'RTF' and tokens[2][:4] == 'CARD'):
+                    break
+            else:
+                break
+
+        titleList, ctopLines = read_charmm_top_title(lines)
+        if ctopTitleList is None:
+            ctopTitleList = titleList
+        reader.defaDict = {}
+
+        block = None
+        isCont = False
+        for line in chain(ctopLines, lines):
+            tokens = line.split('!', 1)[0].upper().split()
+            if not tokens or isCont:
+                isCont = bool(tokens) and tokens[-1] == '-'
+                continue
+            isCont = tokens[-1] == '-'
+            key = tokens[0][:4]
+            if key in ('RESI', 'PRES', 'END') and block is not None:
+                blockDicts[block[0]][block[1]] = (
+                    block[2], lines.offset - block[2], block[3], block[4],
+                    block[5])
+                block = None
+            if key == 'END':
+                break
+            elif key in ('RESI', 'PRES'):
+                block = [key, tokens[1], lines.offset,
+                         reader.defaDict.get('FIRS', 'NONE'),
+                         reader.defaDict.get('LAST', 'NONE'), lines.num]
+            elif key == 'MASS':
+                reader.do_mass(tokens)
+            elif key == 'DEFA':
+                reader.do_defa(tokens)
         else:
-            ctopResiLines = ctopLines[resiStart:]
-        ctopResiLines = [line.split('!')[0] for line in ctopResiLines.
-            splitlines() if line]
-    else:
-        hasResi = False
+            if block is not None:
+                blockDicts[block[0]][block[1]] = (
+                    block[2], lines.end - block[2], block[3], block[4],
+                    block[5])
 
-    if presStart != -1:
-        hasPres = True
-        ctopPresLines = [line.split('!')[0] for line in ctopLines[resiStart:].
-            splitlines() if line]
-    else:
-        hasPres = False
+        if not isStream:
+            break
 
-    if hasMass:
-        print("\nLoad mass data")
-        ctopAtomMassDict = read_charmm_top_mass(ctopMassLines)
-    else:
-        ctopAtomMassDict = {}
+    if ctopTitleList is None:
+        ctopTitleList = ['0 0']
 
-    if hasDecl:
-        print("Load decl data")
-        ctopDefaDict = read_charmm_top_defa(ctopDeclLines)
-    else:
-        ctopDefaDict = {}
+    return (ctopTitleList, reader.massDict, blockDicts['RESI'],
+            blockDicts['PRES'])
 
-    if hasResi:
-        print("Load resi data")
-        ctopResiDataDict = read_charmm_top_resi(ctopResiLines,
-                                                ctopDefaDict, noCmap)
-    else:
-        ctopResiDataDict = {}
 
-    if hasPres:
-        print("Load pres data")
-        ctopPresDataDict = read_charmm_top_pres(ctopPresLines,
-                                                ctopDefaDict, noCmap)
+class CharmmTopSource(object):
+    """A topology file that RESI and PRES blocks are read from.
+
+    blocks is {'RESI': ..., 'PRES': ...} as found by index_charmm_top,
+    for the file as it was when stamp (see _file_stamp) was taken; if the
+    file has changed since, it is indexed again before a block is read.
+    A compressed file is decompressed once and kept, since seeking in it
+    means decompressing from the start.
+    """
+
+    def __init__(self, filename, isStream, stamp, resiBlocks, presBlocks):
+        self.filename = filename
+        self.isStream = isStream
+        self.stamp = stamp
+        self.blocks = {'RESI': resiBlocks, 'PRES': presBlocks}
+        self.data = None
+
+    def read(self, kind, name):
+        """Return the text of a block, its DEFA patches (firs, last) and
+        the number of its first line."""
+        try:
+            stamp = _file_stamp(self.filename)
+            if stamp != self.stamp:
+                print("Index CHARMM topology file", self.filename,
+                      "again, it has changed")
+                with ropen(self.filename, 'rb') as ctopFile:
+                    ctopIndex = index_charmm_top(ctopFile, self.isStream)
+                self.blocks = {'RESI': ctopIndex[2], 'PRES': ctopIndex[3]}
+                self.stamp = stamp
+                self.data = None
+            offset, size, firs, last, line = self.blocks[kind][name]
+            if is_compressed(self.filename):
+                if self.data is None:
+                    with ropen(self.filename, 'rb') as ctopFile:
+                        self.data = ctopFile.read()
+                data = self.data[offset:offset + size]
+            else:
+                with ropen(self.filename, 'rb') as ctopFile:
+                    ctopFile.seek(offset)
+                    data = ctopFile.read(size)
+        except (IOError, OSError):
+            perr("Cannot open", self.filename)
+            raise
+        return _native(data), firs, last, line
+
+
+def read_charmm_top_block(source, kind, name, noCmap=False):
+    """Parse one RESI or PRES block of a CharmmTopSource."""
+    data, firs, last, line = source.read(kind, name)
+
+    reader = CharmmTopReader(noCmap)
+    reader.defaDict = {'FIRS': firs, 'LAST': last}
+    reader.lines = _CountedLines(data.splitlines(), line - 1)
+    reader.feed(charmm_records(reader.lines))
+    if kind == 'RESI':
+        return reader.resiDict[name]
+    return reader.presDict[name]
+
+
+class LazyBlockDict(MutableMapping):
+    """RESI or PRES table whose entries are parsed on first access.
+
+    blocks maps a name to the CharmmTopSource it is read from. An entry
+    is read from its file the first time it is looked up and kept in
+    entries, so a structure only pays for the residues and patches it
+    uses. Entries assigned directly go to entries
+    as well. Membership and iteration never parse anything.
+    """
+
+    def __init__(self, kind, blocks=None, noCmap=False):
+        self.kind = kind
+        self.blocks = dict(blocks or {})
+        self.noCmap = noCmap
+        self.entries = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.entries[name]
+        except KeyError:
+            source = self.blocks[name]
+        entry = read_charmm_top_block(source, self.kind, name, self.noCmap)
+        self.entries[name] = entry
+        return entry
+
+    def __setitem__(self, name, entry):
+        self.entries[name] = entry
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.entries.pop(name, None)
+        self.blocks.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.entries or name in self.blocks
+
+    def __iter__(self):
+        for name in self.blocks:
+            yield name
+        for name in self.entries:
+            if name not in self.blocks:
+                yield name
+
+    def __len__(self):
+        return len(self.blocks) + sum(1 for name in self.entries
+                                      if name not in self.blocks)
+
+    def copy(self):
+        """Return a new table sharing the blocks and the parsed entries."""
+        other = LazyBlockDict(self.kind, self.blocks, self.noCmap)
+        other.entries.update(self.entries)
+        return other
+
+    def merge(self, other):
+        """Add the entries of other, replacing those of the same name."""
+        for name in other.blocks:
+            self.entries.pop(name, None)
+        self.blocks.update(other.blocks)
+        self.entries.update(other.entries)
+
+
+def read_charmm_top_file(filename, noCmap=False):
+    """Read one topology file, or the rtf sections of a stream file.
+
+    Only the index of the file is built (see index_charmm_top); RESI and
+    PRES entries are parsed when first used. The index of each file is
+    cached on its own, see ff_cache_path.
+    """
+    isStream = is_charmm_stream(filename)
+    cachePath = ff_cache_path('top', filename, os.path.abspath(filename),
+                              isStream)
+    ctopIndex = ff_cache_load(cachePath)
+    if ctopIndex is not None:
+        print("Read CHARMM topology file", filename, "from cache",
+              end="\n\n")
+        print_charmm_top_title(ctopIndex[0])
     else:
-        ctopPresDataDict = {}
+        try:
+            ctopFile = ropen(filename, 'rb')
+        except IOError:
+            perr("Cannot open", filename)
+            raise
+
+        print("Read CHARMM topology file", filename, end="\n\n")
+
+        with ctopFile:
+            ctopIndex = index_charmm_top(ctopFile, isStream)
+        print_charmm_top_title(ctopIndex[0])
+        ff_cache_save(cachePath, ctopIndex)
+
+    ctopTitleList, ctopAtomMassDict, resiBlocks, presBlocks = ctopIndex
+    source = CharmmTopSource(filename, isStream, _file_stamp(filename),
+                             resiBlocks, presBlocks)
+    ctopResiDataDict = LazyBlockDict(
+        'RESI', ((name, source) for name in resiBlocks), noCmap)
+    ctopPresDataDict = LazyBlockDict(
+        'PRES', ((name, source) for name in presBlocks), noCmap)
+    print("\nLoad %d masses, %d residues and %d patches" %
+          (len(ctopAtomMassDict), len(ctopResiDataDict),
+           len(ctopPresDataDict)))
 
     global _debug
     if _debug:
         print(ctopAtomMassDict)
-        print(ctopResiDataDict)
-        print(ctopPresDataDict)
+        print(resiBlocks)
+        print(presBlocks)
 
-    return ctopTitleList, ctopAtomMassDict, ctopResiDataDict, ctopPresDataDict
+    return (ctopTitleList, ctopAtomMassDict, ctopResiDataDict,
+            ctopPresDataDict)
 
 
-def read_charmm_prm(filename):
+def merge_charmm_top(ctopDataLists, filenames):
+    """Merge topologies read from several files, in order.
+
+    A MASS, RESI or PRES read later replaces the one of the same name read
+    before, as with 'read rtf card append' in CHARMM. The titles and the
+    version come from the first file.
+    """
+    ctopTitleList = list(ctopDataLists[0][0])
+    ctopAtomMassDict = {}
+    ctopResiDataDict = LazyBlockDict('RESI', noCmap=ctopDataLists[0][2].noCmap)
+    ctopPresDataDict = LazyBlockDict('PRES', noCmap=ctopDataLists[0][3].noCmap)
+    for ctopDataList, filename in zip(ctopDataLists, filenames):
+        for name in ctopDataList[2]:
+            if name in ctopResiDataDict:
+                print("RESI", name, "replaced by", filename)
+        for name in ctopDataList[3]:
+            if name in ctopPresDataDict:
+                print("PRES", name, "replaced by", filename)
+        ctopAtomMassDict.update(ctopDataList[1])
+        ctopResiDataDict.merge(ctopDataList[2])
+        ctopPresDataDict.merge(ctopDataList[3])
+    return (ctopTitleList, ctopAtomMassDict, ctopResiDataDict,
+            ctopPresDataDict)
+
+
+def read_charmm_top(filename, epreInpDict):
+    """Read and merge the topology files named by filename.
+
+    filename is a single file, a list of files or an os.pathsep separated
+    string of files; see ff_file_list and merge_charmm_top.
+    """
+    noCmap = epreInpDict['NOCMAP']
+    filenames = ff_file_list(filename)
+    if not filenames:
+        perr("No topology file given")
+    ctopDataLists = [read_charmm_top_file(name, noCmap) for name in filenames]
+    if len(ctopDataLists) == 1:
+        return ctopDataLists[0]
+
+    ctopDataList = merge_charmm_top(ctopDataLists, filenames)
+    print("\nMerge %d topology files: %d masses, %d residues and %d patches"
+          % (len(filenames), len(ctopDataList[1]), len(ctopDataList[2]),
+             len(ctopDataList[3])))
+    return ctopDataList
+
+
+def prm_key(types):
+    """Return the key a bonded term is stored under in a parameter table."""
+    types = tuple(types)
+    return min(types, types[::-1])
+
+
+def cmap_grid(vals, resolution, cmapGrids=None):
+    """Make the resolution x resolution array of a CMAP grid from its values.
+
+    Grids found in cmapGrids (keyed by content) are shared, so repeated
+    grids are stored once; the arrays are read-only.
+    """
+    grid = numpy.array(vals, dtype=numpy.float64)
+    grid = grid.reshape(resolution, resolution)
+    grid.flags.writeable = False
+    if cmapGrids is not None:
+        grid = cmapGrids.setdefault(grid.tobytes(), grid)
+    return grid
+
+
+class CharmmPrmReader(object):
+    """Single-pass reader for CHARMM parameter records.
+
+    Section headers (BONDS, ANGLES, DIHEDRALS, IMPROPER, CMAP, NONBONDED,
+    NBFIX, HBOND, ...) switch the handler used for the records that
+    follow, so sections may come in any order and more than once. END
+    closes a parameter set and the records after it start a new one, so
+    concatenated files are read in one pass. An entry read later replaces
+    the one read before; the terms of a multiple dihedral are collected
+    within one set and replaced as a whole by a later set.
+    """
+
+    # a section header is a keyword or its abbreviation to four letters or
+    # more (PHI to three); the whole first token must be one, so data
+    # lines starting with an atom type such as BONE or PHI1 are not taken
+    # for headers
+    SECTIONS = dict(
+        (keyword[:n], section)
+        for keyword, section in (
+            ('ATOMS', 'ATOMS'), ('BONDS', 'BONDS'), ('ANGLES', 'ANGLES'),
+            ('THETAS', 'ANGLES'), ('DIHEDRALS', 'DIHEDRALS'),
+            ('PHIS', 'DIHEDRALS'), ('IMPROPERS', 'IMPROPER'),
+            ('IMPHIS', 'IMPROPER'), ('CMAP', 'CMAP'),
+            ('NONBONDED', 'NONBONDED'), ('NBONDED', 'NONBONDED'),
+            ('NBFIX', 'NBFIX'), ('HBONDS', 'HBOND'))
+        for n in range(3 if keyword == 'PHIS' else 4, len(keyword) + 1))
+
+    def __init__(self):
+        self.bondDict = {}
+        self.anglDict = {}
+        self.ubDict = {}
+        self.diheDict = {}
+        self.imprDict = {}
+        self.cmapDict = {}
+        self.nbndDict = {}
+        self.nb14Dict = {}
+        self.nbfixDict = {}
+        self.cmapGrids = {}
+        self.lines = None
+        self.section = None
+        self.cmap = None
+        self.setDihes = set()
+        self.handlers = {
+            'BONDS': self.do_bond,
+            'ANGLES': self.do_angl,
+            'DIHEDRALS': self.do_dihe,
+            'IMPROPER': self.do_impr,
+            'CMAP': self.do_cmap,
+            'NONBONDED': self.do_nbnd,
+            'NBFIX': self.do_nbfix,
+            }
+
+    def feed(self, records):
+        """Handle the records of one or more parameter sets."""
+        for tokens in records:
+            if tokens[0] == 'END':
+                self.end_set()
+            elif tokens[0] in self.SECTIONS:
+                self.drop_cmap()
+                self.section = self.SECTIONS[tokens[0]]
+            elif self.section in self.handlers:
+                try:
+                    self.handlers[self.section](tokens)
+                except (ValueError, IndexError):
+                    perr("Cannot read %s parameter:" % self.section,
+                         ' '.join(tokens))
+
+    def end_set(self):
+        self.drop_cmap()
+        self.section = None
+        self.setDihes = set()
+
+    def drop_cmap(self):
+        """Give up the CMAP grid being read, if it is not complete."""
+        if self.cmap is not None:
+            perr("Incomplete CMAP grid%s:" % line_note(self.lines),
+                 ' '.join(self.cmap[0]))
+            self.cmap = None
+
+    def parameters(self):
+        """Return the tables read so far as a ParameterSet."""
+        return ParameterSet((self.bondDict, self.anglDict, self.ubDict,
+                             self.diheDict, self.imprDict, self.cmapDict,
+                             self.nbndDict, self.nb14Dict, self.nbfixDict))
+
+    def do_bond(self, tokens):
+        self.bondDict[prm_key(tokens[:2])] = (float(tokens[2]),
+                                              float(tokens[3]))
+
+    def do_angl(self, tokens):
+        key = prm_key(tokens[:3])
+        self.anglDict[key] = (float(tokens[3]), radians(float(tokens[4])))
+        if len(tokens) == 7:
+            self.ubDict[key] = (float(tokens[5]), float(tokens[6]))
+
+    def do_dihe(self, tokens):
+        key = prm_key(tokens[:4])
+        term = (float(tokens[4]), int(tokens[5]), radians(float(tokens[6])))
+        if key not in self.setDihes:
+            self.setDihes.add(key)
+            self.diheDict[key] = [term]
+            return
+        # within a set a term of the same periodicity replaces the old one
+        terms = self.diheDict[key]
+        for i, oldTerm in enumerate(terms):
+            if oldTerm[1] == term[1]:
+                terms[i] = term
+                break
+        else:
+            terms.append(term)
+
+    def do_impr(self, tokens):
+        self.imprDict[prm_key(tokens[:4])] = (float(tokens[4]),
+                                              float(tokens[6]))
+
+    def do_cmap(self, tokens):
+        try:
+            float(tokens[0])
+            isValues = True
+        except ValueError:
+            isValues = False
+        if not isValues:
+            self.drop_cmap()
+        if self.cmap is None:
+            # the values of a grid whose header was rejected are skipped
+            if isValues:
+                return
+            if len(tokens) != 9:
+                perr("CMAP header needs 8 atom types and a resolution%s:" %
+                     line_note(self.lines), ' '.join(tokens))
+                return
+            self.cmap = (tuple(tokens[:8]), int(tokens[8]), [])
+            return
+        key, resolution, vals = self.cmap
+        vals.extend(tokens)
+        if len(vals) >= resolution * resolution:
+            if len(vals) > resolution * resolution:
+                perr("CMAP grid of %d values is not %d x %d%s" %
+                     (len(vals), resolution, resolution,
+                      line_note(self.lines)))
+            self.cmap = None
+            self.cmapDict[prm_key(key)] = cmap_grid(
+                vals[:resolution * resolution], resolution, self.cmapGrids)
+
+    def do_nbnd(self, tokens):
+        nbnd = (float(tokens[2]), float(tokens[3]))
+        self.nbndDict[tokens[0]] = nbnd
+        if len(tokens) >= 7:
+            self.nb14Dict[tokens[0]] = (float(tokens[5]), float(tokens[6]))
+        else:
+            self.nb14Dict[tokens[0]] = nbnd
+
+    def do_nbfix(self, tokens):
+        nbfix = (float(tokens[2]), float(tokens[3]))
+        if len(tokens) >= 6:
+            nbfix += (float(tokens[4]), float(tokens[5]))
+        else:
+            nbfix += nbfix
+        self.nbfixDict[tuple(sorted(tokens[:2]))] = nbfix
+
+
+class ParameterSet(tuple):
+    """The nine CHARMM parameter tables with a lookup index on top.
+
+    It is still the (bond, angle, UB, dihedral, improper, CMAP, nonbonded,
+    1-4, NBFIX) tuple of dicts, so code unpacking the tables keeps working.
+    Bonded terms are stored once, under the smaller of the type tuple and
+    its reverse (see prm_key), and NBFIX pairs under the sorted pair. In
+    addition term_id gives every distinct combination of atom types of a
+    bonded term, taken in either direction, a small integer id. The table
+    entry for the id is found once, trying the reversed types and then the
+    X wildcards the way CHARMM does, and kept in values[id] (None if there
+    is no parameter). types[id] is the canonical type tuple and keys[id]
+    the table key that matched.
+    """
+
+    KINDS = {'BOND': 0, 'ANGL': 1, 'UB': 2, 'DIHE': 3, 'IMPR': 4, 'CMAP': 5}
+
+    def __new__(cls, cprmDataList):
+        self = tuple.__new__(cls, cprmDataList)
+        self.ids = dict((kind, {}) for kind in cls.KINDS)
+        self.types = []
+        self.keys = []
+        self.values = []
+        return self
+
+    def __getnewargs__(self):
+        return (tuple(self),)
+
+    def term_id(self, kind, types):
+        """Return the id of the term of kind ('BOND', 'ANGL', 'UB',
+        'DIHE', 'IMPR' or 'CMAP') between atoms of the given types."""
+        ids = self.ids[kind]
+        try:
+            return ids[types]
+        except KeyError:
+            pass
+        canonical = min(types, types[::-1])
+        termId = ids.get(canonical)
+        if termId is None:
+            termId = len(self.values)
+            key = self.match(kind, types)
+            self.types.append(canonical)
+            self.keys.append(key)
+            self.values.append(None if key is None
+                               else self[self.KINDS[kind]][key])
+            ids[canonical] = termId
+        ids[types] = termId
+        return termId
+
+    def match(self, kind, types):
+        """Return the table key holding the parameter for types, or None."""
+        prmDict = self[self.KINDS[kind]]
+        keys = [types, types[::-1]]
+        if kind == 'DIHE':
+            keys.append(('X', types[1], types[2], 'X'))
+            keys.append(('X', types[2], types[1], 'X'))
+        elif kind == 'IMPR':
+            keys.append((types[0], 'X', 'X', types[3]))
+            keys.append((types[3], 'X', 'X', types[0]))
+        for key in keys:
+            if key in prmDict:
+                return key
+        return None
+
+    def value(self, kind, types):
+        """Return the parameter of a term, or None if there is none."""
+        return self.values[self.term_id(kind, types)]
+
+
+def read_charmm_prm_file(filename):
+    """Read one parameter file, or the para sections of a stream file.
+
+    The parsed result of each file is cached on its own, see ff_cache_path.
+    """
+    isStream = is_charmm_stream(filename)
+    cachePath = ff_cache_path('prm', filename, isStream)
+    cprmDataList = ff_cache_load(cachePath)
+    if cprmDataList is not None:
+        print("Read CHARMM parameter file", filename, "from cache")
+        return cprmDataList
+
     try:
-        cprmFile = open(filename)
+        cprmFile = ropen(filename)
     except IOError:
         perr("Cannot open", filename)
+        raise
 
     print("Read CHARMM parameter file", filename)
 
-    cprmBondDict = {}
-    cprmAnglDict = {}
-    cprmUBDict = {}
-    cprmDiheDict = {}
-    cprmImprDict = {}
-    cprmCmapDict = {}
-    cprmNbndDict = {}
-    cprmNb14Dict = {}
+    reader = CharmmPrmReader()
+    with cprmFile:
+        if isStream:
+            fileLines = _CountedLines(cprmFile)
+            for section in charmm_stream_sections(fileLines, 'PARA'):
+                # the END line of the section has been read as well
+                reader.lines = _CountedLines(
+                    section, fileLines.num - len(section) - 1)
+                reader.feed(charmm_records(reader.lines))
+                reader.end_set()
+        else:
+            reader.lines = _CountedLines(cprmFile)
+            reader.feed(charmm_records(reader.lines))
+        reader.lines = None
+    cprmDataList = reader.parameters()
 
-    while True:
-        line = cprmFile.next()
-        if line.startswith('BOND'): break
+    global _debug
+    if _debug:
+        print(cprmDataList[0])
+        print(cprmDataList[1])
 
-    while True:
-        line = cprmFile.next()
-        if line.startswith('ANGLES'): break
-        splitLine = line.split('!')[0].split()
-        if splitLine:
-            cprmBondDict[(splitLine[0], splitLine[1])] = (float(splitLine[2]), float(splitLine[3]))
-            cprmBondDict[(splitLine[1], splitLine[0])] = (float(splitLine[2]), float(splitLine[3]))
+    ff_cache_save(cachePath, cprmDataList)
 
-    while True:
-        line = cprmFile.next()
-        if line.startswith('DIHEDRALS'): break
-        splitLine = line.split('!')[0].split()
-        if splitLine:
-            cprmAnglDict[(splitLine[0], splitLine[1], splitLine[2])] = (
-            float(splitLine[3]), radians(float(splitLine[4])))
-            cprmAnglDict[(splitLine[2], splitLine[1], splitLine[0])] = (
-            float(splitLine[3]), radians(float(splitLine[4])))
-        if len(splitLine) == 7:
-            cprmUBDict[(splitLine[0], splitLine[1], splitLine[2])] = (float(splitLine[5]), float(splitLine[6]))
-            cprmUBDict[(splitLine[2], splitLine[1], splitLine[0])] = (float(splitLine[5]), float(splitLine[6]))
+    return cprmDataList
 
-    while True:
-        line = cprmFile.next()
-        if line.startswith('IMPROPER'): break
-        splitLine = line.split('!')[0].split()
-        if splitLine:
-            key = (splitLine[0], splitLine[1], splitLine[2], splitLine[3])
-            if key in cprmDiheDict:
-                cprmDiheDict[key].append((float(splitLine[4]), int(splitLine[5]), radians(float(splitLine[6]))))
-            else:
-                cprmDiheDict[key] = [(float(splitLine[4]), int(splitLine[5]), radians(float(splitLine[6])))]
 
-    while True:
-        line = cprmFile.next()
-        if line.startswith('CMAP') or line.startswith('NONBONDED'): break
-        splitLine = line.split('!')[0].split()
-        if splitLine:
-            cprmImprDict[(splitLine[0], splitLine[1], splitLine[2], splitLine[3])] = float(splitLine[4]), float(
-                splitLine[6])
-
-    if line.startswith('CMAP'):
-        while True:
-            line = cprmFile.next()
-            if line.startswith('NONBONDED'): break
-            splitLine = line.split('!')[0].split()
-            if splitLine and len(splitLine) == 9:
-                key = tuple(splitLine[:8])
-                resolution = int(splitLine[8])
-                cprmFile.next()
-                val = []
-                for i in range(resolution):
-                    aval = []
-                    i = 0
-                    while i < int(math.ceil(resolution / 5)):
-                        line = cprmFile.next()
-                        splitLine = line.split('!')[0].split()
-                        if splitLine:
-                            aval.extend(map(float, splitLine))
-                            i += 1
-                    cprmFile.next()
-                    assert len(aval) == 24
-                    val.append(aval)
-                assert len(val) == 24
-                cprmCmapDict[key] = val
-
-    line = cprmFile.next()
-    while True:
-        line = cprmFile.next()
-        if line.startswith('HBOND') or line.startswith('END'): break
-        splitLine = line.split('!')[0].split()
-        if splitLine:
-            cprmNbndDict[splitLine[0]] = (float(splitLine[2]), float(splitLine[3]))
-            if len(splitLine) == 7:
-                cprmNb14Dict[splitLine[0]] = (float(splitLine[5]), float(splitLine[6]))
-            else:
-                cprmNb14Dict[splitLine[0]] = (float(splitLine[2]), float(splitLine[3]))
+def merge_charmm_prm(cprmDataLists):
+    """Merge parameter tables read from several files, in order.
 
-    cprmFile.close()
+    An entry read later replaces the one with the same atom types read
+    before; all the terms of a multiple dihedral are replaced together.
+    """
+    cprmDataList = ParameterSet({} for i in range(9))
+    for cprmData in cprmDataLists:
+        for cprmDict, cprmNewDict in zip(cprmDataList, cprmData):
+            cprmDict.update(cprmNewDict)
+    return cprmDataList
 
-    global _debug
-    if _debug:
-        print(cprmBondDict)
-        print(cprmAnglDict)
 
-    return cprmBondDict, \
-           cprmAnglDict, \
-           cprmUBDict, \
-           cprmDiheDict, \
-           cprmImprDict, \
-           cprmCmapDict, \
-           cprmNbndDict, \
-           cprmNb14Dict
+def read_charmm_prm(filename):
+    """Read and merge the parameter files named by filename.
+
+    filename is a single file, a list of files or an os.pathsep separated
+    string of files; see ff_file_list and merge_charmm_prm.
+    """
+    filenames = ff_file_list(filename)
+    if not filenames:
+        perr("No parameter file given")
+    cprmDataLists = [read_charmm_prm_file(name) for name in filenames]
+    if len(cprmDataLists) == 1:
+        return cprmDataLists[0]
+
+    print("Merge %d parameter files" % len(filenames))
+    return merge_charmm_prm(cprmDataLists)
+
+
+def rule_rank(field):
+    """Rank a rename rule field: 0 for '*' or empty, 1 for a glob pattern
+    and 2 for an exact name."""
+    if field in ('', '*'):
+        return 0
+    return 1 if any(c in field for c in '*?[') else 2
+
+
+def rule_matches(field, name):
+    rank = rule_rank(field)
+    if rank == 2:
+        return field == name
+    return not rank or fnmatchcase(name, field)
+
+
+class RenameRules(object):
+    """ALIASRES/ALIASATOM rules compiled into hashed lookup tables.
+
+    A residue or atom field may be a glob pattern ('HS?', 'H*'), and '*'
+    or an empty residue (':ATOM') matches any name. When several rules
+    match a name, the most specific one wins: an exact name beats a
+    pattern, which beats '*', and the residue field counts before the atom
+    field. Rules of the same rank apply in file order. After a rename only
+    the rules listed later are tried on the new name, so chains of rules
+    still work.
+
+    Rules are indexed by the exact name they rename, and each distinct
+    name or (resname, atomname) pair is resolved once and then kept in a
+    dict. Atom rules match on the residue name as read, before ALIASRES.
+    """
+
+    def __init__(self, aliasResiList=(), aliasAtomList=()):
+        self.resRules = self.index_rules(
+            [((oldName,), newName) for oldName, newName in aliasResiList])
+        self.atomRules = self.index_rules(
+            [(tuple(key) if len(key) == 2 else ('',) + tuple(key), newName)
+             for key, newName in aliasAtomList])
+        self.nrule = len(aliasResiList) + len(aliasAtomList)
+        self.resMap = {}
+        self.atomMap = {}
+
+    @staticmethod
+    def index_rules(ruleList):
+        """Return the rules keyed by the exact name they rename, and the
+        list of rules whose name is a pattern. Each rule is kept as (rank,
+        file position, fields, new name)."""
+        nameRules = defaultdict(list)
+        wildRules = []
+        for i, (fields, newName) in enumerate(ruleList):
+            rank = tuple(-rule_rank(field) for field in fields)
+            rule = (rank, i, fields, newName)
+            if rule_rank(fields[-1]) == 2:
+                nameRules[fields[-1]].append(rule)
+            else:
+                wildRules.append(rule)
+        return nameRules, wildRules
+
+    @staticmethod
+    def resolve(index, fields):
+        """Apply the indexed rules to the last of fields and return the
+        resulting name."""
+        nameRules, wildRules = index
+        fields = list(fields)
+        pos = -1
+        while True:
+            rules = [rule for rule in nameRules.get(fields[-1], []) + wildRules
+                     if rule[1] > pos and
+                     all(map(rule_matches, rule[2], fields))]
+            if not rules:
+                return fields[-1]
+            _, pos, _, fields[-1] = min(rules)
+
+    def __len__(self):
+        return self.nrule
+
+    def res_name(self, resName):
+        if resName not in self.resMap:
+            self.resMap[resName] = self.resolve(self.resRules, (resName,))
+        return self.resMap[resName]
+
+    def atom_name(self, resName, atomName):
+        key = (resName, atomName)
+        if key not in self.atomMap:
+            self.atomMap[key] = self.resolve(self.atomRules, key)
+        return self.atomMap[key]
+
+    def apply(self, names, resNames, atomNames):
+        """Rename whole arrays of residue and atom name ids at once.
+
+        names is the NameTable the ids refer to. Each distinct pair of ids
+        is looked up once, so the cost does not grow with the number of
+        rules. Returns new (resNames, atomNames) arrays.
+        """
+        if any(self.atomRules):
+            nname = len(names)
+            pairs = resNames.astype(numpy.int64) * nname + atomNames
+            uniq, inverse = numpy.unique(pairs, return_inverse=True)
+            newIds = numpy.array(
+                [names.intern(self.atom_name(names[pair // nname],
+                                             names[pair % nname]))
+                 for pair in uniq.tolist()], dtype=numpy.int32)
+            atomNames = newIds[inverse]
+
+        if any(self.resRules):
+            uniq, inverse = numpy.unique(resNames, return_inverse=True)
+            newIds = numpy.array(
+                [names.intern(self.res_name(names[resId]))
+                 for resId in uniq.tolist()], dtype=numpy.int32)
+            resNames = newIds[inverse]
+
+        return resNames, atomNames
+
+
+def compile_rename_rules(epreInpDict):
+    rules = RenameRules(epreInpDict['ALIASRES'], epreInpDict['ALIASATOM'])
+    epreInpDict['RENAMERULE'] = rules
+    return rules
 
 
 def read_rename_rule(filename, epreInpDict=None):
     try:
-        ruleFile = open(filename).read().splitlines()
+        ruleFile = ropen(filename).read().splitlines()
     except IOError:
         perr("Cannot open", filename)
 
@@ -830,12 +2347,14 @@ def read_rename_rule(filename, epreInpDict=None):
             perr("Unknown argument", splitLine[0])
         i += 1
 
+    compile_rename_rules(epreInpDict)
+
     return epreInpDict
 
 
 def read_bond_file(filename, epreInpDict=None):
     try:
-        bondFile = open(filename).read().splitlines()
+        bondFile = ropen(filename).read().splitlines()
     except IOError:
         perr("Cannot open", filename)
 
@@ -858,6 +2377,14 @@ def read_bond_file(filename, epreInpDict=None):
                     [int(tmp) for tmp in splitLine[2].split(':')]])
             else:
                 perr("Missing or too many arguments", splitLine[0])
+        elif arg == 'PATCH':
+            if splitLineLen >= 3:
+                epreInpDict['PATCH'].append([
+                    splitLine[1].upper(),
+                    [[int(tmp) for tmp in site.split(':')]
+                     for site in splitLine[2:]]])
+            else:
+                perr("Missing arguments", splitLine[0])
         else:
             perr("Unknown argument", splitLine[0])
         i += 1
@@ -865,7 +2392,13 @@ def read_bond_file(filename, epreInpDict=None):
     return epreInpDict
 
 
-def do_disu(epreInpDict, pdbDataList, ctopResiDataDict, ctopPresDataDict):
+def do_disu(epreInpDict, pdbDataList):
+    """Return the DISU patch statements for the disulfide bonds.
+
+    The bonds are those of DISULIST or, with AUTO, the cys pairs whose SG
+    atoms are within CUT. Pairs that are not two cys residues are left
+    out.
+    """
     doAuto = epreInpDict['DISUBOND']['AUTO']
     cut = epreInpDict['DISUBOND']['CUT']
     if doAuto:
@@ -882,643 +2415,874 @@ def do_disu(epreInpDict, pdbDataList, ctopResiDataDict, ctopPresDataDict):
         print("Found %d cys residues" % numCys)
         if numCys < 2:
             print("No cys pairs found.")
-            return
+            return []
         disuList = do_disu_detect(cysList, cut ** 2)
         print("Found %d possible disufide bonds with a %f A cutoff" %
               (len(disuList), cut))
         epreInpDict['DISUBOND']["DISULIST"] = disuList
-        if not disuList: return
     else:
         disuList = epreInpDict['DISUBOND']["DISULIST"]
 
-    for si, sj in disuList:
-
-        for i, res in enumerate(pdbDataList[si[0] - 1][1]):
-            if res[0] == si[1]:
-                if res[1] == 'CYS':
-                    pdbDataList[si[0] - 1][1][i][1] = '_EPRE_CYM1'
-                    break
-                else:
-                    perr("Segment %d residue %d is not cys" % tuple(si))
-        else:
-            perr("Cannot find segment %d residue %d" % tuple(si))
-
-        for i, res in enumerate(pdbDataList[sj[0] - 1][1]):
-            if res[0] == sj[1]:
-                if res[1] == 'CYS':
-                    pdbDataList[sj[0] - 1][1][i][1] = '_EPRE_CYM2'
-                    break
-                else:
-                    perr("Segment %d residue %d is not cys" % tuple(sj))
+    patchStmts = []
+    for sites in disuList:
+        for site in sites:
+            resi = find_residue(pdbDataList, site)
+            if resi is not None and resi[1] != 'CYS':
+                perr("Segment %d residue %d is not cys" % tuple(site))
+                break
         else:
-            perr("Cannot find segment %d residue %d" % tuple(sj))
-
-    cysResi = deepcopy(ctopResiDataDict['CYS'])
-    patchResi = 'DISU'
-    patchList = ctopPresDataDict[patchResi]
-    deleList = [i[1:] for i in patchList[0] if i[0] == '1']
-    patomDict = OrderedDict()
-    for i, j in patchList[1].items():
-        if i[0] == '1': patomDict[i[1:]] = j
-    atomDict = cysResi[0]
-    bondList = cysResi[1]
-    imprList = cysResi[2]
-    cmapList = cysResi[3]
-    icList = cysResi[4]
-    atomDict.update(patomDict)
-    for atom in deleList: del atomDict[atom]
-    deleList = set(deleList)
-    cysResi[0] = atomDict
-    cysResi[1] = [bond for bond in bondList if not set(bond) & deleList]
-    cysResi[2] = [impr for impr in imprList if not set(impr) & deleList]
-    cysResi[3] = [cmap for cmap in cmapList if not set(cmap) & deleList]
-    cysResi[4] = [ic for ic in icList if not set(ic[:4]) & deleList]
-    ctopResiDataDict['_EPRE_CYM1'] = cysResi
-
-    cysResi = deepcopy(ctopResiDataDict['CYS'])
-    patchResi = 'DISU'
-    patchList = ctopPresDataDict[patchResi]
-    deleList = [i[1:] for i in patchList[0] if i[0] == '2']
-    patomDict = OrderedDict()
-    for i, j in patchList[1].items():
-        if i[0] == '2': patomDict[i[1:]] = j
-    atomDict = cysResi[0]
-    bondList = cysResi[1]
-    imprList = cysResi[2]
-    cmapList = cysResi[3]
-    icList = cysResi[4]
-    atomDict.update(patomDict)
-    for atom in deleList: del atomDict[atom]
-    deleList = set(deleList)
-    cysResi[0] = atomDict
-    cysResi[1] = [bond for bond in bondList if not set(bond) & deleList]
-    cysResi[2] = [impr for impr in imprList if not set(impr) & deleList]
-    cysResi[3] = [cmap for cmap in cmapList if not set(cmap) & deleList]
-    cysResi[4] = [ic for ic in icList if not set(ic[:4]) & deleList]
-    ctopResiDataDict['_EPRE_CYM2'] = cysResi
+            patchStmts.append(['DISU', sites])
+    return patchStmts
 
 
 def do_disu_detect(cysList, cut2):
     disuDict = defaultdict()
     for i, j in combinations(cysList, 2):
         pi = i[2]
-        pj = j[2]
-        bondLen2 = (pi[0] - pj[0]) ** 2 + (pi[1] - pj[1]) ** 2 + (pi[2] - pj[2]) ** 2
-        if bondLen2 <= cut2:
-            disuDict[(i[0], i[1])].append(((j[0], j[1]), sqrt(bondLen2)))
-
-    disuList = []
-    for key, val in disuDict.items():
-        if len(val) > 1:
-            perr("Found more than 1 disufide bonds both share a atom")
-        disuList.append([[key[0], key[1]], [val[0][0], val[0][1]]])
-
-    return disuList
-
-
-def do_disu_connect(disuList, pdbDataList, bondList):
-    for si, sj in disuList:
-
-        for i, res in enumerate(pdbDataList[si[0] - 1][1]):
-            if res[0] == si[1]:
-                if res[1] == '_EPRE_CYM1':
-                    for atom in res[2]:
-                        if atom[1] == 'SG':
-                            b1 = atom[0]
-                            break
-                    else:
-                        perr("Cannot find SG atom")
-                    break
-                else:
-                    perr("Segment %d residue %d is not cys" % tuple(si))
-        else:
-            perr("Cannot find segment %d residue %d" % tuple(si))
-
-        for i, res in enumerate(pdbDataList[sj[0] - 1][1]):
-            if res[0] == sj[1]:
-                if res[1] == '_EPRE_CYM2':
-                    for atom in res[2]:
-                        if atom[1] == 'SG':
-                            b2 = atom[0]
-                            break
-                    else:
-                        perr("Cannot find SG atom")
-                    break
-                else:
-                    perr("Segment %d residue %d is not cys" % tuple(sj))
-        else:
-            perr("Cannot find segment %d residue %d" % tuple(sj))
-
-        bondList.append([b1, b2])
-
-        print("Connect atoms %d and %d" % (b1, b2))
-
-
-def do_disu_rename(pdbDataList, atomList):
-    for _, segDataList in pdbDataList:
-        for i, (_, resName, _) in enumerate(segDataList):
-            if resName in ('_EPRE_CYM1', '_EPRE_CYM2'):
-                segDataList[i][1] = 'CYS'
-
-    for atom in atomList:
-        if atom[3] in ('_EPRE_CYM1', '_EPRE_CYM2'):
-            atom[3] = 'CYS'
-
-
-def build_struct(ctopDataList, pdbDataList, epreInpDict, cprmDataList):
-    ctopAtomMassDict, ctopResiDataDict, ctopPresDataDict = ctopDataList
-    cprmBondDict, cprmAnglDict = cprmDataList[:2]
-
-    doDisu = epreInpDict['DISUBOND']['DODISU']
-    if doDisu:
-        do_disu(epreInpDict, pdbDataList, ctopResiDataDict, ctopPresDataDict)
-
-    newDataList = []
-    atomCnt = 0
-    for segCnt, [segName, segDataList] in enumerate(pdbDataList):
-        newDataList.append([segName, []])
-
-        firstResi = deepcopy(ctopResiDataDict[segDataList[0][1]])
-        patchResi = firstResi[5]['FIRS']
-        if patchResi != 'NONE':
-            patchList = ctopPresDataDict[patchResi]
-            deleList = patchList[0]
-            patomDict = deepcopy(patchList[1])
-            atomDict = firstResi[0]
-            bondList = firstResi[1]
-            imprList = firstResi[2]
-            cmapList = firstResi[3]
-            icList = firstResi[4]
-            atomDict.update(patomDict)
-            patomDict.update(atomDict)
-            atomDict = patomDict
-            for atom in deleList:
-                del atomDict[atom]
-            deleList = set(deleList)
-            firstResi[0] = atomDict
-            firstResi[1] = [bond for bond in bondList
-                            if not set(bond).intersection(deleList)]
-            firstResi[2] = [impr for impr in imprList
-                            if not set(impr).intersection(deleList)]
-            firstResi[3] = [cmap for cmap in cmapList
-                            if not set(cmap).intersection(deleList)]
-            firstResi[4] = [ic for ic in icList
-                            if not set(ic[:4]).intersection(deleList)]
-            for bond in reversed(patchList[2]):
-                firstResi[1].insert(0, bond)
-            for impr in reversed(patchList[3]):
-                firstResi[2].insert(0, impr)
-            for cmap in reversed(patchList[4]):
-                firstResi[3].insert(0, cmap)
-            for ic in reversed(patchList[5]):
-                firstResi[4].insert(0, ic)
-        ctopResiDataDict[segName + 'FIRST'] = firstResi
-
-        lastResi = deepcopy(ctopResiDataDict[segDataList[-1][1]])
-        patchResi = lastResi[5]['LAST']
-        if patchResi != 'NONE':
-            patchList = ctopPresDataDict[patchResi]
-            deleList = patchList[0]
-            patomDict = deepcopy(patchList[1])
-            atomDict = lastResi[0]
-            bondList = lastResi[1]
-            imprList = lastResi[2]
-            cmapList = lastResi[3]
-            icList = lastResi[4]
-            for atom in deleList:
-                del atomDict[atom]
-            atomDict.update(patomDict)
-            deleList = set(deleList)
-            lastResi[0] = atomDict
-            lastResi[1] = [bond for bond in bondList
-                           if not set(bond).intersection(deleList)]
-            lastResi[2] = [impr for impr in imprList
-                           if not set(impr).intersection(deleList)]
-            lastResi[3] = [cmap for cmap in cmapList
-                           if not set(cmap).intersection(deleList)]
-            lastResi[4] = [ic for ic in icList
-                           if not set(ic[:4]).intersection(deleList)]
-            for bond in reversed(patchList[2]):
-                lastResi[1].insert(0, bond)
-            for impr in reversed(patchList[3]):
-                lastResi[2].insert(0, impr)
-            for cmap in reversed(patchList[4]):
-                lastResi[3].insert(0, cmap)
-            for ic in reversed(patchList[5]):
-                lastResi[4].insert(0, ic)
-        ctopResiDataDict[segName + 'LAST'] = lastResi
-
-        singleResi = deepcopy(ctopResiDataDict[segName + 'FIRST'])
-        patchResi = singleResi[5]['LAST']
-        if patchResi != 'NONE':
-            patchList = ctopPresDataDict[patchResi]
-            deleList = patchList[0]
-            patomDict = deepcopy(patchList[1])
-            atomDict = singleResi[0]
-            bondList = singleResi[1]
-            imprList = singleResi[2]
-            cmapList = singleResi[3]
-            icList = singleResi[4]
-            for atom in deleList:
-                del atomDict[atom]
-            atomDict.update(patomDict)
-            deleList = set(deleList)
-            singleResi[0] = atomDict
-            singleResi[1] = [bond for bond in bondList
-                             if not set(bond).intersection(deleList)]
-            singleResi[2] = [impr for impr in imprList
-                             if not set(impr).intersection(deleList)]
-            singleResi[3] = [cmap for cmap in cmapList
-                             if not set(cmap).intersection(deleList)]
-            singleResi[4] = [ic for ic in icList
-                             if not set(ic[:4]).intersection(deleList)]
-            for bond in reversed(patchList[2]):
-                singleResi[1].insert(0, bond)
-            for impr in reversed(patchList[3]):
-                singleResi[2].insert(0, impr)
-            for cmap in reversed(patchList[4]):
-                singleResi[3].insert(0, cmap)
-            for ic in reversed(patchList[5]):
-                singleResi[4].insert(0, ic)
-        ctopResiDataDict[segName + 'SINGLE'] = singleResi
-
-        nres = len(segDataList)
-        last = nres - 1
-        for resCnt, [resiNum, resiName, resiAtom] in enumerate(segDataList):
-            newDataList[segCnt][1].append([resiNum, resiName, []])
-
-            if nres == 1:
-                atomDict = ctopResiDataDict[segName + 'SINGLE'][0]
-            elif resCnt == 0:
-                atomDict = ctopResiDataDict[segName + 'FIRST'][0]
-            elif resCnt == last:
-                atomDict = ctopResiDataDict[segName + 'LAST'][0]
-            else:
-                atomDict = ctopResiDataDict[resiName][0]
-
-            for atomName in atomDict:
-                atomCnt += 1
-                for pdbAtomList in resiAtom:
-                    if atomName == pdbAtomList[1]:
-                        newAtom = pdbAtomList
-                        newAtom[0] = atomCnt
-                        break
-                else:
-                    newAtom = [atomCnt, atomName, None, None, None]
-                newDataList[segCnt][1][resCnt][2].append(newAtom)
+        pj = j[2]
+        bondLen2 = (pi[0] - pj[0]) ** 2 + (pi[1] - pj[1]) ** 2 + (pi[2] - pj[2]) ** 2
+        if bondLen2 <= cut2:
+            disuDict[(i[0], i[1])].append(((j[0], j[1]), sqrt(bondLen2)))
 
-    pdbDataList = newDataList
+    disuList = []
+    for key, val in disuDict.items():
+        if len(val) > 1:
+            perr("Found more than 1 disufide bonds both share a atom")
+        disuList.append([[key[0], key[1]], [val[0][0], val[0][1]]])
 
-    atomList = []
-    segNameNumDict = {}
-    for segCnt, [segName, segDataList] in enumerate(pdbDataList):
-        segNameNumDict[segName] = {}
-        resiNameNumDict = segNameNumDict[segName]
+    return disuList
 
-        nres = len(segDataList)
-        last = nres - 1
-        for resCnt, [resiNum, resiName, resiAtom] in enumerate(segDataList):
-            resiNameNumDict[resiNum] = {}
 
-            if nres == 1:
-                resList = ctopResiDataDict[segName + 'SINGLE']
-            elif resCnt == 0:
-                resList = ctopResiDataDict[segName + 'FIRST']
-            elif resCnt == last:
-                resList = ctopResiDataDict[segName + 'LAST']
+def find_residue(pdbDataList, site):
+    """Return the residue of pdbDataList at a [segment, resNum] site."""
+    segNum, resNum = site
+    if 0 < segNum <= len(pdbDataList):
+        for resi in pdbDataList[segNum - 1][1]:
+            if resi[0] == resNum:
+                return resi
+    perr("Cannot find segment %d residue %d" % tuple(site))
+    return None
+
+
+def patch_residue(resiList, patchList, atomsFirst=False):
+    """Return a copy of a RESI entry with a PRES entry applied.
+
+    The patch atoms are put in front of the residue atoms if atomsFirst
+    is set (N-terminal patches), otherwise they replace the residue atoms
+    in place or are added at the end. Terms that touch a deleted atom are
+    dropped and the terms of the patch come first. Neither entry is
+    changed.
+    """
+    deleList = patchList[0]
+    patomDict = patchList[1]
+    if atomsFirst:
+        atomDict = OrderedDict(patomDict)
+        for atom, val in resiList[0].items():
+            if atom not in atomDict:
+                atomDict[atom] = val
+        for atom in deleList:
+            del atomDict[atom]
+    else:
+        atomDict = OrderedDict(resiList[0])
+        for atom in deleList:
+            del atomDict[atom]
+        atomDict.update(patomDict)
+    deleList = set(deleList)
+    return [atomDict,
+            patchList[2] + [bond for bond in resiList[1]
+                            if not deleList.intersection(bond)],
+            patchList[3] + [impr for impr in resiList[2]
+                            if not deleList.intersection(impr)],
+            patchList[4] + [cmap for cmap in resiList[3]
+                            if not deleList.intersection(cmap)],
+            patchList[5] + [ic for ic in resiList[4]
+                            if not deleList.intersection(ic[:4])]] + \
+        resiList[5:]
+
+
+def patch_names(patchList):
+    """Yield every atom name a PRES entry refers to."""
+    for name in patchList[0]:
+        yield name
+    for name in patchList[1]:
+        yield name
+    for termList in patchList[2:5]:
+        for term in termList:
+            for name in term:
+                yield name
+    for ic in patchList[5]:
+        for name in ic[:4]:
+            yield name.lstrip('*')
+
+
+def patch_size(patchList):
+    """Return the number of residues a PRES entry applies to.
+
+    Names of a patch for several residues carry a 1, 2, ... prefix for
+    the residue they belong to, as in DISU or LINK.
+    """
+    names = list(patch_names(patchList))
+    if names and all(name[0].isdigit() for name in names):
+        return max(int(name[0]) for name in names)
+    return 1
+
+
+def patch_position(name):
+    """Split a prefixed PRES atom name into its position and name."""
+    if name[0] == '*':
+        position, name = patch_position(name[1:])
+        return position, '*' + name
+    return int(name[0]), name[1:]
+
+
+def patch_part(patchList, position):
+    """Return the part of a PRES entry that applies to one residue.
+
+    position counts from 1 and a patch for a single residue is returned
+    as it is. The prefixes are removed from the names, and terms that
+    join the residue to another one are left out (see patch_links).
+    """
+    if patch_size(patchList) == 1:
+        return patchList
+
+    def local(names):
+        split = [patch_position(name) for name in names]
+        if all(i == position for i, _ in split):
+            return [name for _, name in split]
+        return None
+
+    deleList = [name for i, name in map(patch_position, patchList[0])
+                if i == position]
+    atomDict = OrderedDict()
+    for atom, val in patchList[1].items():
+        i, atom = patch_position(atom)
+        if i == position:
+            atomDict[atom] = val
+    partList = [deleList, atomDict]
+    for termList in patchList[2:5]:
+        partList.append([term for term in map(local, termList)
+                         if term is not None])
+    icList = []
+    for ic in patchList[5]:
+        names = local(ic[:4])
+        if names is not None:
+            icList.append(names + ic[4:])
+    partList.append(icList)
+    return partList
+
+
+def patch_links(patchList):
+    """Return the terms of a PRES entry that join its residues.
+
+    The bonds, impropers and cmaps are returned as three lists, with
+    each name given as a (position, name) pair.
+    """
+    if patch_size(patchList) == 1:
+        return [], [], []
+    linkLists = []
+    for termList in patchList[2:5]:
+        linkList = []
+        for term in termList:
+            term = [patch_position(name) for name in term]
+            if len(set(i for i, _ in term)) > 1:
+                linkList.append(term)
+        linkLists.append(linkList)
+    return linkLists
+
+
+def patch_sites(patchStmts, pdbDataList, ctopPresDataDict):
+    """Find the residues changed by a list of PATCH statements.
+
+    Each statement is [patch, [[segment, resNum], ...]] with one site
+    for each residue of the patch. Returns a dict from (segment index,
+    residue index) to the (patch, position) pairs applied there, and
+    the (patch, sites) of the statements that join several residues,
+    with sites as index pairs.
+    """
+    resiPatches = defaultdict(list)
+    patchLinks = []
+    for patchResi, sites in patchStmts:
+        if patchResi not in ctopPresDataDict:
+            perr("Unknown patch", patchResi)
+            continue
+        nsite = patch_size(ctopPresDataDict[patchResi])
+        if len(sites) != nsite:
+            perr("Patch %s needs %d residues" % (patchResi, nsite))
+            continue
+        resiSites = []
+        for segNum, resNum in sites:
+            resi = find_residue(pdbDataList, [segNum, resNum])
+            if resi is None:
+                break
+            resiSites.append((segNum - 1,
+                              pdbDataList[segNum - 1][1].index(resi)))
+        else:
+            for position, site in enumerate(resiSites, 1):
+                resiPatches[site].append((patchResi, position))
+            if nsite > 1:
+                patchLinks.append((patchResi, resiSites))
+    return resiPatches, patchLinks
+
+
+def link_patches(patchLinks, ctopPresDataDict, pdbDataList, segNameNumDict):
+    """Return the bonds, impropers and cmaps that join patched residues.
+
+    patchLinks is as returned by patch_sites; pdbDataList and
+    segNameNumDict give the atom numbers of the built structure.
+    """
+    linkLists = [], [], []
+    for patchResi, sites in patchLinks:
+        resiNameNumDicts = []
+        for segCnt, resCnt in sites:
+            segName, segDataList = pdbDataList[segCnt]
+            resiNum = segDataList[resCnt][0]
+            resiNameNumDicts.append(segNameNumDict[segName][resiNum])
+        for termList, linkList in zip(patch_links(ctopPresDataDict[patchResi]),
+                                      linkLists):
+            for term in termList:
+                try:
+                    linkList.append([resiNameNumDicts[i - 1][name]
+                                     for i, name in term])
+                except KeyError:
+                    perr("Cannot find atoms %s of patch %s" %
+                         (' '.join('%d%s' % atom for atom in term),
+                          patchResi))
+                    continue
+                if len(term) == 2:
+                    print("Connect atoms %d and %d" % tuple(linkList[-1]))
+    return linkLists
+
+
+def residue_template(ctopResiDataDict, ctopPresDataDict, resiName,
+                     patches=(), cache=None):
+    """Return the RESI entry of resiName with a list of patches applied.
+
+    patches holds (patch, position) pairs in the order they are applied;
+    position is the residue of the patch (see patch_part), or 'FIRS' or
+    'LAST' for the terminal patches of a segment. cache is a dict the
+    caller keeps for one build, with the topology unchanged: a patched
+    entry is built once in it for each residue and list of patches and
+    shared by all residues that use it. Shared entries must not be
+    changed.
+    """
+    resiList = ctopResiDataDict[resiName]
+    if not patches:
+        return resiList
+
+    patches = tuple(patches)
+    if cache is None:
+        cache = {}
+    key = (resiName, patches)
+    template = cache.get(key)
+    if template is not None:
+        return template
+
+    position = patches[-1][1]
+    template = patch_residue(
+        residue_template(ctopResiDataDict, ctopPresDataDict, resiName,
+                         patches[:-1], cache),
+        patch_part(ctopPresDataDict[patches[-1][0]], position),
+        atomsFirst=position == 'FIRS')
+    cache[key] = template
+    return template
+
+
+class BuildPlans(object):
+    """Orders in which the missing atoms of a residue template are built.
+
+    Each IC of the template that can place an atom is compiled once into
+    a candidate: the three reference atoms as (offset, name) slots, with
+    offset -1, 0 or 1 for the previous, same or next residue, and the
+    (dihedral, angle, bond) values, zero values resolved from the
+    parameters when the candidate is first used. plan turns a pattern of
+    missing atoms into a list of steps and caches it, so residues missing
+    the same atoms are rebuilt without looking at the ICs again.
+    """
+
+    def __init__(self, template, cprmDataList):
+        self.template = template
+        self.cprmDataList = cprmDataList
+        self.atoms = list(template[0])
+        self.candidates = defaultdict(list)
+        self.prevRefs = set()
+        self.nextRefs = set()
+        self.values = {}
+        self.plans = {}
+
+        for ic in template[4]:
+            if ic[2][0] == '*':
+                impr = ic[:2] + [ic[2][1:]] + ic[3:4]
+            else:
+                impr = None
+            if impr is not None:
+                forward = impr
+                reverse = [ic[3], ic[1], ic[2][1:], ic[0]]
             else:
-                resList = ctopResiDataDict[resiName]
-
-            atomDict = resList[0]
-            icList = resList[4]
-
-            if len(resiAtom) == 3 and resiName in ('WAT', 'TIP3', 'HOH'):
-                pos = []
-                h1Cnt = h2Cnt = None
-                for atomCnt, atom in enumerate(resiAtom):
-                    if atom[1] == 'OH2':
-                        pos = atom[2:]
-                    elif atom[1] == 'H1':
-                        h1Cnt = atomCnt
-                        if atom[2] is not None: break
-                    elif atom[1] == 'H2':
-                        h2Cnt = atomCnt
-                        if atom[2] is not None: break
+                forward = ic[:4]
+                reverse = ic[3::-1]
+            for names, isForward in ((forward, True), (reverse, False)):
+                if not isForward and names[3] == forward[3]:
+                    continue
+                refs = []
+                for name in names[:3]:
+                    if name[0] == '-':
+                        refs.append((-1, name[1:]))
+                        self.prevRefs.add(name[1:])
+                    elif name[0] == '+':
+                        refs.append((1, name[1:]))
+                        self.nextRefs.add(name[1:])
                     else:
-                        print("Unknown atom %s in water" % atom[1])
+                        refs.append((0, name))
+                self.candidates[names[3]].append(
+                    (tuple(refs), ic, isForward, impr is not None))
+
+    def known(self, atomDict, names):
+        """Return which of names have coordinates in atomDict."""
+        return frozenset(name for name in names
+                         if name in atomDict and atomDict[name][2] is not None)
+
+    def value(self, candidate):
+        """Return the (dihedral, angle, bond) used by a candidate."""
+        key = id(candidate)
+        if key in self.values:
+            return self.values[key][1]
+
+        refs, ic, isForward, isImpr = candidate
+        atomDict = self.template[0]
+        names = [name for _, name in refs] + [ic[3] if isForward else ic[0]]
+        if isForward:
+            tors, angl, bond = ic[6], ic[7], ic[8]
+        else:
+            tors, angl, bond = -ic[6] if isImpr else ic[6], ic[5], ic[4]
+        if angl == 0.0:
+            anglKey = tuple(atomDict[name][0] for name in names[1:])
+            anglPrm = self.cprmDataList.value('ANGL', anglKey)
+            if anglPrm is not None:
+                angl = anglPrm[1]
+            else:
+                print("Unknown %s-%s-%s, use 109 deg" % anglKey,
+                      file=sys.stderr)
+                angl = radians(109.0)
+        if bond == 0.0:
+            bondKey = tuple(atomDict[name][0] for name in names[2:])
+            bondPrm = self.cprmDataList.value('BOND', bondKey)
+            if bondPrm is not None:
+                bond = bondPrm[1]
+            else:
+                print("Unknown %s-%s, use 1 A" % bondKey, file=sys.stderr)
+                bond = 1.0
+        self.values[key] = (candidate, (tors, angl, bond))
+        return tors, angl, bond
+
+    def plan(self, missing, prevKnown, nextKnown):
+        """Return the steps that build the missing atoms of a residue.
+
+        missing holds the indices of the atoms without coordinates, and
+        prevKnown and nextKnown the referenced atoms of the neighbouring
+        residues that have them. Atoms are tried in template order, each
+        with the first candidate whose reference atoms are known, over
+        and over until no more can be built. Returns the steps as
+        (index, refs, value) and the indices of the atoms left.
+        """
+        key = (missing, prevKnown, nextKnown)
+        if key in self.plans:
+            return self.plans[key]
+
+        missingSet = set(missing)
+        have = (prevKnown,
+                set(name for i, name in enumerate(self.atoms)
+                    if i not in missingSet),
+                nextKnown)
+        steps = []
+        todo = list(missing)
+        while todo:
+            left = []
+            for i in todo:
+                atomName = self.atoms[i]
+                for candidate in self.candidates.get(atomName, ()):
+                    refs = candidate[0]
+                    if all(name in have[offset + 1] for offset, name in refs):
+                        steps.append((i, refs, self.value(candidate)))
+                        have[1].add(atomName)
+                        break
                 else:
-                    if pos and h1Cnt is not None and h2Cnt is not None:
-                        predH1Pos, predH2Pos = fix_cryst_wat(pos)
-                        (resiAtom[h1Cnt][2], resiAtom[h1Cnt][3],
-                         resiAtom[h1Cnt][4]) = predH1Pos
-                        (resiAtom[h2Cnt][2], resiAtom[h2Cnt][3],
-                         resiAtom[h2Cnt][4]) = predH2Pos
-
-            numMiss = lastNumMiss = 0
-            missAtoms = []
-
-            while True:
-                for atomCnt, atom in enumerate(resiAtom):
-                    atomNum, atomName, atomPosX, atomPosY, atomPosZ = atom
-
-                    if lastNumMiss == 0:
-                        atomType, atomChrg = atomDict[atomName]
-                        atomMass = ctopAtomMassDict[atomType]
-                        resiNameNumDict[resiNum][atomName] = atomNum
-                        atomList.append([atomNum, segName, resiNum, resiName,
-                                         atomName, atomType, atomChrg, atomMass])
-
-                    if atomPosX is not None: continue
-
-                    for ic in icList:
-                        pos = []
-
-                        if atomName == ic[3]:
-                            icNames = ic[:4]
-                            if icNames[2][0] == '*':
-                                icNames[2] = icNames[2][1:]
-
-                            for index, icName in enumerate(icNames[:3]):
-                                if icName[0] == '-':
-                                    if resCnt == 0: break
-                                    icName = icName[1:]
-                                    icNames[index] = icName
-                                    xres = pdbDataList[segCnt][1][resCnt - 1][2]
-                                elif icName[0] == '+':
-                                    if resCnt == last: break
-                                    icName = icName[1:]
-                                    icNames[index] = icName
-                                    xres = pdbDataList[segCnt][1][resCnt + 1][2]
-                                else:
-                                    xres = pdbDataList[segCnt][1][resCnt][2]
-
-                                for [num, name, posX, posY, posZ] in xres:
-                                    if icName == name and posX is not None:
-                                        pos.append([posX, posY, posZ])
-                                        break
-                                else:
-                                    break
-                            else:
-                                if ic[7] == 0.0:
-                                    anglKey = tuple(map(lambda x: atomDict[x][0],
-                                                        icNames[1:]))
-                                    if anglKey in cprmAnglDict:
-                                        ic[7] = cprmAnglDict[anglKey][1]
-                                    else:
-                                        print("Unknown %s-%s-%s, use 109 deg" %
-                                              anglKey, file=sys.stderr)
-                                        ic[7] = radians(109.0)
-                                if ic[8] == 0.0:
-                                    bondKey = tuple(map(lambda x: atomDict[x][0],
-                                                        icNames[2:]))
-                                    if bondKey in cprmBondDict:
-                                        ic[8] = cprmBondDict[bondKey][1]
-                                    else:
-                                        print("Unknown %s-%s, use 1 A" %
-                                              bondKey, file=sys.stderr)
-                                        ic[8] = 1.0
-                                val = (ic[6], ic[7], ic[8])
-                                break
-
-                        elif atomName == ic[0]:
-                            isImpr = False
-                            if ic[2][0] == '*':
-                                isImpr = True
-                                icNames = [ic[3], ic[1], ic[2][1:], ic[0]]
-                            else:
-                                icNames = ic[3::-1]
-
-                            for index, icName in enumerate(icNames[:3]):
-                                if icName[0] == '-':
-                                    if resCnt == 0: break
-                                    icName = icName[1:]
-                                    icNames[index] = icName
-                                    xres = pdbDataList[segCnt][1][resCnt - 1][2]
-                                elif icName[0] == '+':
-                                    if resCnt == last: break
-                                    icName = icName[1:]
-                                    icNames[index] = icName
-                                    xres = pdbDataList[segCnt][1][resCnt + 1][2]
-                                else:
-                                    xres = pdbDataList[segCnt][1][resCnt][2]
-
-                                for [num, name, posX, posY, posZ] in xres:
-                                    if icName == name and posX is not None:
-                                        pos.append([posX, posY, posZ])
-                                        break
-                                else:
-                                    break
-                            else:
-                                if ic[5] == 0.0:
-                                    anglKey = tuple(map(lambda x: atomDict[x][0],
-                                                        icNames[1:]))
-                                    if anglKey in cprmAnglDict:
-                                        ic[5] = cprmAnglDict[anglKey][1]
-                                    else:
-                                        print("Unknown %s-%s-%s, use 109 deg" %
-                                              anglKey, file=sys.stderr)
-                                        ic[5] = radians(109.0)
-                                if ic[4] == 0.0:
-                                    bondKey = tuple(map(lambda x: atomDict[x][0],
-                                                        icNames[2:]))
-                                    if bondKey in cprmBondDict:
-                                        ic[4] = cprmBondDict[bondKey][1]
-                                    else:
-                                        print("Unknown %s-%s, use 1 A" %
-                                              bondKey, file=sys.stderr)
-                                        ic[4] = 1.0
-                                if isImpr:
-                                    val = (-ic[6], ic[5], ic[4])
-                                else:
-                                    val = (ic[6], ic[5], ic[4])
-                                break
-                    else:
-                        numMiss += 1
-                        missAtoms.append((resiNum, resiName, atomNum, atomName))
-                        continue
+                    left.append(i)
+            if len(left) == len(todo):
+                break
+            todo = left
+
+        self.plans[key] = steps, todo
+        return steps, todo
+
+
+def place_missing_atoms(pdbDataList, batches):
+    """Give coordinates to the atoms planned by build_struct.
+
+    batches maps a depth to (atom index, reference indices, value)
+    steps; the atoms of one depth only refer to atoms of lower depths,
+    so each depth is placed with one call to place_atoms. Indices count
+    the atoms of pdbDataList from 0.
+    """
+    atoms = [atom for _, segDataList in pdbDataList
+             for _, _, resiAtom in segDataList for atom in resiAtom]
+    pos = numpy.array([atom[2:] for atom in atoms], dtype=numpy.float64)
+    placed = []
+    for depth in sorted(batches):
+        atomIdx, refIdx, vals = zip(*batches[depth])
+        refIdx = numpy.array(refIdx)
+        vals = numpy.array(vals, dtype=numpy.float64)
+        pos[list(atomIdx)] = place_atoms(
+            pos[refIdx[:, 0]], pos[refIdx[:, 1]], pos[refIdx[:, 2]],
+            vals[:, 0], vals[:, 1], vals[:, 2])
+        placed.extend(atomIdx)
+    for i, atomPos in zip(placed, pos[placed].tolist()):
+        atoms[i][2:] = atomPos
+
+
+def group_offsets(counts):
+    """Return 0, 1, ..., n - 1 for each n of counts, all in one array."""
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    total = counts.sum()
+    return numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts,
+                                              counts)
+
+
+def term_array(terms, size):
+    """Return bonded terms as an (n, size) int32 array of atom numbers."""
+    return numpy.asarray(terms, dtype=numpy.int32).reshape(-1, size)
+
+
+def sort_terms(terms):
+    """Sort terms by their first atom, keeping the order of ties."""
+    return terms[numpy.argsort(terms[:, 0], kind='mergesort')]
+
+
+class BondGraph(object):
+    """Bond connectivity stored as compressed sparse row arrays.
+
+    The neighbours of atom i are indices[indptr[i]:indptr[i + 1]], in the
+    order of the bonds. Atoms are numbered from 1 as in the PSF, so row 0
+    is empty. Angles, dihedrals and 1-4 pairs come out as int32 arrays
+    sorted by their first atom, and otherwise in the order of the bonds
+    they grow from.
+    """
+
+    def __init__(self, bonds, natom):
+        self.bonds = numpy.asarray(bonds, dtype=numpy.int32).reshape(-1, 2)
+        ends = self.bonds.ravel()
+        order = numpy.argsort(ends, kind='mergesort')
+        self.atoms = ends[order]
+        self.indices = self.bonds[:, ::-1].ravel()[order]
+        self.indptr = numpy.zeros(natom + 2, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(ends, minlength=natom + 1),
+                     out=self.indptr[1:])
+
+    def angles(self):
+        """Return every A-B-C with A and C bonded to B, A < C."""
+        entries = numpy.arange(len(self.indices))
+        count = self.indptr[self.atoms + 1] - 1 - entries
+        first = numpy.repeat(entries, count)
+        second = first + 1 + group_offsets(count)
+        atomA = self.indices[first]
+        atomC = self.indices[second]
+        return sort_terms(numpy.column_stack((
+            numpy.minimum(atomA, atomC), self.atoms[first],
+            numpy.maximum(atomA, atomC))))
+
+    def dihedrals(self):
+        """Return every A-B-C-D along the bonds B-C, A < D."""
+        atomB = self.bonds[:, 0]
+        atomC = self.bonds[:, 1]
+        degB = self.indptr[atomB + 1] - self.indptr[atomB]
+        degC = self.indptr[atomC + 1] - self.indptr[atomC]
+        bond = numpy.repeat(numpy.arange(len(self.bonds)), degB * degC)
+        offset = group_offsets(degB * degC)
+        atomA = self.indices[self.indptr[atomB[bond]] + offset // degC[bond]]
+        atomD = self.indices[self.indptr[atomC[bond]] + offset % degC[bond]]
+        atomB = atomB[bond]
+        atomC = atomC[bond]
+        keep = (atomA != atomC) & (atomB != atomD) & (atomA != atomD)
+        dihe = numpy.column_stack((atomA, atomB, atomC, atomD))[keep]
+        flip = dihe[:, 0] > dihe[:, 3]
+        dihe[flip] = dihe[flip, ::-1]
+        return sort_terms(dihe)
+
+    def pairs14(self, dihedrals=None):
+        """Return the distinct 1-4 pairs of the dihedrals, first < second.
+
+        Pairs that are also bonded or the ends of an angle, as in small
+        rings, are left out.
+        """
+        if dihedrals is None:
+            dihedrals = self.dihedrals()
+        size = numpy.int64(len(self.indptr))
+        ends = numpy.sort(dihedrals[:, ::3], axis=1).astype(numpy.int64)
+        keys = numpy.unique(ends[:, 0] * size + ends[:, 1])
+        angles = self.angles()
+        close = numpy.concatenate((
+            numpy.minimum(self.bonds[:, 0], self.bonds[:, 1]).astype(
+                numpy.int64) * size +
+            numpy.maximum(self.bonds[:, 0], self.bonds[:, 1]),
+            angles[:, 0].astype(numpy.int64) * size + angles[:, 2]))
+        keys = keys[~numpy.isin(keys, close)]
+        return numpy.column_stack((keys // size, keys % size)).astype(
+            numpy.int32)
+
+
+def build_plans(template, cprmDataList, cache):
+    """Return the BuildPlans of a residue template for a parameter set.
+
+    cache is a dict the caller keeps for one build, keyed by the id of
+    the template; the templates must stay alive while it is used.
+    """
+    plans = cache.get(id(template))
+    if plans is None:
+        plans = cache[id(template)] = BuildPlans(template, cprmDataList)
+    return plans
+
+
+def segment_templates(segCnt, segDataList, resiPatches, ctopResiDataDict,
+                      ctopPresDataDict, cache=None):
+    """Return the patched template of each residue of a segment.
+
+    cache is passed on to residue_template.
+    """
+    resiTemplates = []
+    last = len(segDataList) - 1
+    for resCnt, [_, resiName, _] in enumerate(segDataList):
+        patches = list(resiPatches.get((segCnt, resCnt), ()))
+        if resCnt == 0:
+            patchResi = ctopResiDataDict[resiName][5]['FIRS']
+            if patchResi != 'NONE':
+                patches.append((patchResi, 'FIRS'))
+        if resCnt == last:
+            patchResi = ctopResiDataDict[resiName][5]['LAST']
+            if patchResi != 'NONE':
+                patches.append((patchResi, 'LAST'))
+        resiTemplates.append(residue_template(
+            ctopResiDataDict, ctopPresDataDict, resiName, patches, cache))
+    return resiTemplates
+
+
+def build_segment(segment, resiTemplates, ctopAtomMassDict, cprmDataList,
+                  noCmap, planCache=None):
+    """Build one segment with its atoms numbered from 1.
+
+    The atoms of each residue are matched to its template, the missing
+    ones are placed, and the bonds, impropers and cross-terms within the
+    segment are expanded. planCache is passed on to build_plans. Returns
+    the new segment, its atom records and the three term arrays; exits
+    if an atom cannot be placed.
+    """
+    if planCache is None:
+        planCache = {}
+    segName, segDataList = segment
+    newDataList = []
+    atomCnt = 0
+    for resCnt, [resiNum, resiName, resiAtom] in enumerate(segDataList):
+        newDataList.append([resiNum, resiName, []])
 
-                    predPos = fix_miss_atom(pos, val)
-                    (pdbDataList[segCnt][1][resCnt][2][atomCnt][2],
-                     pdbDataList[segCnt][1][resCnt][2][atomCnt][3],
-                     pdbDataList[segCnt][1][resCnt][2][atomCnt][4]) = predPos
+        atomDict = resiTemplates[resCnt][0]
 
-                if numMiss == 0 or numMiss == lastNumMiss:
+        for atomName in atomDict:
+            atomCnt += 1
+            for pdbAtomList in resiAtom:
+                if atomName == pdbAtomList[1]:
+                    newAtom = pdbAtomList
+                    newAtom[0] = atomCnt
                     break
-                else:
-                    lastNumMiss = numMiss
-                    numMiss = 0
-                    missAtoms = []
-
-            if missAtoms:
-                for atom in missAtoms:
-                    print("Cannot predict coordinates for %d %s %d %s" % atom,
-                          file=sys.stderr)
-                sys.exit(1)
-
-    bondList = []
-    if doDisu:
-        do_disu_connect(epreInpDict['DISUBOND']["DISULIST"],
-                        pdbDataList, bondList)
-
-    for segName, segDataList in pdbDataList:
-        resiNameNumDict = segNameNumDict[segName]
-        nres = len(segDataList)
-        last = nres - 1
-        for i, resi in enumerate(segDataList):
-            resiNum = resi[0]
-            resiName = resi[1]
-
-            if nres == 1:
-                ctopBondList = ctopResiDataDict[segName + 'SINGLE'][1]
-            elif i == 0:
-                ctopBondList = ctopResiDataDict[segName + 'FIRST'][1]
-            elif i == last:
-                ctopBondList = ctopResiDataDict[segName + 'LAST'][1]
             else:
-                ctopBondList = ctopResiDataDict[resiName][1]
-
-            for bond in ctopBondList:
-                if bond in [['H1', 'H2'], ['H2', 'H1']]:
-                    print("omit the 'HT-HT' bond")
-                    continue
+                newAtom = [atomCnt, atomName, None, None, None]
+            newDataList[resCnt][2].append(newAtom)
 
-                if i != 0:
-                    prevNum = segDataList[i - 1][0]
-                if i != last:
-                    nextNum = segDataList[i + 1][0]
+    segDataList = newDataList
 
-                realBond = []
+    atomList = []
+    resiNameNumDict = {}
+    atomDepths = {}
+    batches = defaultdict(list)
+    resiAtomDicts = [dict((atom[1], atom) for atom in resiAtom)
+                     for _, _, resiAtom in segDataList]
+
+    nres = len(segDataList)
+    last = nres - 1
+    for resCnt, [resiNum, resiName, resiAtom] in enumerate(segDataList):
+        resiNameNumDict[resiNum] = {}
+
+        resList = resiTemplates[resCnt]
+        atomDict = resList[0]
+
+        for atomNum, atomName, _, _, _ in resiAtom:
+            atomType, atomChrg = atomDict[atomName]
+            atomMass = ctopAtomMassDict[atomType]
+            resiNameNumDict[resiNum][atomName] = atomNum
+            atomList.append([atomNum, segName, resiNum, resiName,
+                             atomName, atomType, atomChrg, atomMass])
 
-                for name in bond:
-                    if name[0] == '-':
-                        if i == 0: break
-                        realBond.append(resiNameNumDict[prevNum][name[1:]])
-                    elif name[0] == '+':
-                        if i == last: break
-                        realBond.append(resiNameNumDict[nextNum][name[1:]])
-                    else:
-                        realBond.append(resiNameNumDict[resiNum][name])
+        if len(resiAtom) == 3 and resiName in ('WAT', 'TIP3', 'HOH'):
+            pos = []
+            h1Cnt = h2Cnt = None
+            for atomCnt, atom in enumerate(resiAtom):
+                if atom[1] == 'OH2':
+                    pos = atom[2:]
+                elif atom[1] == 'H1':
+                    h1Cnt = atomCnt
+                    if atom[2] is not None: break
+                elif atom[1] == 'H2':
+                    h2Cnt = atomCnt
+                    if atom[2] is not None: break
                 else:
-                    bondList.append(realBond)
-
-    bondList.sort(key=lambda x: x[0])
+                    print("Unknown atom %s in water" % atom[1])
+            else:
+                if pos and h1Cnt is not None and h2Cnt is not None:
+                    predH1Pos, predH2Pos = fix_cryst_wat(pos)
+                    (resiAtom[h1Cnt][2], resiAtom[h1Cnt][3],
+                     resiAtom[h1Cnt][4]) = predH1Pos
+                    (resiAtom[h2Cnt][2], resiAtom[h2Cnt][3],
+                     resiAtom[h2Cnt][4]) = predH2Pos
+
+        missing = tuple(i for i, atom in enumerate(resiAtom)
+                        if atom[2] is None)
+        if not missing:
+            continue
 
-    atomAllBondList = [[] for _ in repeat(None, len(atomList) + 1)]
-    for bond in bondList:
-        atomAllBondList[bond[0]].append(bond[1])
-        atomAllBondList[bond[1]].append(bond[0])
+        # the previous residue is complete by now: its missing atoms
+        # are placed with the batches below or the build has stopped
+        plans = build_plans(resList, cprmDataList, planCache)
+        atomDicts = (resiAtomDicts[resCnt - 1] if resCnt != 0 else {},
+                     resiAtomDicts[resCnt],
+                     resiAtomDicts[resCnt + 1] if resCnt != last else {})
+        steps, unbuilt = plans.plan(
+            missing, frozenset(name for name in plans.prevRefs
+                               if name in atomDicts[0]),
+            plans.known(atomDicts[2], plans.nextRefs))
+
+        if unbuilt:
+            for atomCnt in unbuilt:
+                print("Cannot predict coordinates for %d %s %d %s" %
+                      (resiNum, resiName, resiAtom[atomCnt][0],
+                       resiAtom[atomCnt][1]), file=sys.stderr)
+            sys.exit(1)
+
+        for atomCnt, refs, val in steps:
+            atomIdx = resiAtom[atomCnt][0] - 1
+            refIdx = [atomDicts[offset + 1][name][0] - 1
+                      for offset, name in refs]
+            depth = 1 + max(atomDepths.get(i, 0) for i in refIdx)
+            atomDepths[atomIdx] = depth
+            batches[depth].append((atomIdx, refIdx, val))
+
+    if batches:
+        place_missing_atoms([[segName, segDataList]], batches)
 
-    anglList = []
-    for atomB, atomBList in enumerate(atomAllBondList):
-        if atomBList:
-            for atomA, atomC in combinations(atomBList, 2):
-                if atomA < atomC:
-                    anglList.append([atomA, atomB, atomC])
+    bondList = []
+    for i, resi in enumerate(segDataList):
+        resiNum = resi[0]
+        ctopBondList = resiTemplates[i][1]
+
+        for bond in ctopBondList:
+            if bond in [['H1', 'H2'], ['H2', 'H1']]:
+                print("omit the 'HT-HT' bond")
+                continue
+
+            if i != 0:
+                prevNum = segDataList[i - 1][0]
+            if i != last:
+                nextNum = segDataList[i + 1][0]
+
+            realBond = []
+
+            for name in bond:
+                if name[0] == '-':
+                    if i == 0: break
+                    realBond.append(resiNameNumDict[prevNum][name[1:]])
+                elif name[0] == '+':
+                    if i == last: break
+                    realBond.append(resiNameNumDict[nextNum][name[1:]])
                 else:
-                    anglList.append([atomC, atomB, atomA])
-
-    anglList.sort(key=lambda x: x[0])
-
-    diheList = []
-    for atomB, atomC in bondList:
-        atomBList = atomAllBondList[atomB]
-        atomCList = atomAllBondList[atomC]
-        if atomBList and atomCList:
-            for atomA, atomD in product(atomBList, atomCList):
-                if atomA != atomC and atomB != atomD and atomA != atomD:
-                    if atomA < atomD:
-                        diheList.append([atomA, atomB, atomC, atomD])
-                    else:
-                        diheList.append([atomD, atomC, atomB, atomA])
-
-    diheList.sort(key=lambda x: x[0])
+                    realBond.append(resiNameNumDict[resiNum][name])
+            else:
+                bondList.append(realBond)
 
     imprList = []
-    for segName, segDataList in pdbDataList:
-        resiNameNumDict = segNameNumDict[segName]
-        nres = len(segDataList)
-        last = nres - 1
-        for i, resi in enumerate(segDataList):
-            resiNum = resi[0]
-            resiName = resi[1]
-
-            if nres == 1:
-                ctopImprList = ctopResiDataDict[segName + 'SINGLE'][2]
-            elif i == 0:
-                ctopImprList = ctopResiDataDict[segName + 'FIRST'][2]
-            elif i == last:
-                ctopImprList = ctopResiDataDict[segName + 'LAST'][2]
+    for i, resi in enumerate(segDataList):
+        resiNum = resi[0]
+        ctopImprList = resiTemplates[i][2]
+
+        for impr in ctopImprList:
+
+            if i != 0:
+                prevNum = segDataList[i - 1][0]
+            if i != last:
+                nextNum = segDataList[i + 1][0]
+
+            realImpr = []
+
+            for name in impr:
+                if name[0] == '-':
+                    if i == 0: break
+                    realImpr.append(resiNameNumDict[prevNum][name[1:]])
+                elif name[0] == '+':
+                    if i == last: break
+                    realImpr.append(resiNameNumDict[nextNum][name[1:]])
+                else:
+                    realImpr.append(resiNameNumDict[resiNum][name])
             else:
-                ctopImprList = ctopResiDataDict[resiName][2]
+                imprList.append(realImpr)
 
-            for impr in ctopImprList:
+    cmapList = []
+    for i, resi in enumerate(segDataList):
+        if noCmap: break
+        resiNum = resi[0]
+        ctopCmapList = resiTemplates[i][3]
 
-                if i != 0:
-                    prevNum = segDataList[i - 1][0]
-                if i != last:
-                    nextNum = segDataList[i + 1][0]
+        for cmap in ctopCmapList:
 
-                realImpr = []
+            if i != 0:
+                prevNum = segDataList[i - 1][0]
+            if i != last:
+                nextNum = segDataList[i + 1][0]
 
-                for name in impr:
-                    if name[0] == '-':
-                        if i == 0: break
-                        realImpr.append(resiNameNumDict[prevNum][name[1:]])
-                    elif name[0] == '+':
-                        if i == last: break
-                        realImpr.append(resiNameNumDict[nextNum][name[1:]])
-                    else:
-                        realImpr.append(resiNameNumDict[resiNum][name])
+            realCmap = []
+
+            for name in cmap:
+                if name[0] == '-':
+                    if i == 0: break
+                    realCmap.append(resiNameNumDict[prevNum][name[1:]])
+                elif name[0] == '+':
+                    if i == last: break
+                    realCmap.append(resiNameNumDict[nextNum][name[1:]])
                 else:
-                    imprList.append(realImpr)
+                    realCmap.append(resiNameNumDict[resiNum][name])
+            else:
+                cmapList.append(realCmap)
 
-    imprList.sort(key=lambda x: x[0])
+    return ([segName, segDataList], atomList, term_array(bondList, 2),
+            term_array(imprList, 4), term_array(cmapList, 8))
 
-    cmapList = []
-    noCmap = epreInpDict['NOCMAP']
-    for segName, segDataList in pdbDataList:
-        if noCmap: break
-        resiNameNumDict = segNameNumDict[segName]
-        nres = len(segDataList)
-        last = nres - 1
-        for i, resi in enumerate(segDataList):
-            resiNum = resi[0]
-            resiName = resi[1]
-
-            if nres == 1:
-                ctopCmapList = ctopResiDataDict[segName + 'SINGLE'][3]
-            elif i == 0:
-                ctopCmapList = ctopResiDataDict[segName + 'FIRST'][3]
-            elif i == last:
-                ctopCmapList = ctopResiDataDict[segName + 'LAST'][3]
-            else:
-                ctopCmapList = ctopResiDataDict[resiName][3]
 
-            for cmap in ctopCmapList:
+# the arguments of build_segment while a pool of forked workers runs, so
+# that templates and parameters are shared with them instead of pickled
+_segmentJob = None
 
-                if i != 0:
-                    prevNum = segDataList[i - 1][0]
-                if i != last:
-                    nextNum = segDataList[i + 1][0]
 
-                realCmap = []
+def _build_segment_job(segCnt):
+    """Run build_segment for segment segCnt of _segmentJob in a worker.
+
+    Returns what it printed to stdout and stderr, and the segment or None
+    if the build stopped.
+    """
+    pdbDataList, segTemplates, args = _segmentJob
+    out, err = StringIO(), StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err
+    try:
+        segment = build_segment(pdbDataList[segCnt], segTemplates[segCnt],
+                                *args)
+    except SystemExit:
+        segment = None
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return out.getvalue(), err.getvalue(), segment
+
+
+def build_segments(pdbDataList, segTemplates, nproc, *args):
+    """Return build_segment(segment, templates, *args) for each segment.
+
+    With nproc above 1 (0 for one per CPU) the segments are built by a
+    pool of that many forked processes, largest first, and what each
+    printed is passed on in segment order. Without fork they are built
+    here.
+    """
+    global _segmentJob
+    if nproc == 0:
+        nproc = multiprocessing.cpu_count()
+    nproc = min(nproc, len(pdbDataList))
+    if nproc < 2 or not hasattr(os, 'fork'):
+        return [build_segment(segment, resiTemplates, *args)
+                for segment, resiTemplates in zip(pdbDataList, segTemplates)]
+
+    order = sorted(range(len(pdbDataList)),
+                   key=lambda x: -sum(len(resList[0])
+                                      for resList in segTemplates[x]))
+    getContext = getattr(multiprocessing, 'get_context', None)
+    _segmentJob = (pdbDataList, segTemplates, args)
+    try:
+        pool = (getContext('fork') if getContext else
+                multiprocessing).Pool(nproc)
+        try:
+            results = dict(zip(order, pool.map(_build_segment_job, order, 1)))
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _segmentJob = None
+
+    segments = []
+    for segCnt in range(len(pdbDataList)):
+        out, err, segment = results[segCnt]
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        if segment is None:
+            sys.exit(1)
+        segments.append(segment)
+    return segments
 
-                for name in cmap:
-                    if name[0] == '-':
-                        if i == 0: break
-                        realCmap.append(resiNameNumDict[prevNum][name[1:]])
-                    elif name[0] == '+':
-                        if i == last: break
-                        realCmap.append(resiNameNumDict[nextNum][name[1:]])
-                    else:
-                        realCmap.append(resiNameNumDict[resiNum][name])
-                else:
-                    cmapList.append(realCmap)
 
-    cmapList.sort(key=lambda x: x[0])
+def build_struct(ctopDataList, pdbDataList, epreInpDict, cprmDataList):
+    ctopAtomMassDict, ctopResiDataDict, ctopPresDataDict = ctopDataList
+    if not isinstance(cprmDataList, ParameterSet):
+        cprmDataList = ParameterSet(cprmDataList)
+
+    patchStmts = list(epreInpDict['PATCH'])
+    if epreInpDict['DISUBOND']['DODISU']:
+        patchStmts += do_disu(epreInpDict, pdbDataList)
+    resiPatches, patchLinks = patch_sites(patchStmts, pdbDataList,
+                                          ctopPresDataDict)
+
+    # patched templates and build plans are shared within this build only
+    templateCache = {}
+    segTemplates = [segment_templates(segCnt, segDataList, resiPatches,
+                                      ctopResiDataDict, ctopPresDataDict,
+                                      templateCache)
+                    for segCnt, [_, segDataList] in enumerate(pdbDataList)]
+
+    segments = build_segments(pdbDataList, segTemplates,
+                              epreInpDict.get('NPROC', 1), ctopAtomMassDict,
+                              cprmDataList, epreInpDict['NOCMAP'], {})
+
+    # segments are numbered from 1 each; shift them by the atoms before
+    segAtomCounts = [len(segment[1]) for segment in segments]
+    offsets = (numpy.cumsum(segAtomCounts) - segAtomCounts).tolist()
 
-    if doDisu:
-        do_disu_rename(pdbDataList, atomList)
+    pdbDataList = []
+    atomList = []
+    segNameNumDict = {}
+    termLists = [], [], []
+    for offset, segment in zip(offsets, segments):
+        (segName, segDataList), segAtomList = segment[:2]
+        resiNameNumDict = segNameNumDict[segName] = {}
+        for resiNum, _, resiAtom in segDataList:
+            resiNameNumDict[resiNum] = {}
+            for atom in resiAtom:
+                atom[0] += offset
+                resiNameNumDict[resiNum][atom[1]] = atom[0]
+        for atom in segAtomList:
+            atom[0] += offset
+        pdbDataList.append([segName, segDataList])
+        atomList.extend(segAtomList)
+        for terms, segTerms in zip(termLists, segment[2:]):
+            terms.append(segTerms + numpy.int32(offset))
+
+    bondList, imprList, cmapList = [
+        sort_terms(numpy.concatenate([term_array(links, size)] + terms))
+        for links, size, terms in zip(
+            link_patches(patchLinks, ctopPresDataDict, pdbDataList,
+                         segNameNumDict), (2, 4, 8), termLists)]
+
+    bondGraph = BondGraph(bondList, len(atomList))
+    anglList = bondGraph.angles()
+    diheList = bondGraph.dihedrals()
 
     topList = [atomList, bondList, anglList, diheList, imprList, cmapList]
 
@@ -1538,37 +3302,52 @@ def fix_cryst_wat(pos, val=(radians(104.52), 0.9572)):
     return (h1x, h1y, h1z), (h2x, h2y, h2z)
 
 
-def fix_miss_atom(pos, val):
-    ri, rj, rk = pos
-    tors_ijkl, angl_jkl, bond_kl = val
-    rjk = numpy.subtract(rk, rj)
-    lenXpi = 1.0 / numpy.linalg.norm(rjk)
-    xp = rjk * lenXpi
-    rji = numpy.subtract(ri, rj)
-    djii = 1.0 / numpy.linalg.norm(rji)
-    rji *= djii
+def place_atoms(ri, rj, rk, tors, angl, bond):
+    """Place atoms from internal coordinates, many at once (NeRF).
+
+    Atom l is put at bond from k, at angle j-k-l and at dihedral i-j-k-l.
+    ri, rj and rk are (n, 3) arrays of reference positions and tors,
+    angl and bond arrays of n values in radians and A. Returns the (n, 3)
+    positions.
+    """
+    rjk = rk - rj
+    xp = rjk / numpy.sqrt(numpy.einsum('ij,ij->i', rjk, rjk))[:, None]
+    rji = ri - rj
+    rji /= numpy.sqrt(numpy.einsum('ij,ij->i', rji, rji))[:, None]
     zp = numpy.cross(xp, rji)
-    lenZpi = 1.0 / numpy.linalg.norm(zp)
-    zp *= lenZpi
+    zp /= numpy.sqrt(numpy.einsum('ij,ij->i', zp, zp))[:, None]
     yp = numpy.cross(zp, xp)
-    rlpx = -bond_kl * cos(angl_jkl)
-    tmp = bond_kl * sin(angl_jkl)
-    rlpy = tmp * cos(tors_ijkl)
-    rlpz = tmp * sin(tors_ijkl)
-    rl = xp * rlpx
-    rl += yp * rlpy
-    rl += zp * rlpz
+    rlpx = -bond * numpy.cos(angl)
+    tmp = bond * numpy.sin(angl)
+    rl = xp * rlpx[:, None]
+    rl += yp * (tmp * numpy.cos(tors))[:, None]
+    rl += zp * (tmp * numpy.sin(tors))[:, None]
     rl += rk
+    return rl
 
-    return rl.tolist()
 
+_solventBoxes = {}
 
-def add_wat(epreInpDict, sluPos):
-    try:
-        import cPickle as p
-    except ImportError:
-        import pickle as p
 
+def load_solvent_box(filename):
+    """Return the coordinates in a solvent coordinate file as an array.
+
+    The array is kept for as long as the file is unchanged, so a process
+    building many systems reads each solvent box once.
+    """
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    stamp = (stat.st_mtime, stat.st_size)
+    if key in _solventBoxes and _solventBoxes[key][0] == stamp:
+        return _solventBoxes[key][1]
+    with ropen(filename, 'rb') as inf:
+        watPos = numpy.array(pickle.load(inf))
+    watPos.flags.writeable = False
+    _solventBoxes[key] = (stamp, watPos)
+    return watPos
+
+
+def add_wat(epreInpDict, sluPos):
     watInfoDict = {
         'TIP3P': {
             'RESNAME': 'WAT',
@@ -1608,8 +3387,7 @@ def add_wat(epreInpDict, sluPos):
     # with open(fn, 'rb') as inf:
     #     watPos = p.load(inf)
 
-    with open(watPosFile, 'rb') as inf:
-        watPos = p.load(inf)
+    watPosArray = load_solvent_box(watPosFile)
     print("Read solvent coordinate file", watPosFile)
 
 
@@ -1630,7 +3408,6 @@ def add_wat(epreInpDict, sluPos):
     nbox = map(lambda x: int(math.ceil(x * watBoxLeni)), boxLen)
 
     watBox = []
-    watPosArray = numpy.array(watPos)
     checkOutsideList = []
     checkOverlapList = []
     nboxX, nboxY, nboxZ = nbox
@@ -2498,6 +4275,21 @@ def add_ion(epreInpDict, atomList, sluPos, watPos, boxInfo):
     return watPos, ionPosList
 
 
+def solv_terms(termInfo, molStarts):
+    """Repeat one molecule's terms for molecules starting after molStarts."""
+    terms = term_array(termInfo, len(termInfo[0]))
+    return (terms[None] + molStarts[:, None, None].astype(numpy.int32)
+            ).reshape(-1, terms.shape[1])
+
+
+def add_solv_top(topList, watDataList):
+    """Return topList with the atoms, bonds and angles of the solvent."""
+    return ([topList[0] + watDataList[1],
+             numpy.concatenate((topList[1], watDataList[2])),
+             numpy.concatenate((topList[2], watDataList[3]))] +
+            list(topList[3:]))
+
+
 def build_solv_top(epreInpDict, watPos, ionPosList, atomNumAdd, resNumAdd):
     watInfoDict = {
         'TIP3P': {
@@ -2536,10 +4328,7 @@ def build_solv_top(epreInpDict, watPos, ionPosList, atomNumAdd, resNumAdd):
     atomList = []
     nmol = 0
 
-    if watPos is None or watPos == []:
-        bondList = []
-        anglList = []
-    else:
+    if watPos is not None and watPos != []:
         for i, box in enumerate(watPos):
             if len(watPos) == 1:
                 segName = segNameWat
@@ -2564,12 +4353,9 @@ def build_solv_top(epreInpDict, watPos, ionPosList, atomNumAdd, resNumAdd):
                                      atomName, atomType, atomChrg, atomMass])
             pdbDataList.append(newSeg)
 
-        molLen = len(atomParmList)
-        bondList = [map(lambda x: x + atomNumAdd + i * molLen, bond)
-                    for i in range(nmol) for bond in bondInfo]
-        anglList = [map(lambda x: x + atomNumAdd + i * molLen, angl)
-                    for i in range(nmol) for angl in anglInfo]
-
+    molStarts = atomNumAdd + numpy.arange(nmol) * len(atomParmList)
+    bondList = solv_terms(bondInfo, molStarts)
+    anglList = solv_terms(anglInfo, molStarts)
 
     segNameIon = epreInpDict['ADDION']['SEGNAME']
     resNum = 0
@@ -2599,6 +4385,25 @@ def build_solv_top(epreInpDict, watPos, ionPosList, atomNumAdd, resNumAdd):
     return pdbDataList, atomList, bondList, anglList
 
 
+def write_fields(write, values, fmt, perLine, eol='\n'):
+    """Write values with fmt, perLine of them to a line.
+
+    values may be an array of any shape and is read in order.  Every
+    line ends with eol, the last one too; nothing is written for no
+    values.
+    """
+    values = numpy.ravel(values)
+    step = perLine * 4096
+    for start in range(0, len(values), step):
+        chunk = values[start:start + step].tolist()
+        nfull = len(chunk) // perLine * perLine
+        text = ((fmt * perLine + eol) * (nfull // perLine) %
+                tuple(chunk[:nfull]))
+        if nfull < len(chunk):
+            text += (fmt * (len(chunk) - nfull) + eol) % tuple(chunk[nfull:])
+        write(text)
+
+
 def write_psf(filename, topList, epreInpDict):
     atomList, bondList, anglList, diheList, imprList, cmapList = topList
     psfFile = wopen(filename)
@@ -2606,7 +4411,7 @@ def write_psf(filename, topList, epreInpDict):
     print("Write X-PLOR/NAMD formatted PSF file", filename)
 
     noCmap = epreInpDict['NOCMAP']
-    hasCmap = True if cmapList else False
+    hasCmap = len(cmapList) > 0
     psfFile.write('PSF\n\n' if noCmap or not hasCmap else 'PSF CMAP\n\n')
     psfFile.write('%8d !NTITLE\n' % 1)
     psfFile.write(' REMARKS PSF file generated by MDBuilder v1.0 on %s\n\n' %
@@ -2621,45 +4426,15 @@ def write_psf(filename, topList, epreInpDict):
                              atomName, atomType, atomChrg, atomMass, 0))
     psfFile.write('\n')
 
-    nbond = len(bondList)
-    psfFile.write('%8d !NBOND: bonds\n' % nbond)
-    for i, bond in enumerate(bondList):
-        bond = ' %7d %7d' % tuple(bond)
-        if (i + 1) % 4 == 0 and i != nbond - 1:
-            psfFile.write(bond + '\n')
-        else:
-            psfFile.write(bond)
-    psfFile.write('\n\n')
-
-    nangl = len(anglList)
-    psfFile.write('%8d !NTHETA: angles\n' % nangl)
-    for i, angl in enumerate(anglList):
-        angl = ' %7d %7d %7d' % tuple(angl)
-        if (i + 1) % 3 == 0 and i != nangl - 1:
-            psfFile.write(angl + '\n')
-        else:
-            psfFile.write(angl)
-    psfFile.write('\n\n')
-
-    ndihe = len(diheList)
-    psfFile.write('%8d !NPHI: dihedrals\n' % ndihe)
-    for i, dihe in enumerate(diheList):
-        dihe = ' %7d %7d %7d %7d' % tuple(dihe)
-        if (i + 1) % 2 == 0 and i != ndihe - 1:
-            psfFile.write(dihe + '\n')
-        else:
-            psfFile.write(dihe)
-    psfFile.write('\n\n')
-
-    nimpr = len(imprList)
-    psfFile.write('%8d !NIMPHI: impropers\n' % nimpr)
-    for i, impr in enumerate(imprList):
-        impr = ' %7d %7d %7d %7d' % tuple(impr)
-        if (i + 1) % 2 == 0 and i != nimpr - 1:
-            psfFile.write(impr + '\n')
-        else:
-            psfFile.write(impr)
-    psfFile.write('\n\n')
+    sections = [(bondList, 2, 4, 'NBOND: bonds'),
+                (anglList, 3, 3, 'NTHETA: angles'),
+                (diheList, 4, 2, 'NPHI: dihedrals'),
+                (imprList, 4, 2, 'NIMPHI: impropers')]
+    for terms, size, perLine, title in sections:
+        terms = term_array(terms, size)
+        psfFile.write('%8d !%s\n' % (len(terms), title))
+        write_fields(psfFile.write, terms, ' %7d', size * perLine)
+        psfFile.write('\n' if len(terms) else '\n\n')
 
     psfFile.write('%8d !NDON: donors\n' % 0)
     psfFile.write('\n\n')
@@ -2669,13 +4444,9 @@ def write_psf(filename, topList, epreInpDict):
 
     natom = len(atomList)
     psfFile.write('%8d !NNB\n\n' % 0)
-    for i in range(natom):
-        nb = '%8d' % 0
-        if (i + 1) % 8 == 0 and i != natom - 1:
-            psfFile.write(nb + '\n')
-        else:
-            psfFile.write(nb)
-    psfFile.write('\n\n')
+    write_fields(psfFile.write, numpy.zeros(natom, dtype=numpy.int32),
+                 '%8d', 8)
+    psfFile.write('\n' if natom else '\n\n')
 
     psfFile.write('%8d %7d !NGRP\n' % (1, 0))
     psfFile.write('%8d%8d%8d\n' % (0, 0, 0))
@@ -2684,8 +4455,7 @@ def write_psf(filename, topList, epreInpDict):
     if not noCmap and hasCmap:
         ncmap = len(cmapList)
         psfFile.write('%8d !NCRTERM: cross-terms\n' % ncmap)
-        for i, cmap in enumerate(cmapList):
-            psfFile.write(' %7d %7d %7d %7d %7d %7d %7d %7d\n' % tuple(cmap))
+        write_fields(psfFile.write, cmapList, ' %7d', 8)
         psfFile.write('\n')
 
     psfFile.close()
@@ -2693,8 +4463,13 @@ def write_psf(filename, topList, epreInpDict):
 
 def write_prmtop(filename, topTitles, topList, prmList, title=None,
                  isNPT=False, version='12', format='unix'):
-    atomList, bondList, anglList, diheList, imprList, cmapList = topList
-    bondPrm, anglPrm, ubPrm, dihePrm, imprPrm, cmapPrm, nbndPrm, nb14Prm = prmList
+    atomList = topList[0]
+    bondList, anglList, diheList, imprList, cmapList = [
+        term_array(terms, size)
+        for terms, size in zip(topList[1:], TOP_TERM_SIZES)]
+    if not isinstance(prmList, ParameterSet):
+        prmList = ParameterSet(prmList)
+    nbndPrm, nb14Prm, nbfixPrm = prmList[6:]
     prmtopFile = wopen(filename, 'wb')
 
     print("Write AMBER parameter/topology file", filename)
@@ -2716,7 +4491,8 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     (atomNums, segNames, resNums, resNames, atomNames,
      atomTypes, atomChrgs, atomMasses) = zip(*atomList)
 
-    isH = [0.1 < i < 2.0 for i in atomMasses]
+    masses = numpy.array(atomMasses)
+    isH = (masses > 0.1) & (masses < 2.0)
 
     natom = len(atomList)
     ifbox = 1 if isNPT else 0
@@ -2734,19 +4510,22 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
             lastResNum, lastResName, lastSegName = resNum, resName, segName
     nres = len(resList)
 
-    exclList = OrderedDict()
-    for i in range(1, natom + 1):
-        exclList[i] = [0]
-    for i in bondList:
-        exclList[min(i)].append(max(i))
-    for i in anglList:
-        exclList[min(i[::2])].append(max(i[::2]))
-    for i in diheList:
-        exclList[min(i[::3])].append(max(i[::3]))
-    for i, j in exclList.items():
-        exclList[i] = sorted(set(j))
-
-    nnb = sum(len(i) - 1 if len(i) > 1 else 1 for _, i in exclList.items())
+    # the excluded partners of each atom are the larger atoms of its 1-2,
+    # 1-3 and 1-4 pairs; an atom without any lists a single 0
+    exclPairs = numpy.concatenate((
+        bondList, anglList[:, ::2],
+        BondGraph(bondList, natom).pairs14(diheList))).astype(numpy.int64)
+    exclPairs.sort(axis=1)
+    exclKeys = numpy.unique(exclPairs[:, 0] * (natom + 1) + exclPairs[:, 1])
+    exclAtoms = exclKeys // (natom + 1)
+    exclCount = numpy.bincount(exclAtoms, minlength=natom + 1)[1:]
+    numExcl = numpy.maximum(exclCount, 1)
+    exclStart = numpy.cumsum(numExcl) - numExcl
+    keyStart = numpy.cumsum(exclCount) - exclCount
+    exclList = numpy.zeros(numExcl.sum(), dtype=numpy.int64)
+    exclList[exclStart[exclAtoms - 1] + numpy.arange(len(exclKeys)) -
+             keyStart[exclAtoms - 1]] = exclKeys % (natom + 1)
+    nnb = len(exclList)
 
     startAtomNum = [i for _, i in resList.items()]
     stopAtomNum = startAtomNum[1:] + [natom]
@@ -2761,185 +4540,110 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     ntype = len(utypes)
     natyp = ntype
 
-    ubonds = OrderedDict()
-    for i, j in enumerate(bondList):
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in ubonds:
-            ubonds[key].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in ubonds:
-            ubonds[key].append(i)
-            continue
-        ubonds[key] = [i]
+    typeNames = list(utypes)
+    typeIds = numpy.empty(natom, dtype=numpy.int32)
+    for i, j in enumerate(utypes.values()):
+        typeIds[j] = i
+
+    def term_ids(kind, termList):
+        """Return the parameter id of each term, looked up once for each
+        combination of atom types."""
+        if not len(termList):
+            return numpy.zeros(0, dtype=numpy.int64)
+        typeRows, inverse = numpy.unique(typeIds[termList - 1], axis=0,
+                                         return_inverse=True)
+        ids = numpy.array([prmList.term_id(kind, tuple(typeNames[x]
+                                                       for x in row))
+                           for row in typeRows.tolist()])
+        return ids[inverse.reshape(-1)]
+
+    def unique_terms(kind, termList, name, default):
+        """Number the parameters used by termList from 1, in order of first
+        use. Returns the parameter values and the number of each term."""
+        termIds = term_ids(kind, termList)
+        uids, first, inverse = numpy.unique(termIds, return_index=True,
+                                            return_inverse=True)
+        order = numpy.argsort(first, kind='mergesort')
+        termIndex = numpy.empty(len(uids), dtype=numpy.int32)
+        termIndex[order] = numpy.arange(1, len(uids) + 1)
+        uterms = uids[order].tolist()
+        uvalues = []
+        for termId in uterms:
+            value = prmList.values[termId]
+            if value is None:
+                perr("Unknown " + name, prmList.types[termId])
+                value = default
+            uvalues.append(value)
+        return uterms, uvalues, termIndex[inverse.reshape(-1)]
+
+    _, ubonds, ubondList = unique_terms('BOND', bondList, 'bond', (0.0, 0.0))
     nubnd = len(ubonds)
 
-    nbond = len(bondList)
-    ubondList = [None] * nbond
-    for i, j in enumerate(ubonds.items()):
-        for k in j[1]:
-            ubondList[k] = i + 1
-    bonhaList = [list(map(lambda x: (x - 1) * 3, i)) for i in bondList]
-    bonhaList = [j + [ubondList[i]] for i, j in enumerate(bonhaList)]
-    bonhList = [i for i in bonhaList if any(isH[j // 3] for j in i[:2])]
+    bonhaList = numpy.column_stack(((bondList - 1) * 3, ubondList))
+    hasH = isH[bondList - 1].any(axis=1)
+    bonhList = bonhaList[hasH]
     nbonh = len(bonhList)
-    bonaList = [i for i in bonhaList if not any(isH[j // 3] for j in i[:2])]
+    bonaList = bonhaList[~hasH]
     mbona = len(bonaList)
     nbona = mbona
 
-    uangls = OrderedDict()
-    for i, j in enumerate(anglList):
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in uangls:
-            uangls[key].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in uangls:
-            uangls[key].append(i)
-            continue
-        uangls[key] = [i]
+    _, uangls, uanglList = unique_terms('ANGL', anglList, 'angle', (0.0, 0.0))
     nuang = len(uangls)
 
-    nangl = len(anglList)
-    uanglList = [None] * nangl
-    for i, j in enumerate(uangls.items()):
-        for k in j[1]:
-            uanglList[k] = i + 1
-    anghaList = [list(map(lambda x: (x - 1) * 3, i)) for i in anglList]
-    anghaList = [j + [uanglList[i]] for i, j in enumerate(anghaList)]
-    anghList = [i for i in anghaList if any(isH[j // 3] for j in i[:3])]
+    anghaList = numpy.column_stack(((anglList - 1) * 3, uanglList))
+    hasH = isH[anglList - 1].any(axis=1)
+    anghList = anghaList[hasH]
     nangh = len(anghList)
-    angaList = [i for i in anghaList if not any(isH[j // 3] for j in i[:3])]
+    angaList = anghaList[~hasH]
     manga = len(angaList)
     nanga = manga
 
-    ubList = []
-    for i in anglList:
-        atoms = list(map(lambda x: x - 1, i))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in ubPrm:
-            ubList.append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in ubPrm:
-            ubList.append(i)
-            continue
-
-    uubs = OrderedDict()
-    for i, j in enumerate(ubList):
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in uubs:
-            uubs[key].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in uubs:
-            uubs[key].append(i)
-            continue
-        uubs[key] = [i]
-
-    ndihe = len(diheList)
-    i = 0
-    while i < ndihe:
-        j = diheList[i]
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in dihePrm:
-            key2 = key
-        elif key[::-1] in dihePrm:
-            key2 = key[::-1]
-        elif ('X', key[1], key[2], 'X') in dihePrm:
-            key2 = ('X', key[1], key[2], 'X')
-        elif ('X', key[2], key[1], 'X') in dihePrm:
-            key2 = ('X', key[2], key[1], 'X')
-        else:
-            perr("Unknown dihedral %s" % key)
-        inc = len(dihePrm[key2]) - 1
-        if inc > 0:
-            ndihe += inc
-            for k in range(inc):
-                i += 1
-                if j[2] != 0:
-                    diheList.insert(i, [j[0], j[1], -j[2], j[3]])
-                else:
-                    diheList.insert(i, [j[0], -j[1], j[2], j[3]])
-        i += 1
-
-    udihes = OrderedDict()
-    for i, j in enumerate(diheList):
-        atoms = list(map(lambda x: int(math.copysign(abs(x) - 1, x)), j))
-        key = tuple(map(lambda x: atomTypes[abs(x)], atoms))
-        if key in udihes:
-            udihes[key][0].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[abs(x)], atoms[::-1]))
-        if key in udihes:
-            udihes[key][0].append(i)
-            continue
-        udihes[key] = [[i], None]
-
-    for key, val in udihes.items():
-        if key in dihePrm:
-            key2 = key
-        elif key[::-1] in dihePrm:
-            key2 = key[::-1]
-        elif ('X', key[1], key[2], 'X') in dihePrm:
-            key2 = ('X', key[1], key[2], 'X')
-        elif ('X', key[2], key[1], 'X') in dihePrm:
-            key2 = ('X', key[2], key[1], 'X')
-        else:
-            perr("Unknown dihedral %s" % key)
-        val[1] = len(dihePrm[key2])
-
-    nudih = sum(val[1] for key, val in udihes.items())
-
-    udiheList = [None] * ndihe
-    cnt = 1
-    for i, j in udihes.items():
-        if j[1] == 1:
-            for k in j[0]:
-                udiheList[k] = cnt
-        else:
-            for k in j[0][::j[1]]:
-                for l in range(j[1]):
-                    udiheList[k + l] = cnt + l
-        cnt += j[1]
-
-    dihhaList = [list(map(lambda x: int(math.copysign((abs(x) - 1) * 3, x)), i)) for i in diheList]
-    dihhaList = [j + [udiheList[i]] for i, j in enumerate(dihhaList)]
-    dihhList = [i for i in dihhaList if any(isH[abs(j) // 3] for j in i[:4])]
+    ubIds = term_ids('UB', anglList)
+    hasUb = numpy.array([value is not None for value in prmList.values],
+                        dtype=bool)
+    ubList = anglList[hasUb[ubIds]]
+    _, uubs, uubList = unique_terms('UB', ubList, 'UB angle', (0.0, 0.0))
+
+    # a dihedral with several terms is written once per term, the copies
+    # with a negative third atom so that its 1-4 pair is counted only once
+    _, udihes, dihIndex = unique_terms('DIHE', diheList, 'dihedral',
+                                            [(0.0, 1, 0.0)])
+    udihStart = []
+    nudih = 0
+    for val in udihes:
+        udihStart.append(nudih + 1)
+        nudih += len(val)
+
+    nterm = numpy.array([len(val) for val in udihes],
+                        dtype=numpy.int64)[dihIndex - 1]
+    dihCopy = group_offsets(nterm)
+    dihhaList = numpy.repeat((diheList - 1) * 3, nterm, axis=0)
+    dihhaList[dihCopy > 0, 2] *= -1
+    dihhaList = numpy.column_stack((
+        dihhaList, numpy.array(udihStart, dtype=numpy.int64)[
+            numpy.repeat(dihIndex - 1, nterm)] + dihCopy))
+    hasH = numpy.repeat(isH[diheList - 1].any(axis=1), nterm)
+    dihhList = dihhaList[hasH]
+    dihaList = dihhaList[~hasH]
     ndihh = len(dihhList)
-    dihaList = [i for i in dihhaList if not any(isH[abs(j) // 3] for j in i[:4])]
     mdiha = len(dihaList)
     ndiha = mdiha
 
-    uimprs = OrderedDict()
-    for i, j in enumerate(imprList):
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in uimprs:
-            uimprs[key].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in uimprs:
-            uimprs[key].append(i)
-            continue
-        uimprs[key] = [i]
-
-    ucmaps = OrderedDict()
-    for i, j in enumerate(cmapList):
-        atoms = list(map(lambda x: x - 1, j))
-        key = tuple(map(lambda x: atomTypes[x], atoms))
-        if key in ucmaps:
-            ucmaps[key].append(i)
-            continue
-        key = tuple(map(lambda x: atomTypes[x], atoms[::-1]))
-        if key in ucmaps:
-            ucmaps[key].append(i)
-            continue
-        ucmaps[key] = [i]
+    _, uimprs, uimprList = unique_terms('IMPR', imprList, 'improper dihedral',
+                                        (0.0, 0.0))
+
+    ucmapIds, ucmaps, ucmapList = unique_terms('CMAP', cmapList, 'CMAP',
+                                               numpy.zeros((0, 0)))
+    # type keys sharing a grid share its CHARMM_CMAP_PARAMETER table
+    gridIndex = {}
+    cmapIndex = numpy.zeros(len(ucmaps) + 1, dtype=numpy.int32)
+    for i, val in enumerate(ucmaps):
+        cmapIndex[i + 1] = gridIndex.setdefault(val.tobytes(),
+                                                len(gridIndex) + 1)
+    keep = numpy.unique(cmapIndex[1:], return_index=True)[1]
+    ucmapIds = [ucmapIds[i] for i in keep]
+    ucmaps = [ucmaps[i] for i in keep]
+    ucmapList = cmapIndex[ucmapList]
 
     date = time.strftime("%m/%d/%y  %H:%M:%S", time.localtime())
     wdat("%%VERSION  VERSION_STAMP = V0001.000  DATE = %s%s" % (date, eol))
@@ -2998,20 +4702,11 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
 
     wflg("NUMBER_EXCLUDED_ATOMS")
     wfmt("10I8")
-    for i, j in enumerate(exclList):
-        num = len(exclList[j])
-        num = num - 1 if num > 1 else 1
-        wdat("%8d" % num)
-        if not (i + 1) % 10 or i == natom - 1: wdat(eol)
+    write_fields(wdat, numExcl, "%8d", 10, eol)
 
     wflg("EXCLUDED_ATOMS_LIST")
     wfmt("10I8")
-    cnt = 0
-    for _, i in exclList.items():
-        for j in (i[1:] if len(i) > 1 else i):
-            wdat("%8d" % j)
-            cnt += 1
-            if not cnt % 10 or cnt == nnb: wdat(eol)
+    write_fields(wdat, exclList, "%8d", 10, eol)
 
     wflg("NONBONDED_PARM_INDEX")
     wfmt("10I8")
@@ -3041,46 +4736,26 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
 
     wflg("BOND_FORCE_CONSTANT")
     wfmt("5E16.8")
-    for i, key in enumerate(ubonds):
-        if key in bondPrm:
-            wdat("%16.8E" % bondPrm[key][0])
-        elif key[::-1] in bondPrm:
-            wdat("%16.8E" % bondPrm[key[::-1]][0])
-        else:
-            perr("Unknown bond", key)
+    for i, val in enumerate(ubonds):
+        wdat("%16.8E" % val[0])
         if not (i + 1) % 5 or i == nubnd - 1: wdat(eol)
 
     wflg("BOND_EQUIL_VALUE")
     wfmt("5E16.8")
-    for i, key in enumerate(ubonds):
-        if key in bondPrm:
-            wdat("%16.8E" % bondPrm[key][1])
-        elif key[::-1] in bondPrm:
-            wdat("%16.8E" % bondPrm[key[::-1]][1])
-        else:
-            perr("Unknown bond", key)
+    for i, val in enumerate(ubonds):
+        wdat("%16.8E" % val[1])
         if not (i + 1) % 5 or i == nubnd - 1: wdat(eol)
 
     wflg("ANGLE_FORCE_CONSTANT")
     wfmt("5E16.8")
-    for i, key in enumerate(uangls):
-        if key in anglPrm:
-            wdat("%16.8E" % anglPrm[key][0])
-        elif key[::-1] in anglPrm:
-            wdat("%16.8E" % anglPrm[key[::-1]][0])
-        else:
-            perr("Unknown angle", key)
+    for i, val in enumerate(uangls):
+        wdat("%16.8E" % val[0])
         if not (i + 1) % 5 or i == nuang - 1: wdat(eol)
 
     wflg("ANGLE_EQUIL_VALUE")
     wfmt("3E25.17")
-    for i, key in enumerate(uangls):
-        if key in anglPrm:
-            wdat("%25.17E" % anglPrm[key][1])
-        elif key[::-1] in anglPrm:
-            wdat("%25.17E" % anglPrm[key[::-1]][1])
-        else:
-            perr("Unknown angle", key)
+    for i, val in enumerate(uangls):
+        wdat("%25.17E" % val[1])
         if not (i + 1) % 3 or i == nuang - 1: wdat(eol)
 
     wflg("CHARMM_UREY_BRADLEY_COUNT")
@@ -3096,58 +4771,28 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wcmt("in each UB term: i,k,index")
     wfmt("10I8")
 
-    uubList = [None] * nub
-    for i, j in enumerate(uubs.items()):
-        for k in j[1]:
-            uubList[k] = i + 1
-    ubhaList = [j + [uubList[i]] for i, j in enumerate(ubList)]
-
-    cnt = 0
-    for atom in ubhaList:
-        for i in (atom[0], atom[2], atom[3]):
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 3 * nub: wdat(eol)
+    write_fields(wdat, numpy.column_stack((ubList[:, ::2], uubList)),
+                 "%8d", 10, eol)
 
     wflg("CHARMM_UREY_BRADLEY_FORCE_CONSTANT")
     wcmt("K_ub: kcal/mole/A**2")
     wfmt("5E16.8")
-    for i, key in enumerate(uubs):
-        if key in ubPrm:
-            wdat("%16.8E" % ubPrm[key][0])
-        elif key[::-1] in ubPrm:
-            wdat("%16.8E" % ubPrm[key[::-1]][0])
-        else:
-            perr("Unknown UB angle", key)
+    for i, val in enumerate(uubs):
+        wdat("%16.8E" % val[0])
         if not (i + 1) % 5 or i == nuub - 1: wdat(eol)
 
     wflg("CHARMM_UREY_BRADLEY_EQUIL_VALUE")
     wcmt("r_ub: A")
     wfmt("5E16.8")
-    for i, key in enumerate(uubs):
-        if key in ubPrm:
-            wdat("%16.8E" % ubPrm[key][1])
-        elif key[::-1] in ubPrm:
-            wdat("%16.8E" % ubPrm[key[::-1]][1])
-        else:
-            perr("Unknown UB angle", key)
+    for i, val in enumerate(uubs):
+        wdat("%16.8E" % val[1])
         if not (i + 1) % 5 or i == nuub - 1: wdat(eol)
 
     wflg("DIHEDRAL_FORCE_CONSTANT")
     wfmt("5E16.8")
     cnt = 0
-    for key in udihes:
-        if key in dihePrm:
-            key2 = key
-        elif key[::-1] in dihePrm:
-            key2 = key[::-1]
-        elif ('X', key[1], key[2], 'X') in dihePrm:
-            key2 = ('X', key[1], key[2], 'X')
-        elif ('X', key[2], key[1], 'X') in dihePrm:
-            key2 = ('X', key[2], key[1], 'X')
-        else:
-            perr("Unknown dihedral %s" % key)
-        for i in dihePrm[key2]:
+    for val in udihes:
+        for i in val:
             cnt += 1
             wdat("%16.8E" % i[0])
         if not cnt % 5 or cnt == nudih: wdat(eol)
@@ -3155,18 +4800,8 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wflg("DIHEDRAL_PERIODICITY")
     wfmt("5E16.8")
     cnt = 0
-    for key in udihes:
-        if key in dihePrm:
-            key2 = key
-        elif key[::-1] in dihePrm:
-            key2 = key[::-1]
-        elif ('X', key[1], key[2], 'X') in dihePrm:
-            key2 = ('X', key[1], key[2], 'X')
-        elif ('X', key[2], key[1], 'X') in dihePrm:
-            key2 = ('X', key[2], key[1], 'X')
-        else:
-            perr("Unknown dihedral %s" % key)
-        for i in dihePrm[key2]:
+    for val in udihes:
+        for i in val:
             cnt += 1
             wdat("%16.8E" % i[1])
         if not cnt % 5 or cnt == nudih: wdat(eol)
@@ -3174,18 +4809,8 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wflg("DIHEDRAL_PHASE")
     wfmt("5E16.8")
     cnt = 0
-    for key in udihes:
-        if key in dihePrm:
-            key2 = key
-        elif key[::-1] in dihePrm:
-            key2 = key[::-1]
-        elif ('X', key[1], key[2], 'X') in dihePrm:
-            key2 = ('X', key[1], key[2], 'X')
-        elif ('X', key[2], key[1], 'X') in dihePrm:
-            key2 = ('X', key[2], key[1], 'X')
-        else:
-            perr("Unknown dihedral %s" % key)
-        for i in dihePrm[key2]:
+    for val in udihes:
+        for i in val:
             cnt += 1
             wdat("%16.8E" % i[2])
         if not cnt % 5 or cnt == nudih: wdat(eol)
@@ -3217,18 +4842,8 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wcmt("CHARMM_IMPROPER_{FORCE_CONSTANT,IMPROPER_PHASE}")
     wfmt("10I8")
 
-    uimprList = [None] * nimpr
-    for i, j in enumerate(uimprs.items()):
-        for k in j[1]:
-            uimprList[k] = i + 1
-    imphaList = [j + [uimprList[i]] for i, j in enumerate(imprList)]
-
-    cnt = 0
-    for atom in imphaList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 5 * nimpr: wdat(eol)
+    write_fields(wdat, numpy.column_stack((imprList, uimprList)),
+                 "%8d", 10, eol)
 
     wflg("CHARMM_NUM_IMPR_TYPES")
     wcmt("Number of unique parameters contributing to the")
@@ -3240,33 +4855,15 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wflg("CHARMM_IMPROPER_FORCE_CONSTANT")
     wcmt("K_psi: kcal/mole/rad**2")
     wfmt("5E16.8")
-    for i, key in enumerate(uimprs):
-        if key in imprPrm:
-            wdat("%16.8E" % imprPrm[key][0])
-        elif key[::-1] in imprPrm:
-            wdat("%16.8E" % imprPrm[key[::-1]][0])
-        elif (key[0], 'X', 'X', key[3]) in imprPrm:
-            wdat("%16.8E" % imprPrm[(key[0], 'X', 'X', key[3])][0])
-        elif (key[3], 'X', 'X', key[0]) in imprPrm:
-            wdat("%16.8E" % imprPrm[(key[3], 'X', 'X', key[0])][0])
-        else:
-            perr("Unknown improper dihedral", key)
+    for i, val in enumerate(uimprs):
+        wdat("%16.8E" % val[0])
         if not (i + 1) % 5 or i == nuimpr - 1: wdat(eol)
 
     wflg("CHARMM_IMPROPER_PHASE")
     wcmt("psi: degrees")
     wfmt("5E16.8")
-    for i, key in enumerate(uimprs):
-        if key in imprPrm:
-            wdat("%16.8E" % imprPrm[key][1])
-        elif key[::-1] in imprPrm:
-            wdat("%16.8E" % imprPrm[key[::-1]][1])
-        elif (key[0], 'X', 'X', key[3]) in imprPrm:
-            wdat("%16.8E" % imprPrm[(key[0], 'X', 'X', key[3])][1])
-        elif (key[3], 'X', 'X', key[0]) in imprPrm:
-            wdat("%16.8E" % imprPrm[(key[3], 'X', 'X', key[0])][1])
-        else:
-            perr("Unknown improper dihedral", key)
+    for i, val in enumerate(uimprs):
+        wdat("%16.8E" % val[1])
         if not (i + 1) % 5 or i == nuimpr - 1: wdat(eol)
 
     wflg("SOLTY")
@@ -3282,18 +4879,27 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     lj14a = []
     lj14b = []
     for id, i in enumerate(utypes):
-        for j in utypes.keys()[:id + 1]:
-            r = nbndPrm[i][1] + nbndPrm[j][1]
+        for j in list(utypes)[:id + 1]:
+            nbfix = nbfixPrm.get(tuple(sorted((i, j))))
+            if nbfix is not None:
+                r = nbfix[1]
+                e = abs(nbfix[0])
+            else:
+                r = nbndPrm[i][1] + nbndPrm[j][1]
+                e = sqrt(nbndPrm[i][0] * nbndPrm[j][0])
             r6 = r ** 6
-            e = sqrt(nbndPrm[i][0] * nbndPrm[j][0])
             b = e * r6
             a = b * r6
             b += b
             lja.append(a)
             ljb.append(b)
-            r = nb14Prm[i][1] + nb14Prm[j][1]
+            if nbfix is not None:
+                r = nbfix[3]
+                e = abs(nbfix[2])
+            else:
+                r = nb14Prm[i][1] + nb14Prm[j][1]
+                e = sqrt(nb14Prm[i][0] * nb14Prm[j][0])
             r6 = r ** 6
-            e = sqrt(nb14Prm[i][0] * nb14Prm[j][0])
             b = e * r6
             a = b * r6
             b += b
@@ -3324,57 +4930,27 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
 
     wflg("BONDS_INC_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in bonhList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 3 * nbonh: wdat(eol)
+    write_fields(wdat, bonhList, "%8d", 10, eol)
 
     wflg("BONDS_WITHOUT_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in bonaList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 3 * mbona: wdat(eol)
+    write_fields(wdat, bonaList, "%8d", 10, eol)
 
     wflg("ANGLES_INC_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in anghList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 4 * nangh: wdat(eol)
+    write_fields(wdat, anghList, "%8d", 10, eol)
 
     wflg("ANGLES_WITHOUT_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in angaList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 4 * manga: wdat(eol)
+    write_fields(wdat, angaList, "%8d", 10, eol)
 
     wflg("DIHEDRALS_INC_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in dihhList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 5 * ndihh: wdat(eol)
+    write_fields(wdat, dihhList, "%8d", 10, eol)
 
     wflg("DIHEDRALS_WITHOUT_HYDROGEN")
     wfmt("10I8")
-    cnt = 0
-    for atom in dihaList:
-        for i in atom:
-            wdat("%8d" % i)
-            cnt += 1
-            if not cnt % 10 or cnt == 5 * mdiha: wdat(eol)
+    write_fields(wdat, dihaList, "%8d", 10, eol)
 
     wflg("HBOND_ACOEF")
     wfmt("5E16.8)")
@@ -3418,14 +4994,11 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
 
     wflg("RADII")
     wfmt("5E16.8")
-    bonhDict = {}
-    for i in bonhList:
-        if isH[i[0] // 3]:
-            bonhDict[i[0] // 3] = i[1] // 3
-        elif isH[i[1] // 3]:
-            bonhDict[i[1] // 3] = i[0] // 3
-        else:
-            perr()
+    bonhAtoms = bonhList[:, :2] // 3
+    hFirst = isH[bonhAtoms[:, 0]]
+    bonhDict = dict(zip(
+        numpy.where(hFirst, bonhAtoms[:, 0], bonhAtoms[:, 1]).tolist(),
+        numpy.where(hFirst, bonhAtoms[:, 1], bonhAtoms[:, 0]).tolist()))
     radiiList = []
     screenList = []
     for i in range(natom):
@@ -3485,11 +5058,8 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
 
     ncmap = len(cmapList)
     nucmap = len(ucmaps)
-    ucmapList = [None] * ncmap
-    for i, j in enumerate(ucmaps.items()):
-        for k in j[1]:
-            ucmapList[k] = i + 1
-    cmahaList = [j[:4] + [j[-1], ucmapList[i]] for i, j in enumerate(cmapList)]
+    cmahaList = numpy.column_stack((cmapList[:, :4], cmapList[:, -1],
+                                    ucmapList))
 
     wdat("%8d%8d%s" % (ncmap, nucmap, eol))
 
@@ -3497,44 +5067,33 @@ def write_prmtop(filename, topTitles, topList, prmList, title=None,
     wcmt("Number of steps along each phi/psi CMAP axis")
     wcmt("for each CMAP_PARAMETER grid")
     wfmt("20I4")
-    for i, key in enumerate(ucmaps):
-        if key in cmapPrm:
-            wdat("%4d" % len(cmapPrm[key]))
-        elif key[::-1] in cmapPrm:
-            wdat("%4d" % len(cmapPrm[key[::-1]]))
-        else:
-            perr("Uknown CMAP", key)
+    for i, val in enumerate(ucmaps):
+        wdat("%4d" % len(val))
         if not (i + 1) % 20 or i == nucmap - 1: wdat(eol)
 
-    for i, key in enumerate(ucmaps):
+    for i, val in enumerate(ucmaps):
         wflg("CHARMM_CMAP_PARAMETER_%02d" % (i + 1))
-        if key in cmapPrm:
-            key2 = key
-        else:
-            key2 = key[::-1]
-        title = " ".join(map(lambda x: x.ljust(4), key2))
+        key = prmList.keys[ucmapIds[i]] or prmList.types[ucmapIds[i]]
+        title = " ".join(map(lambda x: x.ljust(4), key))
         wcmt("     " + title)
         wfmt("8(F9.5)")
-        nval = len(cmapPrm[key2]) ** 2
-        cnt = 0
-        for j in cmapPrm[key2]:
-            for k in j:
-                wdat("%9.5f" % k)
-                cnt += 1
-                if not cnt % 8 or cnt == nval: wdat(eol)
+        vals = val.ravel().tolist()
+        nline = len(vals) // 8
+        wdat((("%9.5f" * 8 + eol) * nline) % tuple(vals[:8 * nline]))
+        if len(vals) > 8 * nline:
+            wdat(("%9.5f" * (len(vals) - 8 * nline) + eol) %
+                 tuple(vals[8 * nline:]))
 
     wflg("CHARMM_CMAP_INDEX")
     wcmt("Atom index i,j,k,l,m of the cross term")
     wcmt("and then pointer to CHARMM_CMAP_PARAMETER_n")
     wfmt("6I8")
-    fmt = "%8d" * 6 + eol
-    for atom in cmahaList:
-        wdat(fmt % tuple(atom))
+    write_fields(wdat, cmahaList, "%8d", 6, eol)
 
     if ifbox > 0:
         bondingList = [[] for _ in range(natom + 1)]
-        for i in bondList:
-            bondingList[min(i)].append(max(i))
+        for i, j in numpy.sort(bondList, axis=1).tolist():
+            bondingList[i].append(j)
         molList = []
         leftAtoms = atomNums
         while leftAtoms:
@@ -3593,6 +5152,199 @@ def write_inpcrd(filename, crd, boxInfo=None, title=None):
     inpcrdFile.close()
 
 
+CHECKPOINT_VERSION = 1
+CHECKPOINT_STAGES = ('Input', 'Preparation', 'Solvation', 'Ionization')
+TOP_ATOM_DTYPE = [('num', 'i4'), ('seg', 'i4'), ('resnum', 'i4'),
+                  ('resname', 'i4'), ('name', 'i4'), ('type', 'i4'),
+                  ('chrg', 'f8'), ('mass', 'f8')]
+TOP_TERM_SIZES = (2, 3, 4, 4, 8)
+
+
+def _pack_names(names):
+    return numpy.array(names.names, dtype='S')
+
+
+def _unpack_names(column):
+    return NameTable([_native(name) for name in column.tolist()])
+
+
+def _pack_system(arrays, key, pdbDataList):
+    system = System.from_pdbdata(pdbDataList)
+    arrays[key + '.names'] = _pack_names(system.names)
+    arrays[key + '.atoms'] = system.atoms
+    arrays[key + '.pos'] = system.pos
+    arrays[key + '.residues'] = system.residues
+    arrays[key + '.segments'] = system.segments
+
+
+def _unpack_system(arrays, key):
+    system = System(names=_unpack_names(arrays[key + '.names']))
+    system.atoms = arrays[key + '.atoms']
+    system.pos = arrays[key + '.pos']
+    system.residues = arrays[key + '.residues']
+    system.segments = arrays[key + '.segments']
+    return system.to_pdbdata()
+
+
+def _pack_topology(arrays, key, topList):
+    names = NameTable()
+    atomList = topList[0]
+    atoms = numpy.empty(len(atomList), dtype=TOP_ATOM_DTYPE)
+    if atomList:
+        num, seg, resNum, resName, name, atomType, chrg, mass = zip(*atomList)
+        atoms['num'] = num
+        atoms['seg'] = names.intern_all(seg)
+        atoms['resnum'] = resNum
+        atoms['resname'] = names.intern_all(resName)
+        atoms['name'] = names.intern_all(name)
+        atoms['type'] = names.intern_all(atomType)
+        atoms['chrg'] = chrg
+        atoms['mass'] = mass
+    arrays[key + '.names'] = _pack_names(names)
+    arrays[key + '.atoms'] = atoms
+    for i, size in enumerate(TOP_TERM_SIZES):
+        arrays['%s.%d' % (key, i + 1)] = term_array(topList[i + 1], size)
+
+
+def _unpack_topology(arrays, key):
+    names = _unpack_names(arrays[key + '.names']).names
+    atoms = arrays[key + '.atoms']
+    atomList = [
+        [num, names[seg], resNum, names[resName], names[name],
+         names[atomType], chrg, mass]
+        for num, seg, resNum, resName, name, atomType, chrg, mass
+        in atoms.tolist()
+        ]
+    return [atomList] + [term_array(arrays['%s.%d' % (key, i + 1)], size)
+                         for i, size in enumerate(TOP_TERM_SIZES)]
+
+
+def _pack_ragged(arrays, key, nested, depth):
+    items = [nested]
+    for level in range(depth):
+        arrays['%s.len%d' % (key, level)] = numpy.array(
+            [len(item) for item in items], dtype=numpy.int64)
+        items = [sub for item in items for sub in item]
+    arrays[key] = numpy.array(items, dtype=numpy.float64)
+
+
+def _unpack_ragged(arrays, key, depth):
+    items = arrays[key].tolist()
+    for level in reversed(range(depth)):
+        stops = numpy.cumsum(arrays['%s.len%d' % (key, level)]).tolist()
+        items = [items[start:stop]
+                 for start, stop in zip([0] + stops[:-1], stops)]
+    return items[0]
+
+
+def _native_json(value):
+    """Turn the unicode strings json gives back into native strs."""
+    if isinstance(value, dict):
+        return dict((_native_json(key), _native_json(item))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [_native_json(item) for item in value]
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+
+def save_checkpoint(filename, state, stage, epreInpDict):
+    """Save the pipeline state reached after stage to a checkpoint file.
+
+    state maps 'mod', 'topList', 'watPos', 'sluPos', 'boxInfo', 'tmpmod'
+    and 'tmptopList' to their values, or None for the ones not built yet.
+    Coordinates and topologies are stored as compressed NumPy arrays in an
+    .npz archive, next to a JSON header with the stage and the options.
+    The parsed force field is not stored; it is read again from the
+    TOPOLOGY and FORCEFIELD files named in the options.
+    """
+    if stage not in CHECKPOINT_STAGES:
+        raise ValueError('Unknown stage %s' % stage)
+
+    arrays = {}
+    for key in ('mod', 'tmpmod'):
+        if state.get(key) is not None:
+            _pack_system(arrays, key, state[key])
+    for key in ('topList', 'tmptopList'):
+        if state.get(key) is not None:
+            _pack_topology(arrays, key, state[key])
+    if state.get('watPos') is not None:
+        _pack_ragged(arrays, 'watPos', state['watPos'], 3)
+    if state.get('sluPos') is not None:
+        arrays['sluPos'] = numpy.array(state['sluPos'],
+                                       dtype=numpy.float64).reshape(-1, 3)
+    if state.get('boxInfo') is not None:
+        arrays['boxInfo'] = numpy.array(state['boxInfo'], dtype=numpy.float64)
+
+    options = dict((key, value) for key, value in epreInpDict.items()
+                   if key != 'RENAMERULE')
+    header = {
+        'program': __program__,
+        'version': __version__,
+        'format': CHECKPOINT_VERSION,
+        'created': time.ctime(),
+        'stage': stage,
+        'state': sorted(key for key in state if state[key] is not None),
+        'options': options,
+        }
+    arrays['header'] = numpy.array(json.dumps(header).encode('utf-8'))
+
+    print("Write checkpoint file", filename, "after", stage)
+
+    ckptFile = wopen(filename, 'wb')
+    numpy.savez_compressed(ckptFile, **arrays)
+    ckptFile.close()
+
+
+def load_checkpoint(filename):
+    """Read a file written by save_checkpoint.
+
+    Returns (state, stage, epreInpDict) with the same Python structures
+    the pipeline functions produce.
+    """
+    try:
+        ckptFile = ropen(filename, 'rb')
+    except IOError:
+        perr("Cannot open", filename)
+        raise
+
+    print("Read checkpoint file", filename)
+
+    with ckptFile:
+        arrays = numpy.load(ckptFile)
+        try:
+            header = json.loads(_native(arrays['header'].item()))
+        except KeyError:
+            raise ValueError('%s is not an MDBuilder checkpoint' % filename)
+        header = _native_json(header)
+        if header.get('format') != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint format %s' %
+                             header.get('format'))
+
+        state = dict((key, None) for key in ('mod', 'topList', 'watPos',
+                                             'sluPos', 'boxInfo', 'tmpmod',
+                                             'tmptopList'))
+        present = header['state']
+        for key in ('mod', 'tmpmod'):
+            if key in present:
+                state[key] = _unpack_system(arrays, key)
+        for key in ('topList', 'tmptopList'):
+            if key in present:
+                state[key] = _unpack_topology(arrays, key)
+        if 'watPos' in present:
+            state['watPos'] = _unpack_ragged(arrays, 'watPos', 3)
+        if 'sluPos' in present:
+            state['sluPos'] = [tuple(pos) for pos in arrays['sluPos'].tolist()]
+        if 'boxInfo' in present:
+            state['boxInfo'] = tuple(arrays['boxInfo'].tolist())
+
+    epreInpDict = header['options']
+    epreInpDict['RENAMERULE'] = None
+
+    return state, header['stage'], epreInpDict
+
+
 def print_logo():
     print("\n----------------------------------------------------------------------------\n"
           "----------------------------- %s %s -----------------------------\n"
@@ -3606,7 +5358,88 @@ class PDBDownloadError(Exception):
     pass
 
 
-class CleanableEntryField(Pmw.EntryField):
+def build_chempy_model(pdbDataList, bondList=()):
+    """Build a chempy model that PyMOL can load without parsing any text.
+
+    bondList holds pairs of atom numbers, as in a topology; bonds naming
+    atoms outside pdbDataList are skipped.
+    """
+    if isinstance(pdbDataList, System):
+        system = pdbDataList
+    else:
+        system = System.from_pdbdata(pdbDataList)
+
+    names = system.names.names
+    symbols = [name[:1] for name in names]
+    segNames = system.seg_names().tolist()
+    resSeg = system.residues['seg'].tolist()
+    resNames = system.res_names().tolist()
+    resNums = system.residues['num'].tolist()
+    resIds = [str(num) for num in resNums]
+    atomNums = system.atoms['num'].tolist()
+
+    model = Indexed()
+    modelAtoms = model.atom
+    for num, nameId, res, coord in zip(atomNums,
+                                       system.atoms['name'].tolist(),
+                                       system.atoms['res'].tolist(),
+                                       system.pos.tolist()):
+        atom = Atom()
+        atom.id = num
+        atom.name = names[nameId]
+        atom.symbol = symbols[nameId]
+        atom.resn = resNames[res]
+        atom.resi = resIds[res]
+        atom.resi_number = resNums[res]
+        atom.segi = segNames[resSeg[res]]
+        atom.chain = atom.segi[:1]
+        atom.coord = coord
+        modelAtoms.append(atom)
+
+    index = dict((num, i) for i, num in enumerate(atomNums))
+    for atomNum1, atomNum2 in term_array(bondList, 2).tolist():
+        if atomNum1 in index and atomNum2 in index:
+            bond = Bond()
+            bond.index = [index[atomNum1], index[atomNum2]]
+            model.bond.append(bond)
+
+    return model
+
+
+def load_pymol_object(objname, pdbDataList, bondList=()):
+    cmd.load_model(build_chempy_model(pdbDataList, bondList), objname)
+
+
+def update_pymol_ions(objname, oldname, removedAtoms, newIds, ionDataList):
+    """Turn the solvated object into the ionized one inside PyMOL.
+
+    The object is changed in place: the removed solvent atoms (atom
+    numbers in oldname) are deleted, the solvent left gets its atom number,
+    residue number and segment of the ionized model from newIds, a dict
+    keyed by the old atom number, the ions are copied in and the object is
+    renamed. Atoms are selected by id, the atom number, since PyMOL
+    reorders them on load.
+    """
+    if removedAtoms:
+        cmd.remove('%s and id %s' % (
+            oldname, '+'.join(str(i) for i in removedAtoms)))
+    if newIds:
+        cmd.alter(oldname,
+                  'ID, resi, segi = newIds.get(ID, (ID, resi, segi))',
+                  space={'newIds': newIds})
+    tmpname = '_%s_ions' % objname
+    load_pymol_object(tmpname, ionDataList)
+    if hasattr(cmd, 'copy_to'):
+        cmd.copy_to(oldname, tmpname, rename='')
+        cmd.set_name(oldname, objname)
+    else:
+        # PyMOL before 2.0 can only merge objects by copying both
+        cmd.create(objname, '%s or %s' % (oldname, tmpname))
+        cmd.delete(oldname)
+    cmd.delete(tmpname)
+
+
+class CleanableEntryField(Pmw.EntryField if _HAS_GUI else object):
     def __init__(self, *args, **kwargs):
         Pmw.EntryField.__init__(self, *args, **kwargs)
         self.component('entry').bind('<Escape>',
@@ -3640,47 +5473,11 @@ class MDBuilderGui:
         self.watPos = None
         self.sluPos = None
         self.boxInfo = None
+        self.tmpmod = None
+        self.tmptopList = None
+        self.stage = None
 
-        self.epreInpDict = {
-            'TOPOLOGY': None,
-            'FORCEFIELD': None,
-            'NOCMAP': False,
-            'ALIASRES': [],
-            'ALIASATOM': [],
-            'PATCH': [],
-            'SEGMENT': [],
-            'COORDPDB': None,
-            'DOWNLOAD': False,
-            'NOGUESSCOORD': False,
-            'DISUBOND': {
-                'DODISU': False,
-                'AUTO': False,
-                'CUT': 2.1,
-                'DISULIST': []
-            },
-            'ADDWAT': {
-                'DOADDWAT': False,
-                'MODEL': 'TIP3P',
-                'SEGNAME': 'WT',
-                'CUT': 2.4,
-                'PAD': 9.0,
-                'COORDINATE': 'tip3p.crd'
-            },
-            'ADDION': {
-                'DOADDION': False,
-                'METHOD': 'RANDOM',
-                'SEGNAME': 'ION',
-                'CATION': ['SOD', 0],
-                'ANION': ['CLA', 0],
-                'ION_SOLUTE': 5.0,
-                'ION_ION': 5.0,
-                'SALTCON': 0.0
-            },
-            'WRITEPSF': None,
-            'WRITEPDB': None,
-            'WRITEPRMTOP': None,
-            'WRITEINPCRD': None
-        }
+        self.epreInpDict = default_options()
 
         self.pmobj = []
         self.original_stdout = sys.stdout
@@ -3715,8 +5512,8 @@ class MDBuilderGui:
 
     def create_dialog(self):
         self.dialog = Pmw.Dialog(self.parent,
-                                 buttons=('Execute', 'Output', 'Console',
-                                          'Quit', 'About'),
+                                 buttons=('Execute', 'Output', 'Save', 'Load',
+                                          'Console', 'Quit', 'About'),
                                  title='%s %s'%(__program__, __version__),
                                  command=self.on_dialog_button_clicked)
         w = self.dialog.component('buttonbox')
@@ -3928,7 +5725,7 @@ class MDBuilderGui:
                 frame,
                 labelpos='w',
                 label_text='Coordinate Format:',
-                items=('pdb', 'AMBER inpcrd'),
+                items=('pdb', 'mmCIF', 'AMBER inpcrd'),
                 menubutton_width=14)
         self.crdfmt.pack(side='right', anchor='w', padx=10, pady=5)
 
@@ -4307,6 +6104,10 @@ class MDBuilderGui:
             self.on_execute_button_clicked()
         elif result == 'Output':
             self.on_output_button_clicked()
+        elif result == 'Save':
+            self.on_save_button_clicked()
+        elif result == 'Load':
+            self.on_load_button_clicked()
         elif result == 'Console':
             self.on_console_button_clicked()
         elif result == 'About':
@@ -4352,9 +6153,13 @@ class MDBuilderGui:
         self.epreInpDict['FORCEFIELD'] = self.parloc.getvalue()
         self.epreInpDict['COORDPDB'] = self.pdbloc.getvalue()
 
-        self.mod = read_pdb(self.pdbloc.getvalue(), self.epreInpDict)
+        if is_cif(self.pdbloc.getvalue()):
+            self.mod = read_cif(self.pdbloc.getvalue(), self.epreInpDict)
+        else:
+            self.mod = read_pdb(self.pdbloc.getvalue(), self.epreInpDict)
         self.top = read_charmm_top(self.ffloc.getvalue(), self.epreInpDict)
         self.prm = read_charmm_prm(self.parloc.getvalue())
+        self.stage = 'Input'
         return 0
 
     def on_execute_button_clicked(self):
@@ -4365,6 +6170,7 @@ class MDBuilderGui:
                 parent=self.parent)
             return
 
+        ionUpdate = None
         if self.notebook.getcurselection() == 'Preparation':
             if self.mod is None or self.top is None or self.prm is None:
                 failed = self.load_input()
@@ -4399,6 +6205,7 @@ class MDBuilderGui:
                     'Failed',
                     parent=self.parent)
             else:
+                self.finish_stage()
                 tkMessageBox.showinfo(
                     'INFO',
                     'Successfully completed',
@@ -4452,14 +6259,8 @@ class MDBuilderGui:
                 self.tmpmod = deepcopy(self.mod)
                 self.tmptopList = deepcopy(self.topList)
 
-                #self.mod += watDataList[0]
-                #self.topList[0] += watDataList[1]
-                #self.topList[1] += watDataList[2]
-                #self.topList[2] += watDataList[3]
-                self.mod = self.mod if watDataList[0] == [] else self.mod + watDataList[0]
-                self.topList[0] = self.topList[0] if watDataList[1] == [] else self.topList[0] + watDataList[1]
-                self.topList[1] = self.topList[1] if watDataList[2] == [] else self.topList[1] + watDataList[2]
-                self.topList[2] = self.topList[2] if watDataList[3] == [] else self.topList[2] + watDataList[3]
+                self.mod = self.mod + watDataList[0]
+                self.topList = add_solv_top(self.topList, watDataList)
 
             except Exception:
                 tkMessageBox.showerror(
@@ -4467,6 +6268,7 @@ class MDBuilderGui:
                     'Failed',
                     parent=self.parent)
             else:
+                self.finish_stage()
                 tkMessageBox.showinfo(
                     'INFO',
                     'Successfully completed',
@@ -4509,23 +6311,44 @@ class MDBuilderGui:
                 self.topList = self.tmptopList
                 self.mod = self.tmpmod
 
+                oldWatPos = [list(box) for box in self.watPos]
                 self.watPos, ionPosList = add_ion(self.epreInpDict, self.topList[0],
                                                   self.sluPos, self.watPos, self.boxInfo)
 
+                # solvent atoms replaced by ions and kept, as atom numbers
+                # in the solvated model, so the preview can be patched in
+                # place; build_solv_top numbered them on from the last
+                # solute atom
+                keptMols = set(id(mol) for box in self.watPos for mol in box)
+                atomNum = self.mod[-1][-1][-1][-1][-1][0]
+                removedAtoms = []
+                keptAtoms = []
+                for box in oldWatPos:
+                    for mol in box:
+                        atomNums = range(atomNum + 1, atomNum + len(mol) + 1)
+                        if id(mol) in keptMols:
+                            keptAtoms.extend(atomNums)
+                        else:
+                            removedAtoms.extend(atomNums)
+                        atomNum += len(mol)
+
                 # if doAddWat or doAddIon:
                 atomNumAdd = self.mod[-1][-1][-1][-1][-1][0]
                 resNumAdd = self.mod[-1][-1][-1][0]
                 watDataList = build_solv_top(self.epreInpDict, self.watPos, ionPosList,
                                               atomNumAdd, resNumAdd)
-
-                # self.mod += watDataList[0]
-                # self.topList[0] += watDataList[1]
-                # self.topList[1] += watDataList[2]
-                # self.topList[2] += watDataList[3]
-                self.mod = self.mod if watDataList[0] == [] else self.mod + watDataList[0]
-                self.topList[0] = self.topList[0] if watDataList[1] == [] else self.topList[0] + watDataList[1]
-                self.topList[1] = self.topList[1] if watDataList[2] == [] else self.topList[1] + watDataList[2]
-                self.topList[2] = self.topList[2] if watDataList[3] == [] else self.topList[2] + watDataList[3]
+                segNameIon = self.epreInpDict['ADDION']['SEGNAME']
+                # the solvent left is numbered anew, in the same order
+                newIds = dict(zip(keptAtoms, [
+                    (atom[0], str(res[0]), seg[0]) for seg in watDataList[0]
+                    if seg[0] != segNameIon
+                    for res in seg[1] for atom in res[2]]))
+                ionUpdate = (removedAtoms, newIds,
+                             [seg for seg in watDataList[0]
+                              if seg[0] == segNameIon])
+
+                self.mod = self.mod + watDataList[0]
+                self.topList = add_solv_top(self.topList, watDataList)
 
             except Exception:
                 tkMessageBox.showerror(
@@ -4533,6 +6356,7 @@ class MDBuilderGui:
                     'Failed',
                     parent=self.parent)
             else:
+                self.finish_stage()
                 tkMessageBox.showinfo(
                     'INFO',
                     'Successfully completed',
@@ -4543,27 +6367,51 @@ class MDBuilderGui:
                 self.load_input()
             return
 
-        # generate a tmp PDB file for view
-        objname = {'Preparation': 'modified', 'Solvation': 'solvated',
-                   'Ionization': 'ionized'}[self.notebook.getcurselection()]
-        tmpfp = StringIO()
-
-        #write_tmppdb(tmpfp, self.mod, self.boxInfo)
-        if self.boxInfo is not None:
-            write_tmppdb(tmpfp, self.mod, self.boxInfo)
-        else:
-            write_tmppdb(tmpfp, self.mod)
+        self.show_model(self.notebook.getcurselection(), ionUpdate)
+
+    def finish_stage(self):
+        self.stage = self.notebook.getcurselection()
+        if self.epreInpDict['CHECKPOINT']:
+            save_checkpoint(self.epreInpDict['CHECKPOINT'], self.get_state(),
+                            self.stage, self.epreInpDict)
+
+    def get_state(self):
+        return {
+            'mod': self.mod,
+            'topList': self.topList,
+            'watPos': self.watPos,
+            'sluPos': self.sluPos,
+            'boxInfo': self.boxInfo,
+            'tmpmod': self.tmpmod,
+            'tmptopList': self.tmptopList
+            }
+
+    def show_model(self, stage, ionUpdate=None):
+        objname = {'Input': 'original', 'Preparation': 'modified',
+                   'Solvation': 'solvated', 'Ionization': 'ionized'}[stage]
 
         cmd.bg_color('white')
-        for obj in self.pmobj:
-            cmd.delete(obj)
-        cmd.read_pdbstr(tmpfp.getvalue(), objname)
+        if ionUpdate is not None and self.pmobj == ['solvated']:
+            update_pymol_ions(objname, 'solvated', *ionUpdate)
+        else:
+            for obj in self.pmobj:
+                cmd.delete(obj)
+            if self.topList is not None:
+                load_pymol_object(objname, self.mod, self.topList[1])
+                if self.boxInfo is not None:
+                    a, b, c = self.boxInfo[2]
+                    cmd.set_symmetry(objname, a, b, c, 90.0, 90.0, 90.0, 'P 1')
+            else:
+                # without a topology let PyMOL guess bonds from a PDB
+                tmpfp = StringIO()
+                write_tmppdb(tmpfp, self.mod, self.boxInfo)
+                cmd.read_pdbstr(tmpfp.getvalue(), objname)
+                tmpfp.close()
         util.cbag()
         self.pmobj = [objname]
-        if self.notebook.getcurselection() == 'Ionization':
+        if stage == 'Ionization':
             cmd.show('spheres', 'segi %s'%self.epreInpDict['ADDION']['SEGNAME'])
             cmd.color('skyblue','segi %s'%self.epreInpDict['ADDION']['SEGNAME'])
-        tmpfp.close()
 
     def on_output_button_clicked(self):
         # check
@@ -4612,6 +6460,50 @@ class MDBuilderGui:
         print("Time elapsed: %.3f s" % (clock() - self.startTime))
         print("Job finished on", time.ctime())
 
+    def on_save_button_clicked(self):
+        if self.stage is None:
+            tkMessageBox.showerror('ERROR', 'Nothing to save yet',
+                                   parent=self.parent)
+            return
+
+        filename = tkFileDialog.asksaveasfilename(
+                defaultextension='.npz',
+                filetypes=[('Checkpoint File', '.npz'),
+                           ('All Files', '.*')])
+        if not filename:
+            return
+        self.epreInpDict['CHECKPOINT'] = filename
+        save_checkpoint(filename, self.get_state(), self.stage,
+                        self.epreInpDict)
+
+    def on_load_button_clicked(self):
+        filename = tkFileDialog.askopenfilename(
+                defaultextension='.npz',
+                filetypes=[('Checkpoint File', '.npz'),
+                           ('All Files', '.*')])
+        if not filename:
+            return
+
+        try:
+            state, stage, epreInpDict = load_checkpoint(filename)
+            self.epreInpDict.update(epreInpDict)
+            self.epreInpDict['CHECKPOINT'] = filename
+            self.pdbloc.setvalue(self.epreInpDict['COORDPDB'])
+            self.ffloc.setvalue(self.epreInpDict['TOPOLOGY'])
+            self.parloc.setvalue(self.epreInpDict['FORCEFIELD'])
+            self.top = read_charmm_top(self.epreInpDict['TOPOLOGY'],
+                                       self.epreInpDict)
+            self.prm = read_charmm_prm(self.epreInpDict['FORCEFIELD'])
+        except Exception:
+            tkMessageBox.showerror('ERROR', 'Failed to load "%s"'%filename,
+                                   parent=self.parent)
+            return
+
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.stage = stage
+        self.show_model(stage)
+
     def on_console_button_clicked(self):
         if self.console_shown:
             self.panedwin.forget(self.console_frame)
@@ -4636,18 +6528,19 @@ class MDBuilderGui:
     def on_download_clicked(self):
         pdb = self.pdbloc.getvalue()
         try:
-            download_pdb(pdb)
+            pdbFile = download_pdb(pdb)
         except Exception:
             tkMessageBox.showerror('ERROR', 'Failed to download "%s"'%pdb,
                                    parent=self.parent)
         else:
-            self.pdbloc.setvalue(os.path.join(os.getcwd(), pdb.upper()+'.pdb'))
+            self.pdbloc.setvalue(os.path.join(os.getcwd(), pdbFile))
             self.on_pdbentry_pressed()
 
     def on_pdbentry_pressed(self):
         pdb = self.pdbloc.getvalue()
         if self.check_exist(pdb) == Pmw.OK:
-            cmd.load(pdb, 'original', format='pdb', quiet=0)
+            cmd.load(pdb, 'original', format='cif' if is_cif(pdb) else 'pdb',
+                     quiet=0)
             util.cbag()
             self.pmobj.append('original')
 
@@ -4656,24 +6549,27 @@ class MDBuilderGui:
                 tkFileDialog.askopenfilename(
                     defaultextension='.pdb .ent',
                     filetypes=[('PDB File', '.pdb .ent'),
+                               ('mmCIF File', '.cif .mmcif'),
                                ('All Files', '.*')]))
         self.on_pdbentry_pressed()
 
     def on_openff_clicked(self, event=None):
-        self.ffloc.setvalue(
-                tkFileDialog.askopenfilename(
+        self.ffloc.setvalue(os.pathsep.join(self.parent.tk.splitlist(
+                tkFileDialog.askopenfilenames(
                     defaultextension='.inp .top',
-                    filetypes=[('Topology File', '.inp .top'),
-                               ('All Files', '.*')]))
+                    filetypes=[('Topology File', '.inp .top .rtf'),
+                               ('Stream File', '.str'),
+                               ('All Files', '.*')]))))
                     #filetypes=[('Forcefield File', '.inp .top'),
                     #          ('All Files', '.*')]))
 
     def on_openpar_clicked(self, event=None):
-        self.parloc.setvalue(
-                tkFileDialog.askopenfilename(
+        self.parloc.setvalue(os.pathsep.join(self.parent.tk.splitlist(
+                tkFileDialog.askopenfilenames(
                     defaultextension='.prm',
-                    filetypes=[('Parameter File', '.prm'),
-                               ('All Files', '.*')]))
+                    filetypes=[('Parameter File', '.prm .par'),
+                               ('Stream File', '.str'),
+                               ('All Files', '.*')]))))
 
     def on_savetop_clicked(self, event=None):
         tops = {'AMBER prmtop': '.prmtop',
@@ -4692,7 +6588,8 @@ class MDBuilderGui:
                 'GROMACS g96': '.g96',
                 'GROMACS gro': '.gro',
                 'NAMD bin': '.bin',
-                'pdb': '.pdb'}
+                'pdb': '.pdb',
+                'mmCIF': '.cif'}
         crd = crds[self.crdfmt.getvalue()]
         self.crdloc.setvalue(
                 tkFileDialog.asksaveasfilename(
@@ -4745,9 +6642,395 @@ def save_files(epreInpDict, crdDataList, topList, prmDataList, boxInfo, topfmt,
 
     if crdfmt == 'pdb':
         write_pdb(crdfile, crdDataList, boxInfo)
+    elif crdfmt == 'mmCIF':
+        write_cif(crdfile, crdDataList, boxInfo)
     elif crdfmt == 'AMBER inpcrd':
         doAddWat = epreInpDict['ADDWAT']['DOADDWAT']
         write_prmtop(crdfile, topTitles, topList, prmDataList, isNPT=doAddWat)
     else:
         raise ValueError('Unsupported coordinate format' % crdfmt)
 
+
+def default_options():
+    """Return a new option dict with the defaults of the plugin."""
+    return {
+        'TOPOLOGY': None,
+        'FORCEFIELD': None,
+        'NOCMAP': False,
+        'ALIASRES': [],
+        'ALIASATOM': [],
+        'RENAMERULE': None,
+        'PATCH': [],
+        'SEGMENT': [],
+        'COORDPDB': None,
+        'DOWNLOAD': False,
+        'NOGUESSCOORD': False,
+        'NPROC': 1,
+        'ALLMODELS': False,
+        'DISUBOND': {
+            'DODISU': False,
+            'AUTO': False,
+            'CUT': 2.1,
+            'DISULIST': []
+        },
+        'ADDWAT': {
+            'DOADDWAT': False,
+            'MODEL': 'TIP3P',
+            'SEGNAME': 'WT',
+            'CUT': 2.4,
+            'PAD': 9.0,
+            'COORDINATE': 'tip3p.crd'
+        },
+        'ADDION': {
+            'DOADDION': False,
+            'METHOD': 'RANDOM',
+            'SEGNAME': 'ION',
+            'CATION': ['SOD', 0],
+            'ANION': ['CLA', 0],
+            'ION_SOLUTE': 5.0,
+            'ION_ION': 5.0,
+            'SALTCON': 0.0
+        },
+        'WRITEPSF': None,
+        'WRITEPDB': None,
+        'WRITEPRMTOP': None,
+        'WRITEINPCRD': None,
+        'CHECKPOINT': None
+    }
+
+
+def read_options(options):
+    """Return the defaults updated with a dict of options, as from JSON.
+
+    DISUBOND, ADDWAT and ADDION are updated key by key.
+    """
+    epreInpDict = default_options()
+    for key, value in _native_json(options).items():
+        if isinstance(epreInpDict.get(key), dict):
+            epreInpDict[key].update(value)
+        else:
+            epreInpDict[key] = value
+    return epreInpDict
+
+
+def build_system(epreInpDict, forceField=None):
+    """Run a whole build from the options alone, without the GUI.
+
+    The steps of the plugin pages are run in order: read COORDPDB, build
+    the structure, add water (ADDWAT) and then ions (ADDION), and write
+    each of WRITEPSF, WRITEPDB, WRITEPRMTOP and WRITEINPCRD that is set.
+    With ALLMODELS every model of a PDB file is built in turn and written
+    to its own files, named by model_filename. forceField is the
+    (topology, parameters) pair if already read. Returns the names of
+    the files written.
+    """
+    if forceField is None:
+        top = read_charmm_top(epreInpDict['TOPOLOGY'], epreInpDict)
+        prm = read_charmm_prm(epreInpDict['FORCEFIELD'])
+    else:
+        top, prm = forceField
+
+    filename = epreInpDict['COORDPDB']
+    if epreInpDict['DOWNLOAD']:
+        filename = download_pdb(filename)
+    if epreInpDict.get('ALLMODELS'):
+        if is_cif(filename):
+            raise ValueError('ALLMODELS needs a PDB file: %s' % filename)
+        written = []
+        for modelNum, mod, topList in build_models(filename, top[1:],
+                                                   epreInpDict, prm):
+            written.extend(finish_system(epreInpDict, top, prm, mod,
+                                         topList, modelNum))
+        return written
+
+    if is_cif(filename):
+        mod = read_cif(filename, epreInpDict)
+    else:
+        mod = read_pdb(filename, epreInpDict)
+
+    mod, topList = build_struct(top[1:], mod, epreInpDict, prm)
+    return finish_system(epreInpDict, top, prm, mod, topList)
+
+
+def finish_system(epreInpDict, top, prm, mod, topList, modelNum=None):
+    """Solvate, ionize and write a built structure, as for build_system.
+
+    With a modelNum the output names are made by model_filename.
+    Returns the names of the files written.
+    """
+    def output(key):
+        filename = epreInpDict[key]
+        if filename and modelNum is not None:
+            filename = model_filename(filename, modelNum)
+        return filename
+
+    boxInfo = None
+    doAddWat = epreInpDict['ADDWAT']['DOADDWAT']
+    if doAddWat:
+        sluPos = [(posX, posY, posZ)
+                  for _, segDataList in mod
+                  for _, _, resAtom in segDataList
+                  for _, _, posX, posY, posZ in resAtom]
+        watPos, sluPos, boxInfo = add_wat(epreInpDict, sluPos)
+        itPos = iter(sluPos)
+        for _, segDataList in mod:
+            for _, _, resAtom in segDataList:
+                for atom in resAtom:
+                    atom[2:] = next(itPos)
+
+        ionPosList = []
+        if epreInpDict['ADDION']['DOADDION']:
+            watPos, ionPosList = add_ion(epreInpDict, topList[0], sluPos,
+                                         watPos, boxInfo)
+
+        atomNumAdd = mod[-1][-1][-1][-1][-1][0]
+        resNumAdd = mod[-1][-1][-1][0]
+        watDataList = build_solv_top(epreInpDict, watPos, ionPosList,
+                                     atomNumAdd, resNumAdd)
+        mod = mod + watDataList[0]
+        topList = add_solv_top(topList, watDataList)
+
+    written = []
+    filename = output('WRITEPSF')
+    if filename:
+        write_psf(filename, topList, epreInpDict)
+        written.append(filename)
+    filename = output('WRITEPDB')
+    if filename:
+        if is_cif(filename):
+            write_cif(filename, mod, boxInfo)
+        else:
+            write_pdb(filename, mod, boxInfo)
+        written.append(filename)
+    filename = output('WRITEPRMTOP')
+    if filename:
+        write_prmtop(filename, top[0], topList, prm, isNPT=doAddWat)
+        written.append(filename)
+    filename = output('WRITEINPCRD')
+    if filename:
+        crd = [tuple(atom[2:]) for seg in mod for res in seg[1]
+               for atom in res[2]]
+        box = None
+        if boxInfo is not None:
+            box = list(boxInfo[2]) + [90.0, 90.0, 90.0]
+        write_inpcrd(filename, crd, box)
+        written.append(filename)
+
+    return written
+
+
+def server_path():
+    """Return the socket of the force-field server (MDBUILDER_SOCKET)."""
+    return (os.environ.get('MDBUILDER_SOCKET') or
+            os.path.join(cache_dir(), 'server.sock'))
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return (filename, stat.st_mtime, stat.st_size)
+
+
+class ForceFieldServer(socketserver.UnixStreamServer):
+    """Local build server keeping parsed force fields in memory.
+
+    Clients connect to a Unix socket and send one JSON request per line;
+    each gets one JSON reply line with 'ok', the printed 'log' and either
+    the result or an 'error'. Requests are served one at a time:
+
+        {"op": "ping"}
+        {"op": "load", "options": {...}}   read TOPOLOGY and FORCEFIELD
+        {"op": "build", "options": {...}}  run build_system
+        {"op": "shutdown"}
+
+    Options use the keys of default_options. Force fields are kept per set
+    of files and read again only when a file changes; solvent boxes are
+    kept by load_solvent_box, and parsed residues by the topology tables.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = server_path()
+        if os.path.exists(path):
+            try:
+                ff_request({'op': 'ping'}, path)
+            except socket.error:
+                os.remove(path)
+            else:
+                raise IOError('A server is already running on %s' % path)
+        socketserver.UnixStreamServer.__init__(self, path, _ServerHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.forceFields = {}
+        self.stopping = False
+
+    def serve(self):
+        print("Serve requests on", self.path)
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+
+    def force_field(self, epreInpDict):
+        """Return the (topology, parameters) named by the options."""
+        topFiles = [os.path.abspath(name)
+                    for name in ff_file_list(epreInpDict['TOPOLOGY'])]
+        prmFiles = [os.path.abspath(name)
+                    for name in ff_file_list(epreInpDict['FORCEFIELD'])]
+        key = (tuple(topFiles), tuple(prmFiles), epreInpDict['NOCMAP'])
+        stamp = [_file_stamp(name) for name in topFiles + prmFiles]
+        if key not in self.forceFields or self.forceFields[key][0] != stamp:
+            self.forceFields[key] = (stamp,
+                                     read_charmm_top(topFiles, epreInpDict),
+                                     read_charmm_prm(prmFiles))
+        _, top, prm = self.forceFields[key]
+        return top, prm
+
+    def reply(self, request):
+        log = StringIO()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = log
+        try:
+            op = request.get('op')
+            if op == 'ping':
+                result = {'version': __version__, 'pid': os.getpid(),
+                          'forcefields': len(self.forceFields)}
+            elif op == 'load':
+                self.force_field(read_options(request['options']))
+                result = {'forcefields': len(self.forceFields)}
+            elif op == 'build':
+                epreInpDict = read_options(request['options'])
+                result = {'files': build_system(
+                    epreInpDict, self.force_field(epreInpDict))}
+            elif op == 'shutdown':
+                self.stopping = True
+                result = {}
+            else:
+                raise ValueError('Unknown request %r' % op)
+        except Exception as err:
+            reply = {'ok': False, 'error': '%s: %s' % (type(err).__name__,
+                                                       err)}
+        except SystemExit as err:
+            # the build functions stop with sys.exit on bad input; the
+            # reason is in the log
+            reply = {'ok': False,
+                     'error': 'Build stopped with status %s' % err.code}
+        else:
+            reply = {'ok': True}
+            reply.update(result)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        reply['log'] = log.getvalue()
+        return reply
+
+
+class _ServerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                request = _native_json(json.loads(line.decode('utf-8')))
+            except ValueError as err:
+                reply = {'ok': False, 'error': 'Bad request: %s' % err}
+            else:
+                reply = self.server.reply(request)
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def ff_request(request, path=None):
+    """Send a request to the force-field server and return its reply.
+
+    Raises socket.error if no server is listening on path, and IOError
+    if it closes the connection without a reply.
+    """
+    if path is None:
+        path = server_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            block = sock.recv(1 << 16)
+            if not block:
+                break
+            data += block
+    finally:
+        sock.close()
+    if not data:
+        raise IOError('No reply from the server on %s' % path)
+    return _native_json(json.loads(data.decode('utf-8')))
+
+
+def _abspath_options(options):
+    """Make the file names in options absolute, for a server elsewhere."""
+    options = deepcopy(options)
+    for key in ('TOPOLOGY', 'FORCEFIELD'):
+        if options.get(key):
+            options[key] = [os.path.abspath(name)
+                            for name in ff_file_list(options[key])]
+    keys = ['WRITEPSF', 'WRITEPDB', 'WRITEPRMTOP', 'WRITEINPCRD']
+    if not options.get('DOWNLOAD'):
+        keys.append('COORDPDB')
+    for key in keys:
+        if options.get(key):
+            options[key] = os.path.abspath(options[key])
+    if options.get('ADDWAT', {}).get('COORDINATE'):
+        options['ADDWAT']['COORDINATE'] = os.path.abspath(
+            options['ADDWAT']['COORDINATE'])
+    return options
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=__program__,
+                                     description=__desc__)
+    parser.add_argument('--socket', default=None,
+                        help='server socket (default: $MDBUILDER_SOCKET or '
+                             '~/.mdbuilder/server.sock)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='run the force-field server')
+    commands.add_parser('stop', help='stop the force-field server')
+    build = commands.add_parser(
+        'build', help='build a system from a JSON file of options, on the '
+                      'server if one is running')
+    build.add_argument('options')
+    build.add_argument('--local', action='store_true',
+                       help='build in this process')
+    build.add_argument('--all-models', action='store_true',
+                       help='build every model of COORDPDB, each to its own '
+                            'files (out.psf becomes out_1.psf, ...)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        ForceFieldServer(args.socket).serve()
+        return 0
+
+    if args.command == 'stop':
+        ff_request({'op': 'shutdown'}, args.socket)
+        return 0
+
+    with open(args.options) as optFile:
+        options = json.load(optFile)
+    if args.all_models:
+        options['ALLMODELS'] = True
+    if not args.local:
+        try:
+            reply = ff_request({'op': 'build',
+                                'options': _abspath_options(options)},
+                               args.socket)
+        except socket.error:
+            pass
+        else:
+            sys.stdout.write(reply['log'])
+            if not reply['ok']:
+                perr(reply['error'])
+                return 1
+            return 0
+    build_system(read_options(options))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""Round-trip tests for the MDBuilder module.
+
+Run from the top of the repository with
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, os.pardir, 'examples')
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'src'))
+
+import mdbuilder
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='mdbuilder-test-')
+        self.oldCache = os.environ.get('MDBUILDER_CACHE')
+        os.environ['MDBUILDER_CACHE'] = os.path.join(self.tmpDir, 'cache')
+
+    def tearDown(self):
+        if self.oldCache is None:
+            del os.environ['MDBUILDER_CACHE']
+        else:
+            os.environ['MDBUILDER_CACHE'] = self.oldCache
+        shutil.rmtree(self.tmpDir)
+
+    def path(self, name):
+        return os.path.join(self.tmpDir, name)
+
+
+class Hy36Test(unittest.TestCase):
+    def test_round_trip(self):
+        for value in [0, 1, -9999, 99999, 100000, 100001, 2436111, 43770015,
+                      43770016, 87440031]:
+            encoded = mdbuilder.hy36encode(5, value)
+            self.assertEqual(len(encoded), 5)
+            column = numpy.array([encoded.encode('ascii')], dtype='S5')
+            self.assertEqual(mdbuilder._hy36_number(column)[0], value)
+
+    def test_order(self):
+        self.assertEqual(mdbuilder.hy36encode(5, 100000), 'A0000')
+        self.assertEqual(mdbuilder.hy36encode(4, 10000), 'A000')
+        self.assertEqual(mdbuilder.hy36encode(5, 43770015), 'ZZZZZ')
+        self.assertEqual(mdbuilder.hy36encode(5, 43770016), 'a0000')
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, mdbuilder.hy36encode, 5, -10000)
+        self.assertRaises(ValueError, mdbuilder.hy36encode, 5, 87440032)
+
+
+class CifTest(TempDirTestCase):
+    def test_round_trip(self):
+        options = mdbuilder.default_options()
+        pdbDataList = mdbuilder.read_pdb(os.path.join(EXAMPLES, 'adi.pdb'),
+                                         options)
+        cifFile = self.path('adi.cif')
+        mdbuilder.write_cif(cifFile, pdbDataList, [0, 0, [10.0, 20.0, 30.0]])
+        self.assertTrue(mdbuilder.is_cif(cifFile))
+
+        # atoms are numbered from 1 on output, as in write_pdb
+        atomNum = 0
+        for segName, resList in pdbDataList:
+            for resNum, resName, atomList in resList:
+                for atom in atomList:
+                    atomNum += 1
+                    atom[0] = atomNum
+        self.assertEqual(mdbuilder.read_cif(cifFile, options), pdbDataList)
+
+
+class CompressedIOTest(TempDirTestCase):
+    def exts(self):
+        exts = ['', '.gz', '.bz2']
+        if mdbuilder.lzma is not None:
+            exts.append('.xz')
+        return exts
+
+    def test_round_trip(self):
+        data = b''.join(b'ATOM  %5d\n' % i for i in range(1000))
+        for ext in self.exts():
+            filename = self.path('out.pdb' + ext)
+            outFile = mdbuilder.wopen(filename, 'wb')
+            outFile.write(data)
+            outFile.close()
+            self.assertEqual(mdbuilder.is_compressed(filename), bool(ext))
+            with mdbuilder.ropen(filename, 'rb') as inFile:
+                self.assertEqual(inFile.read(), data)
+
+    def test_backup_copy_is_readable(self):
+        for ext in self.exts():
+            filename = self.path('out.pdb' + ext)
+            for data in (b'first\n', b'second\n'):
+                outFile = mdbuilder.wopen(filename, 'wb')
+                outFile.write(data)
+                outFile.close()
+            if ext:
+                copy = self.path('out.copy.pdb' + ext)
+            else:
+                copy = filename + '.copy'
+            with mdbuilder.ropen(copy, 'rb') as inFile:
+                self.assertEqual(inFile.read(), b'first\n')
+
+
+class CheckpointTest(TempDirTestCase):
+    def state(self):
+        mod = [['WT', [[1, 'WAT', [[1, 'OH2', 0.0, 0.0, 0.0],
+                                   [2, 'H1', 0.957, 0.0, 0.0],
+                                   [3, 'H2', -0.24, 0.927, 0.0]]]]],
+               ['ION', [[1, 'SOD', [[4, 'SOD', 5.0, 5.0, 5.0]]]]]]
+        atomList = [[1, 'WT', 1, 'WAT', 'OH2', 'OT', -0.834, 15.9994],
+                    [2, 'WT', 1, 'WAT', 'H1', 'HT', 0.417, 1.008],
+                    [3, 'WT', 1, 'WAT', 'H2', 'HT', 0.417, 1.008],
+                    [4, 'ION', 1, 'SOD', 'SOD', 'SOD', 1.0, 22.98977]]
+        topList = [atomList,
+                   mdbuilder.term_array([[1, 2], [1, 3]], 2),
+                   mdbuilder.term_array([[2, 1, 3]], 3),
+                   mdbuilder.term_array([], 4),
+                   mdbuilder.term_array([], 4),
+                   mdbuilder.term_array([], 8)]
+        return {
+            'mod': mod,
+            'topList': topList,
+            'watPos': [[[[0.0, 0.0, 0.0], [0.957, 0.0, 0.0],
+                         [-0.24, 0.927, 0.0]]]],
+            'sluPos': [(5.0, 5.0, 5.0)],
+            'boxInfo': ([10.0, 10.0, 10.0], [0.0, 0.0, 0.0],
+                        [10.0, 10.0, 10.0]),
+            'tmpmod': None,
+            'tmptopList': None,
+            }
+
+    def test_round_trip(self):
+        state = self.state()
+        options = mdbuilder.default_options()
+        options['ADDWAT']['DOADDWAT'] = True
+        ckptFile = self.path('state.npz')
+        mdbuilder.save_checkpoint(ckptFile, state, 'Ionization', options)
+        newState, stage, newOptions = mdbuilder.load_checkpoint(ckptFile)
+
+        self.assertEqual(stage, 'Ionization')
+        self.assertEqual(newOptions, options)
+        for key in ('mod', 'watPos', 'sluPos', 'tmpmod', 'tmptopList'):
+            self.assertEqual(newState[key], state[key], key)
+        self.assertEqual(list(newState['boxInfo']), list(state['boxInfo']))
+        self.assertEqual(newState['topList'][0], state['topList'][0])
+        for new, old in zip(newState['topList'][1:], state['topList'][1:]):
+            self.assertEqual(new.tolist(), old.tolist())
+
+    def test_unknown_stage(self):
+        self.assertRaises(ValueError, mdbuilder.save_checkpoint,
+                          self.path('state.npz'), self.state(), 'Nothing',
+                          mdbuilder.default_options())
+
+
+class BondGraphTest(unittest.TestCase):
+    # 5
+    # |
+    # 1 - 2 - 3 - 4
+    BONDS = [[1, 2], [2, 3], [3, 4], [2, 5]]
+
+    @staticmethod
+    def terms(array):
+        return sorted(min(tuple(term), tuple(term)[::-1])
+                      for term in array.tolist())
+
+    def test_angles(self):
+        graph = mdbuilder.BondGraph(self.BONDS, 5)
+        self.assertEqual(self.terms(graph.angles()),
+                         [(1, 2, 3), (1, 2, 5), (2, 3, 4), (3, 2, 5)])
+
+    def test_dihedrals(self):
+        graph = mdbuilder.BondGraph(self.BONDS, 5)
+        self.assertEqual(self.terms(graph.dihedrals()),
+                         [(1, 2, 3, 4), (4, 3, 2, 5)])
+        self.assertEqual(self.terms(graph.pairs14()), [(1, 4), (4, 5)])
+
+    def test_ring(self):
+        # in a three-membered ring the ends of a dihedral are bonded
+        graph = mdbuilder.BondGraph([[1, 2], [2, 3], [3, 1], [3, 4]], 4)
+        self.assertEqual(len(graph.angles()), 5)
+        self.assertEqual(self.terms(graph.pairs14()), [])
+
+
+class ServerTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.socketPath = self.path('server.sock')
+        self.server = mdbuilder.ForceFieldServer(self.socketPath)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            mdbuilder.ff_request({'op': 'shutdown'}, self.socketPath)
+        self.thread.join()
+        TempDirTestCase.tearDown(self)
+
+    def request(self, request):
+        return mdbuilder.ff_request(request, self.socketPath)
+
+    def test_ping(self):
+        reply = self.request({'op': 'ping'})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['version'], mdbuilder.__version__)
+        self.assertEqual(reply['forcefields'], 0)
+
+    def test_load(self):
+        options = {
+            'TOPOLOGY': os.path.join(EXAMPLES, 'top_all22_prot.inp'),
+            'FORCEFIELD': os.path.join(EXAMPLES, 'par_all27_prot_lipid.prm'),
+            }
+        for _ in range(2):
+            reply = self.request({'op': 'load', 'options': options})
+            self.assertTrue(reply['ok'], reply.get('error'))
+            self.assertEqual(reply['forcefields'], 1)
+
+    def test_errors(self):
+        reply = self.request({'op': 'nothing'})
+        self.assertFalse(reply['ok'])
+        self.assertIn('Unknown request', reply['error'])
+        reply = self.request({'op': 'load', 'options': {
+            'TOPOLOGY': self.path('missing.rtf'), 'FORCEFIELD': []}})
+        self.assertFalse(reply['ok'])
+        # the server keeps serving after a failed request
+        self.assertTrue(self.request({'op': 'ping'})['ok'])
+
+    def test_shutdown(self):
+        self.assertTrue(self.request({'op': 'shutdown'})['ok'])
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.socketPath))
+
+
+if __name__ == '__main__':
+    unittest.main()